@@ -0,0 +1,298 @@
+# Copyright (C) 2013  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Catalog of the files cached in the Oz data directory
+"""
+
+import os
+import time
+import errno
+import fcntl
+
+import oz.ozutil
+import oz.JeosCache
+
+# the kinds of cached files that the catalog knows about
+CATEGORIES = ["iso", "modified", "kernel", "floppy", "jeos"]
+
+class CacheCatalog(object):
+    """
+    Class to keep track of the files cached in the Oz data directory: the
+    original ISOs, kernels, initrds and floppies, the modified media made
+    from them, and the cached JEOS images.  For each cached file the catalog
+    records its category, the space it uses, when it was added and last
+    used, how many times it was used from the cache, and where it came from.
+    The catalog is used to keep the cache under size quotas, removing the
+    least recently used files first.
+
+    Several cached files can be hard links to the same data (the original
+    media in the media store, and the snapshots of cached JEOS images that
+    overlays use), so the space used by each inode is only counted once.
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.index_path = os.path.join(data_dir, "catalog.json")
+        self.lock_path = os.path.join(data_dir, "catalog.lock")
+
+    def _name(self, path):
+        """
+        Internal method to return the name of the cached file at path in the
+        catalog, which is its path relative to the data directory.
+        """
+        return os.path.relpath(os.path.abspath(path),
+                               os.path.abspath(self.data_dir))
+
+    def _read_index(self):
+        """
+        Internal method to read the index, returning an empty one if there is
+        no index yet.
+        """
+        index = oz.ozutil.read_json_file(self.index_path)
+        if index is None:
+            index = {}
+        return index
+
+    def _update(self, func):
+        """
+        Internal method to call func with the index, with the index lock
+        held, and write the index back afterwards.  Returns what func
+        returns.
+        """
+        oz.ozutil.mkdir_p(self.data_dir)
+        lockfd = os.open(self.lock_path, os.O_RDWR|os.O_CREAT)
+        try:
+            fcntl.lockf(lockfd, fcntl.LOCK_EX)
+            index = self._read_index()
+            ret = func(index)
+            oz.ozutil.write_json_file(self.index_path, index)
+        finally:
+            os.close(lockfd)
+        return ret
+
+    def use(self, path, category, provenance=None):
+        """
+        Method to record that the cached file at path, of the given category,
+        was just added to the cache or used from it.  If the catalog already
+        has the same file, its hit count goes up; otherwise (the file is new,
+        or was replaced since the catalog last saw it) a new entry is made,
+        recording the dictionary provenance about where the file came from.
+        """
+        if category not in CATEGORIES:
+            raise Exception("Invalid cache category %s" % (category))
+
+        st = os.stat(path)
+        name = self._name(path)
+
+        def _use(index):
+            now = time.time()
+            entry = index.get(name)
+            if entry is not None and entry.get('inode') == st.st_ino and entry.get('mtime') == st.st_mtime:
+                entry['hits'] = entry.get('hits', 0) + 1
+                entry['last_used'] = now
+                entry['size'] = st.st_blocks * 512
+                entry['device'] = st.st_dev
+                if provenance:
+                    entry['provenance'] = provenance
+                return
+            index[name] = {'category': category,
+                           'size': st.st_blocks * 512,
+                           'inode': st.st_ino,
+                           'device': st.st_dev,
+                           'mtime': st.st_mtime,
+                           'created': now,
+                           'last_used': now,
+                           'hits': 0,
+                           'provenance': provenance or {}}
+        self._update(_use)
+
+    def _refresh(self, index):
+        """
+        Internal method to drop the entries for cached files that no longer
+        exist (or were replaced by files the catalog has not seen), and to
+        update the sizes of the rest.  Must be called with the index lock
+        held.
+        """
+        for name in list(index.keys()):
+            try:
+                st = os.stat(os.path.join(self.data_dir, name))
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                del index[name]
+                continue
+            if st.st_ino != index[name].get('inode'):
+                del index[name]
+                continue
+            index[name]['size'] = st.st_blocks * 512
+            index[name]['device'] = st.st_dev
+
+    def _groups(self, index, names):
+        """
+        Internal method to group the cached files names by the inode they
+        are, since hard links to the same inode only use its space once.
+        Returns a dictionary of (device, inode) to the list of names.
+        """
+        groups = {}
+        for name in names:
+            key = (index[name].get('device'), index[name].get('inode'))
+            groups.setdefault(key, []).append(name)
+        return groups
+
+    def _size(self, index, names):
+        """
+        Internal method to return the bytes that the cached files names use
+        together, counting each inode once.
+        """
+        return sum([index[group[0]].get('size', 0)
+                    for group in self._groups(index, names).values()])
+
+    def _remove(self, name, entry):
+        """
+        Internal method to remove the cached file name.  Files that another
+        build is fetching, or checking, at the moment (that is, whose lock
+        file is locked) are left alone.  If the file is original media stored
+        in the media store, and nothing else links to the stored copy, the
+        stored copy is removed as well so the space is really freed.
+        Snapshots of cached JEOS images that overlays still use are left
+        alone as well.  Returns True if the file was removed.
+        """
+        path = os.path.join(self.data_dir, name)
+        if 'snapshot_of' in entry.get('provenance', {}):
+            jeos_cache = oz.JeosCache.JeosCache(os.path.dirname(path), None)
+            if jeos_cache.in_use(path):
+                return False
+
+        lockfd = None
+        if os.access(path + ".lock", os.F_OK):
+            lockfd = os.open(path + ".lock", os.O_RDWR)
+        try:
+            if lockfd is not None:
+                try:
+                    fcntl.lockf(lockfd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+                except (IOError, OSError) as err:
+                    if err.errno not in [errno.EACCES, errno.EAGAIN]:
+                        raise
+                    return False
+
+            oz.ozutil.unlink_if_exists(path)
+            oz.ozutil.unlink_if_exists(path + ".ozsha256")
+
+            blob = entry.get('provenance', {}).get('blob')
+            if blob is not None:
+                blob = os.path.join(self.data_dir, blob)
+                try:
+                    if os.stat(blob).st_nlink == 1:
+                        os.unlink(blob)
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+        finally:
+            if lockfd is not None:
+                os.close(lockfd)
+        return True
+
+    def _evict(self, index, limit, category=None):
+        """
+        Internal method to remove the cached files in category (or in every
+        category, if category is None), least recently used first, until they
+        use at most limit bytes.  Hard links to the same inode are removed
+        together, since removing only some of them frees nothing; an inode
+        counts as used when the most recently used of its links was.  Must
+        be called with the index lock held.  Returns the list of paths that
+        were removed.
+        """
+        names = [name for name in index
+                 if category is None or index[name].get('category') == category]
+        groups = list(self._groups(index, names).values())
+        groups.sort(key=lambda group: max([index[name].get('last_used', 0)
+                                           for name in group]))
+
+        total = self._size(index, names)
+        removed = []
+        for group in groups:
+            if total <= limit:
+                break
+            size = index[group[0]].get('size', 0)
+            freed = True
+            for name in group:
+                if not self._remove(name, index[name]):
+                    freed = False
+                    continue
+                del index[name]
+                removed.append(os.path.join(self.data_dir, name))
+            if freed:
+                total -= size
+        return removed
+
+    def enforce(self, quotas, max_size):
+        """
+        Method to bring the cache under its quotas.  quotas is a dictionary
+        of category to the most bytes the files of that category may use (or
+        None for no limit), and max_size is the most bytes all of the cached
+        files together may use (or None for no limit).  The least recently
+        used files are removed first.  Returns the list of paths that were
+        removed.
+        """
+        def _enforce(index):
+            self._refresh(index)
+            removed = []
+            for category in CATEGORIES:
+                if quotas.get(category) is not None:
+                    removed.extend(self._evict(index, quotas[category],
+                                               category))
+            if max_size is not None:
+                removed.extend(self._evict(index, max_size))
+            return removed
+        return self._update(_enforce)
+
+    def stats(self):
+        """
+        Method to return a dictionary of category to a dictionary with the
+        number of cached files ('count'), the bytes they use ('size'), and
+        the number of times they were used from the cache ('hits').  Every
+        category is included, even if it has no cached files, along with
+        'total' for all of the cached files together.  Hard links to the
+        same inode are counted as files, but their space only once.
+        """
+        index = self._update(lambda index: self._refresh(index) or index)
+        stats = {}
+        for category in CATEGORIES:
+            stats[category] = {'count': 0, 'size': 0, 'hits': 0}
+        names = {}
+        for name, entry in index.items():
+            category = stats.setdefault(entry.get('category'),
+                                        {'count': 0, 'size': 0, 'hits': 0})
+            category['count'] += 1
+            category['hits'] += entry.get('hits', 0)
+            names.setdefault(entry.get('category'), []).append(name)
+        for category in names:
+            stats[category]['size'] = self._size(index, names[category])
+        stats['total'] = {'count': len(index),
+                          'size': self._size(index, list(index.keys())),
+                          'hits': sum([entry.get('hits', 0)
+                                       for entry in index.values()])}
+        return stats
+
+    def entries(self):
+        """
+        Method to return the list of (path, entry) pairs of the catalog,
+        least recently used first.
+        """
+        index = self._update(lambda index: self._refresh(index) or index)
+        names = sorted(index, key=lambda name: index[name].get('last_used', 0))
+        return [(os.path.join(self.data_dir, name), index[name])
+                for name in names]
@@ -66,17 +66,18 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
                                                               "-jeos.preseed"
                                                               )
 
-    def _modify_iso(self):
+    def _modified_iso_files(self):
         """
-        Method to make the boot ISO auto-boot with appropriate parameters.
+        Method to return the files on the Debian ISO that are changed in
+        place.
         """
-        self.log.debug("Modifying ISO")
-
-        self.log.debug("Copying preseed file")
-        oz.ozutil.mkdir_p(os.path.join(self.iso_contents, "preseed"))
-
-        outname = os.path.join(self.iso_contents, "preseed", "customiso.seed")
+        return ["isolinux/isolinux.cfg", "isolinux/isolinux.bin",
+                "preseed/customiso.seed"]
 
+    def _render_auto_file(self, outname):
+        """
+        Method to write the preseed file for the install to outname.
+        """
         if self.preseed_file == oz.ozutil.generate_full_auto_path(
                                                               "debian-" +
                                                               self.tdl.update +
@@ -101,6 +102,18 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         else:
             shutil.copy(self.preseed_file, outname)
 
+    def _modify_iso(self):
+        """
+        Method to make the boot ISO auto-boot with appropriate parameters.
+        """
+        self.log.debug("Modifying ISO")
+
+        self.log.debug("Copying preseed file")
+        oz.ozutil.mkdir_p(os.path.join(self.iso_contents, "preseed"))
+
+        self._render_auto_file(os.path.join(self.iso_contents, "preseed",
+                                            "customiso.seed"))
+
         if self.tdl.arch == "x86_64":
             installdir = "/install.amd"
         else:
@@ -135,14 +148,14 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.info("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-l", "-no-emul-boot",
-                                           "-b", "isolinux/isolinux.bin",
-                                           "-c", "isolinux/boot.cat",
-                                           "-boot-load-size", "4",
-                                           "-cache-inodes", "-boot-info-table",
-                                           "-v", "-v", "-o", self.output_iso,
-                                           self.iso_contents])
+        self._run_genisoimage(["-r", "-V", "Custom",
+                               "-J", "-l", "-no-emul-boot",
+                               "-b", "isolinux/isolinux.bin",
+                               "-c", "isolinux/boot.cat",
+                               "-boot-load-size", "4",
+                               "-cache-inodes", "-boot-info-table",
+                               "-v", "-v", "-o", self.output_iso,
+                               self.iso_contents])
 
     def _internal_customize(self, libvirt_xml, action):
         """
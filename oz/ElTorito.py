@@ -0,0 +1,303 @@
+# Copyright (C) 2013  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Parsing of El Torito boot catalogs on ISOs
+"""
+
+import os
+import sys
+import array
+import struct
+import threading
+
+import oz.OzException
+import oz.ozutil
+
+SECTOR_SIZE = 2048
+
+# platform IDs from the El Torito specification, plus the one for EFI
+PLATFORM_X86 = 0x0
+PLATFORM_PPC = 0x1
+PLATFORM_MAC = 0x2
+PLATFORM_EFI = 0xef
+
+# the longest boot catalog we are prepared to read; real ones are a single
+# sector
+_MAX_CATALOG_SECTORS = 16
+
+class BootEntry(object):
+    """
+    Class that represents one entry of a boot catalog: the default entry,
+    or an entry in one of the sections that follow it.
+    """
+    def __init__(self, platform, bootable, media, load_segment, system_type,
+                 sector_count, load_rba):
+        self.platform = platform
+        self.bootable = bootable
+        self.media = media
+        self.load_segment = load_segment
+        self.system_type = system_type
+        self.sector_count = sector_count
+        self.load_rba = load_rba
+
+    def image_length(self):
+        """
+        Method to return the length in bytes of the boot image of this entry.
+        """
+        if self.media in [0, 4]:
+            # The eltorito specification section 2.5 says:
+            #
+            # Sector Count. This is the number of virtual/emulated sectors
+            # the system will store at Load Segment during the initial boot
+            # procedure.
+            #
+            # and then Section 1.5 says:
+            #
+            # Virtual Disk - A series of sectors on the CD which INT 13
+            # presents to the system as a drive with 200 byte virtual
+            # sectors. There are 4 virtual sectors found in each sector on a
+            # CD.
+            #
+            # (note that the bytes above are in hex).  So the image is
+            # sector_count*512 bytes
+            return self.sector_count * 512
+        if self.media == 1:
+            # 1.2MB floppy
+            return 1200*1024
+        if self.media == 2:
+            # 1.44MB floppy
+            return 1440*1024
+        if self.media == 3:
+            # 2.88MB floppy
+            return 2880*1024
+        raise oz.OzException.OzException("invalid CD media type")
+
+class BootCatalog(object):
+    """
+    Class that represents the boot catalog of an ISO.  default is the
+    BootEntry of the default entry, and entries is the list of every entry,
+    starting with the default one, so that EFI images in the sections after
+    the default entry can be found as well.
+    """
+    def __init__(self, default, entries):
+        self.default = default
+        self.entries = entries
+
+    def find(self, platform):
+        """
+        Method to return the first bootable entry for platform, or None if
+        there is none.
+        """
+        for entry in self.entries:
+            if entry.platform == platform and entry.bootable:
+                return entry
+        return None
+
+def _checksum(data):
+    """
+    Function to compute the checksum of a validation entry, which is the sum
+    of its little-endian 16-bit words.  Note that this is *not* a 1's
+    complement checksum; when an addition overflows, the carry bit is
+    discarded, not added to the end.
+    """
+    words = array.array('H', bytes(data))
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return sum(words) & 0xffff
+
+def _read(fd, offset, length):
+    """
+    Function to read length bytes from fd at offset, raising an OzException
+    if the ISO is too short.
+    """
+    data = b""
+    while len(data) < length:
+        buf = oz.ozutil.pread(fd, length - len(data), offset + len(data))
+        if not buf:
+            raise oz.OzException.OzException("ISO is too short for an El Torito boot catalog")
+        data += buf
+    return data
+
+def _check_primary_volume_descriptor(fd):
+    """
+    Function to make sure that the ISO starts with a sane primary volume
+    descriptor.
+    """
+    pvd = _read(fd, 16*SECTOR_SIZE, 88)
+    if pvd[0:1] != b"\x01":
+        raise oz.OzException.OzException("Invalid primary volume descriptor")
+    if pvd[1:6] != b"CD001":
+        raise oz.OzException.OzException("invalid CD isoIdentification")
+    if pvd[7:8] != b"\x00":
+        raise oz.OzException.OzException("data in unused field")
+    if pvd[72:80] != b"\x00"*8:
+        raise oz.OzException.OzException("data in 2nd unused field")
+
+class _CatalogReader(object):
+    """
+    Class to read the entries of a boot catalog.  The catalog is read a
+    sector at a time into one buffer, and only read past its first sector if
+    it really is that long.
+    """
+    def __init__(self, fd, sector):
+        self.fd = fd
+        self.start = sector * SECTOR_SIZE
+        self.buf = bytearray()
+
+    def entry(self, index):
+        """
+        Method to return the offset in buf of the 32 byte entry index,
+        reading more of the catalog if necessary.
+        """
+        end = (index + 1) * 32
+        while len(self.buf) < end:
+            if len(self.buf) >= _MAX_CATALOG_SECTORS * SECTOR_SIZE:
+                raise oz.OzException.OzException("El Torito boot catalog is too long")
+            self.buf.extend(_read(self.fd, self.start + len(self.buf),
+                                  SECTOR_SIZE))
+        return index * 32
+
+def _parse_entry(buf, offset, platform):
+    """
+    Function to parse the initial/default or section entry at offset in buf.
+    """
+    (boot, media, load_segment, system_type, unused, sector_count,
+     load_rba) = struct.unpack_from("<BBHBBHI", buf, offset)
+    # the upper bits of the media type are flags
+    return BootEntry(platform, boot == 0x88, media & 0x0f, load_segment,
+                     system_type, sector_count, load_rba)
+
+def _parse_catalog(reader):
+    """
+    Function to parse the boot catalog read by reader.
+    """
+    buf = reader.buf
+
+    # the boot catalog starts with the validation entry
+    offset = reader.entry(0)
+    (header, platform, unused, five,
+     aa) = struct.unpack_from("<BBH26xBB", buf, offset)
+    if header != 0x1:
+        raise oz.OzException.OzException("invalid CD boot sector header")
+    if platform not in [PLATFORM_X86, PLATFORM_PPC, PLATFORM_MAC,
+                        PLATFORM_EFI]:
+        raise oz.OzException.OzException("invalid CD boot sector platform")
+    if unused != 0x0:
+        raise oz.OzException.OzException("invalid CD unused boot sector field")
+    if five != 0x55 or aa != 0xaa:
+        raise oz.OzException.OzException("invalid CD boot sector footer")
+    csum = _checksum(buf[offset:offset + 32])
+    if csum != 0:
+        raise oz.OzException.OzException("invalid CD checksum: expected 0, saw %d" % (csum))
+
+    # followed by the default entry
+    offset = reader.entry(1)
+    if buf[offset] != 0x88:
+        raise oz.OzException.OzException("invalid CD initial boot indicator")
+    if buf[offset + 5] != 0x0 or buf[offset + 12] != 0x0:
+        raise oz.OzException.OzException("invalid CD initial boot unused field")
+    default = _parse_entry(buf, offset, platform)
+    entries = [default]
+
+    # and then by any number of sections, each a header followed by its
+    # entries; the last header is marked with 0x91.  Section entries may be
+    # followed by extension entries, which we do not need
+    index = 2
+    header = 0x90
+    while header == 0x90:
+        offset = reader.entry(index)
+        header = buf[offset]
+        if header not in [0x90, 0x91]:
+            break
+        (platform, count) = struct.unpack_from("<BH", buf, offset + 1)
+        index += 1
+        for i in range(count):
+            entries.append(_parse_entry(buf, reader.entry(index), platform))
+            index += 1
+            while buf[reader.entry(index)] == 0x44:
+                index += 1
+
+    return BootCatalog(default, entries)
+
+def read_boot_catalog(path):
+    """
+    Function to read the El Torito boot catalog of the ISO at path.  Raises
+    an OzException if the ISO is not bootable.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        _check_primary_volume_descriptor(fd)
+
+        # the 17th sector contains the boot record, which says where the boot
+        # catalog is
+        (boot, ident, version, spec,
+         sector) = struct.unpack_from("<B5sB32s32xI",
+                                      _read(fd, 17*SECTOR_SIZE, 75))
+        if boot != 0x0:
+            raise oz.OzException.OzException("invalid CD boot sector")
+        if ident != b"CD001":
+            raise oz.OzException.OzException("invalid CD isoIdentification")
+        if version != 0x1:
+            raise oz.OzException.OzException("invalid CD version")
+        if spec.rstrip(b"\0") != b"EL TORITO SPECIFICATION":
+            raise oz.OzException.OzException("invalid CD torito specification")
+
+        # OK, this looks like a bootable CD
+        return _parse_catalog(_CatalogReader(fd, sector))
+    finally:
+        os.close(fd)
+
+# parsed boot catalogs, keyed by the SHA-256 digest of the ISO
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def boot_catalog(path, digest=None):
+    """
+    Function to return the boot catalog of the ISO at path.  If the SHA-256
+    digest of the ISO is given, the parsed catalog is remembered, so that
+    later builds from the same ISO in this process do not parse it again.
+    """
+    if digest is None:
+        return read_boot_catalog(path)
+
+    with _catalogs_lock:
+        catalog = _catalogs.get(digest)
+    if catalog is None:
+        catalog = read_boot_catalog(path)
+        with _catalogs_lock:
+            _catalogs[digest] = catalog
+    return catalog
+
+def extract_boot_image(path, entry, outfile):
+    """
+    Function to write the boot image of the boot catalog entry to the file
+    outfile.  The image is copied straight from the ISO with copy_range(),
+    rather than read into memory.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = entry.load_rba * SECTOR_SIZE
+        length = min(entry.image_length(), os.fstat(fd).st_size - offset)
+        if length < 0:
+            raise oz.OzException.OzException("El Torito boot image is past the end of the ISO")
+        outfd = os.open(outfile, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o644)
+        try:
+            oz.ozutil.copy_range(fd, outfd, offset, length)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(fd)
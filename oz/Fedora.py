@@ -19,8 +19,6 @@
 Fedora installation
 """
 
-import os
-
 import oz.ozutil
 import oz.RedHat
 import oz.OzException
@@ -49,29 +47,34 @@ class FedoraGuest(oz.RedHat.RedHatCDYumGuest):
         self.haverepo = haverepo
         self.brokenisomethod = brokenisomethod
 
-    def _modify_iso(self):
+    def _cdrom_kickstart(self):
         """
-        Method to modify the ISO for autoinstallation.
+        Method to return where the installer finds the kickstart on the
+        modified ISO.
         """
-        self._copy_kickstart(os.path.join(self.iso_contents, "ks.cfg"))
-
         if self.tdl.update in ["17", "18"]:
-            initrdline = "  append initrd=initrd.img ks=cdrom:/dev/cdrom:/ks.cfg"
-        else:
-            initrdline = "  append initrd=initrd.img ks=cdrom:/ks.cfg"
+            return "cdrom:/dev/cdrom:/ks.cfg"
+        return "cdrom:/ks.cfg"
+
+    def _boot_args(self, ks):
+        """
+        Method to return the kernel command line arguments that start an
+        automated install with the kickstart at ks, and tell the installer
+        where to install from.
+        """
+        args = "ks=" + ks
         if self.tdl.installtype == "url":
             if self.haverepo:
-                initrdline += " repo="
+                args += " repo="
             else:
-                initrdline += " method="
-            initrdline += self.url + "\n"
+                args += " method="
+            args += self.url
         else:
             # if the installtype is iso, then due to a bug in anaconda we leave
             # out the method completely
             if not self.brokenisomethod:
-                initrdline += " method=cdrom:/dev/cdrom"
-            initrdline += "\n"
-        self._modify_isolinux(initrdline)
+                args += " method=cdrom:/dev/cdrom"
+        return args
 
     def generate_diskimage(self, size=10, force=False):
         """
@@ -19,8 +19,6 @@
 Fedora Core installation
 """
 
-import os
-
 import oz.ozutil
 import oz.RedHat
 import oz.OzException
@@ -44,19 +42,6 @@ class FedoraCoreGuest(oz.RedHat.RedHatCDGuest):
         # FIXME: if doing an ISO install, we have to check that the ISO passed
         # in is the DVD, not the CD (since we can't change disks midway)
 
-    def _modify_iso(self):
-        """
-        Method to modify the ISO for autoinstallation.
-        """
-        self._copy_kickstart(os.path.join(self.iso_contents, "ks.cfg"))
-
-        initrdline = "  append initrd=initrd.img ks=cdrom:/ks.cfg method="
-        if self.tdl.installtype == "url":
-            initrdline += self.url + "\n"
-        else:
-            initrdline += "cdrom:/dev/cdrom\n"
-        self._modify_isolinux(initrdline)
-
 def get_class(tdl, config, auto, output_disk=None, netdev=None, diskbus=None,
               macaddress=None):
     """
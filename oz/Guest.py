@@ -23,7 +23,6 @@ import uuid
 import libvirt
 import os
 import fcntl
-import subprocess
 import shutil
 import time
 try:
@@ -38,14 +37,24 @@ import guestfs
 import socket
 import struct
 import tempfile
+import tarfile
+import threading
 import M2Crypto
 import base64
 import hashlib
 import errno
 import re
+import json
 
 import oz.ozutil
 import oz.OzException
+import oz.MediaStore
+import oz.ElTorito
+import oz.ISO
+import oz.ISORemaster
+import oz.JeosCache
+import oz.CacheCatalog
+import oz.TreeCache
 
 def subprocess_check_output(*popenargs, **kwargs):
     """
@@ -55,6 +64,142 @@ def subprocess_check_output(*popenargs, **kwargs):
     """
     return oz.ozutil.subprocess_check_output(*popenargs, **kwargs)
 
+# parsed checksum files, keyed by (URL, hash name); see
+# Guest._get_checksum_index()
+_checksum_indexes = {}
+
+def _pool_target_path(pool):
+    """
+    Function to return the target path of a libvirt storage pool, or None
+    if it does not have one.
+    """
+    doc = libxml2.parseDoc(pool.XMLDesc(0))
+    try:
+        res = doc.xpathEval('/pool/target/path')
+        if len(res) != 1:
+            return None
+        return res[0].getContent()
+    finally:
+        doc.freeDoc()
+
+class _StoragePoolIndex(object):
+    """
+    Class to find the libvirt storage pool that manages a directory without
+    fetching and parsing the XML of every pool on the host each time.  The
+    index maps each libvirt URI and directory to the name of the pool that
+    managed it when the pools were last scanned, and is kept in a file so
+    that it outlives a single run.  A hit is revalidated by fetching the XML
+    of just that pool; only a miss (or a hit that turns out to be stale)
+    scans all of the pools, which rebuilds the index.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        """
+        Internal method to read the index, returning an empty one if there
+        is no index yet.
+        """
+        index = oz.ozutil.read_json_file(self.path)
+        if index is None:
+            index = {}
+        return index
+
+    def _scan(self, conn):
+        """
+        Internal method to scan all of the pools of conn, returning a
+        dictionary of directory to pool name.
+        """
+        pools = {}
+        # sigh.  Yes, this is racy; if a pool is defined during this loop, we
+        # might miss it.  I'm not quite sure how to do it better, and in any
+        # case we don't expect that to happen to often
+        for poolname in conn.listDefinedStoragePools() + conn.listStoragePools():
+            if poolname == "oztempdir":
+                # the transient pool of another build; it is about to go
+                continue
+            try:
+                path = _pool_target_path(conn.storagePoolLookupByName(poolname))
+            except libvirt.libvirtError:
+                # the pool went away while we were looking
+                continue
+            if path is not None:
+                pools[path] = poolname
+        return pools
+
+    def lookup(self, conn, directory):
+        """
+        Method to return the storage pool of conn that manages directory, or
+        None if no pool does.
+        """
+        uri = conn.getURI()
+        poolname = self._read().get(uri, {}).get(directory)
+        if poolname is not None:
+            try:
+                pool = conn.storagePoolLookupByName(poolname)
+                if _pool_target_path(pool) == directory:
+                    return pool
+            except libvirt.libvirtError:
+                # the pool is gone
+                pass
+
+        pools = self._scan(conn)
+        index = self._read()
+        index[uri] = pools
+        oz.ozutil.mkdir_p(os.path.dirname(self.path))
+        oz.ozutil.write_json_file(self.path, index)
+        if directory not in pools:
+            return None
+        return conn.storagePoolLookupByName(pools[directory])
+
+class _TarExtractor(threading.Thread):
+    """
+    Class to extract a tar stream into a directory in a separate thread.  The
+    members of an ISO are read-only, so the owner write bit is added to the
+    mode of every member as it is written; that way the tree can be modified
+    and removed without a separate pass to fix up the permissions.
+    """
+    def __init__(self, stream, dest):
+        threading.Thread.__init__(self)
+        self.stream = stream
+        self.dest = dest
+        self.error = None
+
+    def _members(self, tar):
+        """
+        Method to yield the members of tar, made writable by the owner.
+        """
+        for member in tar:
+            if member.isdir():
+                member.mode |= stat.S_IRWXU
+            elif not member.issym():
+                member.mode |= stat.S_IRUSR|stat.S_IWUSR
+            yield member
+
+    def run(self):
+        """
+        Method to extract the stream; any error is saved in error.
+        """
+        try:
+            tar = tarfile.open(fileobj=self.stream, mode='r|')
+            try:
+                kwargs = {}
+                if hasattr(tarfile, 'fully_trusted_filter'):
+                    # the stream comes from the ISO we are about to modify;
+                    # keep absolute symlinks and modes as they are
+                    kwargs['filter'] = 'fully_trusted'
+                tar.extractall(self.dest, self._members(tar), **kwargs)
+            finally:
+                tar.close()
+        except Exception as err:
+            self.error = err
+        finally:
+            # drain whatever is left, so the writer never blocks on a full
+            # pipe
+            while self.stream.read(65536):
+                pass
+            self.stream.close()
+
 class Guest(object):
     """
     Main class for guest installation.
@@ -177,21 +322,62 @@ class Guest(object):
         self.cache_modified_media = oz.ozutil.config_get_boolean_key(config,
                                                                      'cache',
                                                                      'modified_media',
-                                                                     False)
+                                                                     True)
         self.cache_jeos = oz.ozutil.config_get_boolean_key(config, 'cache',
                                                            'jeos', False)
-
+        self.jeos_overlay = oz.ozutil.config_get_boolean_key(config, 'cache',
+                                                             'jeos_overlay',
+                                                             False)
+        self.jeos_flatten = oz.ozutil.config_get_boolean_key(config, 'cache',
+                                                             'jeos_flatten',
+                                                             False)
+        self.reverify_media = oz.ozutil.config_get_boolean_key(config,
+                                                               'cache',
+                                                               'reverify_media',
+                                                               False)
+        # size quotas for the cache, overall and per category of cached file
+        self.cache_max_size = oz.ozutil.config_get_size_key(config, 'cache',
+                                                            'max_size', None)
+        self.cache_quotas = {}
+        for category in oz.CacheCatalog.CATEGORIES:
+            self.cache_quotas[category] = oz.ozutil.config_get_size_key(config,
+                                                                        'cache',
+                                                                        category + '_max_size',
+                                                                        None)
+
+        # configuration from 'download' section
+        self.download_segments = int(oz.ozutil.config_get_key(config,
+                                                              'download',
+                                                              'segments', 4))
+
+        # configuration from 'mirrors' section
+        self.mirror_cache_ttl = int(oz.ozutil.config_get_key(config,
+                                                             'mirrors',
+                                                             'cache_ttl',
+                                                             3600))
+
+        # all of the HTTP requests for this guest go through one session, so
+        # that connections to the same server are reused
+        self.http = oz.ozutil.HttpSession()
+
+        self.media_store = oz.MediaStore.MediaStore(os.path.join(self.data_dir,
+                                                                 "store"))
+        self.cache_catalog = oz.CacheCatalog.CacheCatalog(self.data_dir)
+        self.storage_pools = _StoragePoolIndex(os.path.join(self.data_dir,
+                                                            "storagepools.json"))
         self.jeos_cache_dir = os.path.join(self.data_dir, "jeos")
-
-        # only pull a cached JEOS if it was built with the correct image type
-        if self.image_type == 'raw':
-            # backwards compatible
-            jeos_extension = 'dsk'
-        else:
-            jeos_extension = self.image_type
-
-        self.jeos_filename = os.path.join(self.jeos_cache_dir,
-                                          self.tdl.distro + self.tdl.update + self.tdl.arch + '.' + jeos_extension)
+        self.jeos_cache = oz.JeosCache.JeosCache(self.jeos_cache_dir,
+                                                 int(oz.ozutil.config_get_key(config,
+                                                                              'cache',
+                                                                              'jeos_variants',
+                                                                              4)))
+        # computed on first use; see the jeos_filename property
+        self._jeos_filename = None
+        self.jeos_inputs = None
+
+        # the cached JEOS snapshot that the disk image is an overlay on, if
+        # any; see _restore_jeos()
+        self.diskimage_backing = None
 
         self.diskimage = output_disk
         if self.diskimage is None:
@@ -203,6 +389,8 @@ class Guest(object):
 
         self.icicle_tmp = os.path.join(self.data_dir, "icicletmp",
                                        self.tdl.name)
+        # scratch trees are moved here to be removed in the background
+        self.trash_dir = os.path.join(self.data_dir, "trash")
         self.listen_port = random.randrange(1024, 65535)
 
         self.connect_to_libvirt()
@@ -307,7 +495,7 @@ class Guest(object):
         if os.access(self.diskimage, os.F_OK):
             raise oz.OzException.OzException("Diskimage %s already exists" % (self.diskimage))
 
-    # the next 4 methods are intended to be overridden by the individual
+    # the next 5 methods are intended to be overridden by the individual
     # OS backends; raise an error if they are called but not implemented
 
     def generate_install_media(self, force_download=False,
@@ -318,6 +506,14 @@ class Guest(object):
         """
         raise oz.OzException.OzException("Install media for %s%s is not implemented, install cannot continue" % (self.tdl.distro, self.tdl.update))
 
+    def prefetch_media(self, force_download=False):
+        """
+        Base method for fetching and verifying the original install media
+        ahead of time, so that a later generate_install_media() finds it in
+        the cache.  This is expected to be overridden by all subclasses.
+        """
+        raise oz.OzException.OzException("Prefetching media for %s%s is not implemented" % (self.tdl.distro, self.tdl.update))
+
     def customize(self, libvirt_xml):
         """
         Base method for customizing the operating system.  This is expected
@@ -370,9 +566,11 @@ class Guest(object):
         serialTarget.setProp("port", "1")
 
     def _generate_xml(self, bootdev, installdev, kernel=None, initrd=None,
-                      cmdline=None):
+                      cmdline=None, sidedev=None):
         """
-        Method to generate libvirt XML useful for installation.
+        Method to generate libvirt XML useful for installation.  sidedev is
+        an optional second installation device, like a floppy holding the
+        answer file.
         """
         self.log.info("Generate XML for guest %s with bootdev %s" % (self.tdl.name, bootdev))
 
@@ -469,15 +667,17 @@ class Guest(object):
         driver.setProp("name", "qemu")
         driver.setProp("type", self.image_type)
 
-        # install disk (if any)
-        if installdev:
+        # install disks (if any)
+        for dev in [installdev, sidedev]:
+            if not dev:
+                continue
             install = devices.newChild(None, "disk", None)
             install.setProp("type", "file")
-            install.setProp("device", installdev.devicetype)
+            install.setProp("device", dev.devicetype)
             source = install.newChild(None, "source", None)
-            source.setProp("file", installdev.path)
+            source.setProp("file", dev.path)
             target = install.newChild(None, "target", None)
-            target.setProp("dev", installdev.bus)
+            target.setProp("dev", dev.bus)
 
         xml = doc.serialize(None, 1)
         self.log.debug("Generated XML:\n%s" % (xml))
@@ -524,51 +724,41 @@ class Guest(object):
         permissions.newChild(None, "mode", "0666")
         vol_xml = doc.serialize(None, 1)
 
-        # sigh.  Yes, this is racy; if a pool is defined during this loop, we
-        # might miss it.  I'm not quite sure how to do it better, and in any case
-        # we don't expect that to happen to often
-        started = False
-        found = False
-        for poolname in self.libvirt_conn.listDefinedStoragePools() + self.libvirt_conn.listStoragePools():
-            pool = self.libvirt_conn.storagePoolLookupByName(poolname)
-            doc = libxml2.parseDoc(pool.XMLDesc(0))
-            res = doc.xpathEval('/pool/target/path')
-            if len(res) != 1:
-                continue
-            if res[0].getContent() == directory:
-                # OK, this pool manages that directory; make sure it is running
-                found = True
-                if not pool.isActive():
-                    pool.create(0)
-                    started = True
-
-        if not found:
-            pool = self.libvirt_conn.storagePoolCreateXML(pool_xml, 0)
-            started = True
-
-        # this is a bit complicated, because of the cases that can
-        # happen.  The cases are:
-        #
-        # 1.  The volume did not exist.  In this case, storageVolLookupByName()
-        #     throws an exception, which we just ignore.  We then go on to
-        #     create the volume
-        # 2.  The volume did exist.  In this case, storageVolLookupByName()
-        #     returns a valid volume object, and then we delete the volume
-        try:
+        pool = self.storage_pools.lookup(self.libvirt_conn, directory)
+        if pool is None and self.image_type in ['raw', 'qcow2']:
+            # no pool manages that directory, so there is nothing for libvirt
+            # to keep track of; just create the image
+            self._create_local_diskimage(size)
+        else:
+            started = False
+            if pool is None:
+                pool = self.libvirt_conn.storagePoolCreateXML(pool_xml, 0)
+                started = True
+            elif not pool.isActive():
+                # this pool manages that directory; make sure it is running
+                pool.create(0)
+                started = True
+
+            # this is a bit complicated, because of the cases that can
+            # happen.  The cases are:
+            #
+            # 1.  The volume did not exist.  In this case,
+            #     storageVolLookupByName() throws an exception, which we just
+            #     ignore.  We then go on to create the volume
+            # 2.  The volume did exist.  In this case, storageVolLookupByName()
+            #     returns a valid volume object, and then we delete the volume
             try:
-                vol = pool.storageVolLookupByName(filename)
-                vol.delete(0)
-            except libvirt.libvirtError as e:
-                if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
-                    raise
+                try:
+                    vol = pool.storageVolLookupByName(filename)
+                    vol.delete(0)
+                except libvirt.libvirtError as e:
+                    if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                        raise
 
-            try:
                 pool.createXML(vol_xml, 0)
-            except libvirt.libvirtError as e:
-                raise
-        finally:
-            if started:
-                pool.destroy()
+            finally:
+                if started:
+                    pool.destroy()
 
         if create_partition:
             g_handle = guestfs.GuestFS()
@@ -579,6 +769,27 @@ class Guest(object):
             g_handle.part_add(devices[0], 'p', 1, 2)
             g_handle.close()
 
+    def _create_local_diskimage(self, size):
+        """
+        Internal method to create an empty diskimage of size GB directly,
+        for directories that are not managed by a libvirt storage pool.
+        Raw images are sparse files, and qcow2 images are written with
+        oz.ozutil.create_qcow2(), so either takes no time.
+        """
+        oz.ozutil.unlink_if_exists(self.diskimage)
+        capacity = size * 1024 * 1024 * 1024
+        if self.image_type == 'qcow2':
+            oz.ozutil.create_qcow2(self.diskimage, capacity)
+        else:
+            fd = os.open(self.diskimage, os.O_WRONLY|os.O_CREAT|os.O_EXCL)
+            try:
+                os.ftruncate(fd, capacity)
+            finally:
+                os.close(fd)
+        # FIXME: this makes the permissions insecure, but is needed since
+        # libvirt launches guests as qemu:qemu.
+        os.chmod(self.diskimage, 0o666)
+
     def generate_diskimage(self, size=10, force=False):
         """
         Method to generate a diskimage.  By default, a blank diskimage of
@@ -591,6 +802,83 @@ class Guest(object):
         """
         return self._internal_generate_diskimage(size, force, False)
 
+    def _jeos_snapshot(self):
+        """
+        Internal method to return a snapshot of the cached JEOS for the
+        overlay at the disk image path to use as its backing file (see
+        JeosCache.snapshot).  When the cache is refreshed, existing overlays
+        keep using the JEOS they were created on.
+        """
+        return self.jeos_cache.snapshot(self.jeos_filename, self.diskimage)
+
+    def _restore_jeos(self):
+        """
+        Internal method to set up the disk image from the cached JEOS.  If
+        jeos_overlay is enabled and the image type is qcow2, the disk image
+        is created as a thin qcow2 overlay whose backing file is the cached
+        JEOS, which takes no time no matter how big the JEOS is, and only
+        the changes made by customization are written to it.  Otherwise the
+        cached JEOS is copied to the disk image.
+        """
+        if self.jeos_overlay and self.image_type == 'qcow2':
+            backing = os.path.abspath(self._jeos_snapshot())
+            self.log.info("Creating overlay on cached JEOS %s" % (backing))
+            oz.ozutil.unlink_if_exists(self.diskimage)
+            oz.ozutil.subprocess_check_output(["qemu-img", "create",
+                                               "-f", "qcow2",
+                                               "-b", backing, "-F", "qcow2",
+                                               self.diskimage])
+            self.diskimage_backing = backing
+            self._catalog_cache_use(backing, "jeos",
+                                    {'snapshot_of': os.path.basename(self.jeos_filename)})
+        else:
+            oz.ozutil.copyfile_sparse(self.jeos_filename, self.diskimage)
+        self.jeos_cache.touch(self.jeos_filename)
+        self._catalog_cache_use(self.jeos_filename, "jeos")
+
+    def _cache_jeos(self):
+        """
+        Internal method to store the freshly installed disk image as the
+        cached JEOS.  The copy is renamed into place, so overlays on a
+        snapshot of the previous JEOS are not affected.
+        """
+        self.log.info("Caching JEOS")
+        oz.ozutil.mkdir_p(self.jeos_cache_dir)
+        tmp = "%s.%d.tmp" % (self.jeos_filename, os.getpid())
+        try:
+            oz.ozutil.copyfile_sparse(self.diskimage, tmp)
+            os.rename(tmp, self.jeos_filename)
+        except:
+            oz.ozutil.unlink_if_exists(tmp)
+            raise
+        self.jeos_cache.add(self.jeos_filename,
+                            self.tdl.distro + self.tdl.update + self.tdl.arch,
+                            self.jeos_inputs)
+        self._catalog_cache_use(self.jeos_filename, "jeos")
+
+    def flatten_diskimage(self):
+        """
+        Method to turn the disk image into a standalone image, if it is an
+        overlay on a cached JEOS (see the jeos_overlay configuration key).
+        The overlay and its backing file are streamed into a new image by
+        qemu-img convert, which then replaces the overlay.  Does nothing if
+        the disk image is not an overlay.
+        """
+        if self.diskimage_backing is None:
+            return
+
+        self.log.info("Flattening %s" % (self.diskimage))
+        tmp = self.diskimage + ".flatten"
+        try:
+            oz.ozutil.subprocess_check_output(["qemu-img", "convert",
+                                               "-O", self.image_type,
+                                               self.diskimage, tmp])
+            os.rename(tmp, self.diskimage)
+        except:
+            oz.ozutil.unlink_if_exists(tmp)
+            raise
+        self.diskimage_backing = None
+
     def _get_disks_and_interfaces(self, libvirt_dom):
         """
         Method to figure out the disks and interfaces attached to a domain.
@@ -776,109 +1064,472 @@ class Guest(object):
 
         return True
 
-    def _get_csums(self, original_url, outdir, outputfd):
+    def _get_csum_url(self):
         """
-        Internal method to fetch the checksum file and compute the checksum
-        on the downloaded data.
+        Internal method to find out which checksum file (if any) the TDL asks
+        us to verify the original media against.  Returns a tuple of the URL
+        of the checksum file and the name of the hash, or (None, None) if no
+        checksum was requested.
         """
         if self.tdl.iso_md5_url:
-            url = self.tdl.iso_md5_url
-            hashname = 'md5'
+            return self.tdl.iso_md5_url, 'md5'
         elif self.tdl.iso_sha1_url:
-            url = self.tdl.iso_sha1_url
-            hashname = 'sha1'
+            return self.tdl.iso_sha1_url, 'sha1'
         elif self.tdl.iso_sha256_url:
-            url = self.tdl.iso_sha256_url
-            hashname = 'sha256'
-        else:
-            return True
+            return self.tdl.iso_sha256_url, 'sha256'
 
-        originalname = os.path.basename(urlparse.urlparse(original_url)[2])
+        return None, None
 
-        csumname = os.path.join(outdir,
-                                self.tdl.distro + self.tdl.update + self.tdl.arch + "-CHECKSUM")
-        csumfd = os.open(csumname, os.O_WRONLY|os.O_CREAT|os.O_TRUNC)
+    def _get_checksum_index(self, url, hashname, info):
+        """
+        Internal method to get the parsed contents of the checksum file at
+        url, as a dictionary of filename to checksum.  info is the dictionary
+        of HTTP headers for url.  Parsed checksum files are remembered in
+        memory for the rest of the process and on disk under
+        data_dir/checksums, keyed by the URL and the HTTP validators (ETag,
+        Last-Modified, and length) of the checksum file, so verifying several
+        pieces of media against the same checksum file only fetches and
+        parses it once.
+        """
+        validators = self._download_validators(url, info)
+        key = (url, hashname)
 
-        try:
-            self.log.debug("Attempting to get the lock for %s" % (csumname))
-            fcntl.lockf(csumfd, fcntl.LOCK_EX)
-            self.log.debug("Got the lock, doing the download")
+        entry = _checksum_indexes.get(key)
+        if entry is not None and entry['validators'] == validators:
+            return entry['sums']
+
+        indexdir = os.path.join(self.data_dir, "checksums")
+        indexname = os.path.join(indexdir,
+                                 hashlib.sha256((hashname + ' ' + url).encode('utf-8')).hexdigest() + ".json")
+
+        if validators is not None:
+            entry = oz.ozutil.read_json_file(indexname)
+            if entry is not None and entry.get('validators') == validators:
+                self.log.debug("Using cached index of checksum file %s" % (url))
+                _checksum_indexes[key] = entry
+                return entry['sums']
+
+        oz.ozutil.mkdir_p(indexdir)
 
+        # several builds may be fetching the same checksum file at once, so
+        # each of them fetches it into a file of its own
+        csumfd, csumname = tempfile.mkstemp(dir=indexdir)
+        try:
             self.log.debug("Checksum requested, fetching %s file" % (hashname))
-            oz.ozutil.http_download_file(url, csumfd, False, self.log)
-        finally:
+            self.http.download_file(url, csumfd, False, self.log)
             os.close(csumfd)
+            csumfd = -1
+
+            bits, digest_type = {'md5': (128, 'MD5'),
+                                 'sha1': (160, 'SHA1'),
+                                 'sha256': (256, 'SHA256')}[hashname]
+            sums = oz.ozutil.get_sums_from_file(csumname, bits, digest_type)
+        finally:
+            if csumfd >= 0:
+                os.close(csumfd)
+            os.unlink(csumname)
+
+        entry = {'url': url, 'validators': validators, 'sums': sums}
+        _checksum_indexes[key] = entry
+        if validators is not None:
+            oz.ozutil.write_json_file(indexname, entry)
+
+        return sums
 
-        upstream_sum = getattr(oz.ozutil,
-                               'get_' + hashname + 'sum_from_file')(csumname, originalname)
+    def _get_upstream_csum(self, original_url, info=None):
+        """
+        Internal method to find the checksum of the file at original_url in
+        the checksum file named in the TDL.  info is the dictionary of HTTP
+        headers for the checksum file, if the caller already has it.
+        """
+        url, hashname = self._get_csum_url()
+
+        if info is None:
+            info = self.http.get_header(url)
 
-        os.unlink(csumname)
+        originalname = os.path.basename(urlparse.urlparse(original_url)[2])
 
+        upstream_sum = self._get_checksum_index(url, hashname, info).get(originalname)
         if not upstream_sum:
             raise oz.OzException.OzException("Could not find checksum for original file " + originalname)
 
-        self.log.debug("Calculating checksum of downloaded file")
-        os.lseek(outputfd, 0, os.SEEK_SET)
+        return upstream_sum
+
+    def _get_csums(self, original_url, output, outputfd, local_sum=None):
+        """
+        Internal method to fetch the checksum file and compare it to the
+        checksum of the downloaded data.  If local_sum is given, it is the hex
+        digest of the data as computed during the download; otherwise the
+        checksum is computed by reading the data back from outputfd.
+
+        Once the data has been verified, the digest is recorded in a sidecar
+        file next to output, along with the size, modification time, and inode
+        of output and the ETag of the checksum file.  As long as none of those
+        change, later runs use the recorded digest instead of rehashing the
+        whole file, and skip downloading the checksum file altogether.  Setting
+        self.reverify_media ignores the recorded digest.
+        """
+        url, hashname = self._get_csum_url()
+        if url is None:
+            return True
+
+        digestname = output + ".ozdigest"
+
+        st = os.fstat(outputfd)
+        key = {'size': st.st_size, 'mtime': st.st_mtime, 'inode': st.st_ino,
+               'hashname': hashname, 'csum_url': url}
+
+        record = None
+        if local_sum is None and not self.reverify_media:
+            record = oz.ozutil.read_json_file(digestname)
+            if record is not None:
+                for k in key:
+                    if record.get(k) != key[k]:
+                        self.log.debug("Cached media changed since it was last verified")
+                        record = None
+                        break
+
+        csum_info = self.http.get_header(url)
+        csum_etag = csum_info.get('etag')
+
+        if record is not None:
+            local_sum = record['digest']
+            if csum_etag is not None and record.get('csum_etag') == csum_etag:
+                self.log.debug("Checksum file unchanged, using recorded checksum")
+                return local_sum == record['upstream_sum']
+
+        upstream_sum = self._get_upstream_csum(original_url, csum_info)
+
+        if local_sum is None:
+            self.log.debug("Calculating checksum of downloaded file")
+            os.lseek(outputfd, 0, os.SEEK_SET)
+
+            csum = getattr(hashlib, hashname)()
+
+            buf = os.read(outputfd, 1024*1024)
+            while len(buf) > 0:
+                csum.update(buf)
+                buf = os.read(outputfd, 1024*1024)
+
+            local_sum = csum.hexdigest()
+
+        if local_sum != upstream_sum:
+            oz.ozutil.unlink_if_exists(digestname)
+            return False
+
+        record = dict(key)
+        record['digest'] = local_sum
+        record['upstream_sum'] = upstream_sum
+        record['csum_etag'] = csum_etag
+        oz.ozutil.write_json_file(digestname, record)
+
+        return True
+
+    def _download_validators(self, url, info):
+        """
+        Internal method to collect the pieces of HTTP header information that
+        identify a particular version of a remote file.  If the server gives
+        us neither an ETag nor a Last-Modified header, we have no way to tell
+        if the file changed, and None is returned.
+        """
+        etag = info.get('etag')
+        last_modified = info.get('last-modified')
+        if etag is None and last_modified is None:
+            return None
+
+        content_length = info.get('content-length')
+        if content_length is not None:
+            content_length = int(content_length)
+
+        return {'url': url, 'etag': etag, 'last_modified': last_modified,
+                'content_length': content_length}
+
+    def _use_byte_ranges(self, info):
+        """
+        Internal method to check whether the original media, whose headers
+        are in the dictionary info, can be fetched in byte ranges, so that
+        it can be downloaded in segments and resumed.  This is only done
+        over HTTP; libcurl reports byte range support for FTP too, but FTP
+        transfers do not report HTTP status codes.
+        """
+        scheme = info.get('effective-url', '').split(':', 1)[0].lower()
+        return scheme in ['http', 'https'] and info.get('accept-ranges') == 'bytes'
+
+    def _get_resume_ranges(self, partialname, validators):
+        """
+        Internal method to figure out which byte ranges are still missing from
+        a previously interrupted download.  Returns None if the download
+        cannot be resumed, either because there is no record of an earlier
+        download, or because the remote file has changed since then.
+        """
+        partial = oz.ozutil.read_json_file(partialname)
+        if partial is None or validators is None or 'segments' not in partial:
+            # the download stopped before its progress was first recorded
+            return None
+
+        for key in validators:
+            if partial.get(key) != validators[key]:
+                self.log.info("Remote media changed since the last partial download, starting over")
+                return None
+
+        ranges = []
+        for start, end, written in partial.get('segments', []):
+            if start + written <= end:
+                ranges.append((start + written, end))
+
+        return ranges
+
+    def _rekey_digest_record(self, output):
+        """
+        Internal method to update the digest sidecar of output after output
+        was replaced by a file with identical contents (such as a link into
+        the media store), so that the recorded digest stays valid.
+        """
+        digestname = output + ".ozdigest"
+        record = oz.ozutil.read_json_file(digestname)
+        if record is None:
+            return
+        st = os.stat(output)
+        record['size'] = st.st_size
+        record['mtime'] = st.st_mtime
+        record['inode'] = st.st_ino
+        oz.ozutil.write_json_file(digestname, record)
+
+    def _check_cached_media(self, url, output, content_length):
+        """
+        Internal method to check whether output holds complete, verified
+        media from url.  This only reads the cached media, so it is safe to
+        call with just a shared lock held.
+        """
+        if os.access(output + ".partial", os.F_OK):
+            # an earlier download was interrupted
+            return False
 
-        local_sum = getattr(hashlib, hashname)()
+        try:
+            fd = os.open(output, os.O_RDONLY)
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                return False
+            raise
 
-        buf = os.read(outputfd, 4096)
-        while buf != '':
-            local_sum.update(buf)
-            buf = os.read(outputfd, 4096)
+        try:
+            if content_length != os.fstat(fd)[stat.ST_SIZE]:
+                return False
 
-        return local_sum.hexdigest() == upstream_sum
+            if not self._get_csums(url, output, fd):
+                self.log.info("Original available, but checksum mis-match; re-downloading")
+                return False
+        finally:
+            os.close(fd)
+
+        self.log.info("Original install media available, using cached version")
+        return True
 
     def _get_original_media(self, url, output, force_download):
         """
         Method to fetch the original media from url.  If the media is already
-        cached locally, the cached copy will be used instead.
+        cached locally, the cached copy will be used instead.  If an earlier
+        download of the media was interrupted, the download is resumed from
+        where it left off, as long as the remote file has not changed.
+
+        If original media is being cached, downloaded media is also added to
+        the content-addressed media store, and output becomes a link to the
+        stored copy.  Media that is already in the store, either because it
+        was fetched from the same URL before or because it has the checksum
+        that the TDL asks for, is linked into place instead of downloaded.
+
+        Access to output is coordinated through a lock file next to it.
+        Validating cached media only takes a shared lock, so any number of
+        builds can use the same cached media at once; the exclusive lock is
+        only taken when the media actually has to be fetched or repaired.
         """
         self.log.info("Fetching the original media")
 
         outdir = os.path.dirname(output)
         oz.ozutil.mkdir_p(outdir)
 
-        fd = os.open(output, os.O_RDWR|os.O_CREAT)
+        info = self.http.get_header(url)
 
-        # from this point forward, we need to close fd on success or failure
-        try:
-            self.log.debug("Attempting to get the lock for %s" % (output))
-            fcntl.lockf(fd, fcntl.LOCK_EX)
-            self.log.debug("Got the lock, doing the download")
-
-            # if we reach here, the open and lock succeeded and we can download
+        if not 'http-code' in info or info['http-code'] >= 400 or not 'content-length' in info or int(info['content-length']) < 0:
+            raise oz.OzException.OzException("Could not reach destination to fetch boot media")
 
-            info = oz.ozutil.http_get_header(url)
+        content_length = int(info['content-length'])
 
-            if not 'HTTP-Code' in info or info['HTTP-Code'] >= 400 or not 'Content-Length' in info or info['Content-Length'] < 0:
-                raise oz.OzException.OzException("Could not reach destination to fetch boot media")
+        if content_length == 0:
+            raise oz.OzException.OzException("Install media of 0 size detected, something is wrong")
 
-            content_length = int(info['Content-Length'])
+        # the cached file may have been fetched from somewhere else (for
+        # instance, a different point release with the same name), in which
+        # case its size says nothing about whether it is the media we want
+        stored_url = self.media_store.name_url(output)
+        if stored_url is not None and stored_url != url:
+            self.log.info("Cached media was fetched from %s, not using it" % (stored_url))
+            force_download = True
 
-            if content_length == 0:
-                raise oz.OzException.OzException("Install media of 0 size detected, something is wrong")
+        lockfd = os.open(output + ".lock", os.O_RDWR|os.O_CREAT)
 
+        # from this point forward, we need to close lockfd on success or
+        # failure
+        try:
             if not force_download:
-                if content_length == os.fstat(fd)[stat.ST_SIZE]:
-                    if self._get_csums(url, outdir, fd):
-                        self.log.info("Original install media available, using cached version")
-                        return
-                    else:
-                        self.log.info("Original available, but checksum mis-match; re-downloading")
+                self.log.debug("Attempting to get the shared lock for %s" % (output))
+                fcntl.lockf(lockfd, fcntl.LOCK_SH)
+                self.log.debug("Got the shared lock, checking the cache")
+                if self._check_cached_media(url, output, content_length):
+                    self._catalog_original_media(url, output)
+                    return
+                # two builds holding the shared lock cannot both upgrade it,
+                # so drop it before asking for the exclusive lock
+                fcntl.lockf(lockfd, fcntl.LOCK_UN)
+
+            self.log.debug("Attempting to get the exclusive lock for %s" % (output))
+            fcntl.lockf(lockfd, fcntl.LOCK_EX)
+            self.log.debug("Got the exclusive lock, doing the download")
+
+            # another build may have fetched the media while we were waiting
+            # for the lock
+            if not force_download and self._check_cached_media(url, output,
+                                                               content_length):
+                self._catalog_original_media(url, output)
+                return
 
-            # before fetching everything, make sure that we have enough
-            # space on the filesystem to store the data we are about to download
-            devdata = os.statvfs(outdir)
-            if (devdata.f_bsize*devdata.f_bavail) < content_length:
-                raise oz.OzException.OzException("Not enough room on %s for install media" % (outdir))
+            self._fetch_original_media(url, output, info, force_download)
+            self._catalog_original_media(url, output)
+        finally:
+            os.close(lockfd)
+
+    def _catalog_original_media(self, url, output):
+        """
+        Internal method to record the use of the original media at output,
+        fetched from url, in the cache catalog.  Nothing is recorded if
+        original media is not being cached, since it is removed after the
+        install anyway.
+        """
+        if not self.cache_original_media:
+            return
+        provenance = {'url': url}
+        digest = self.media_store.digest(output)
+        if digest is not None:
+            provenance['blob'] = os.path.relpath(self.media_store.blob_path(digest),
+                                                 self.data_dir)
+        category = {"isos": "iso", "kernels": "kernel",
+                    "floppies": "floppy"}.get(os.path.basename(os.path.dirname(output)),
+                                              "iso")
+        self._catalog_cache_use(output, category, provenance)
+
+    def _fetch_original_media(self, url, output, info, force_download):
+        """
+        Internal method to fetch the original media from url into output,
+        either from the media store or by downloading it.  info is the
+        dictionary of HTTP headers for url.  The caller must hold the
+        exclusive lock for output.
+        """
+        outdir = os.path.dirname(output)
+        content_length = int(info['content-length'])
+        validators = self._download_validators(url, info)
+
+        # while a download is in progress, the progress of each byte range is
+        # recorded in this sidecar file.  Its presence means that the data in
+        # output is incomplete, no matter what size the file is
+        partialname = output + ".partial"
+
+        if force_download:
+            oz.ozutil.unlink_if_exists(partialname)
+        elif self.cache_original_media and not os.access(partialname, os.F_OK):
+            blob = self.media_store.lookup_url(url, validators)
+            if blob is None and self._get_csum_url()[0] is not None:
+                blob = self.media_store.lookup_sum(self._get_csum_url()[1],
+                                                   self._get_upstream_csum(url))
+            if blob is not None:
+                self.log.info("Original install media available in the media store, using it")
+                self.media_store.link(blob, output)
+
+                # the blob was verified when it went into the store, so use
+                # the checksum recorded then instead of rehashing it
+                local_sum = self.media_store.sums(blob).get(self._get_csum_url()[1])
+                fd = os.open(output, os.O_RDONLY)
+                try:
+                    if not self._get_csums(url, output, fd, local_sum):
+                        raise oz.OzException.OzException("Checksum for stored media does not match!")
+                finally:
+                    os.close(fd)
+                return
 
-            # at this point we know we are going to download something.  Make
-            # sure to truncate the file so no stale data is left on the end
-            os.ftruncate(fd, 0)
+        fd = os.open(output, os.O_RDWR|os.O_CREAT)
+
+        # from this point forward, we need to close fd on success or failure
+        try:
+            ranges = None
+            if self._use_byte_ranges(info):
+                ranges = self._get_resume_ranges(partialname, validators)
+
+            if ranges is None:
+                # before fetching everything, make sure that we have enough
+                # space on the filesystem to store the data we are about to
+                # download
+                devdata = os.statvfs(outdir)
+                if (devdata.f_bsize*devdata.f_bavail) < content_length:
+                    raise oz.OzException.OzException("Not enough room on %s for install media" % (outdir))
+
+                if os.fstat(fd)[stat.ST_NLINK] > 1:
+                    # output is a link into the media store; writing to it
+                    # would corrupt the stored copy, so put a new file in its
+                    # place
+                    tmpfd, tmpname = tempfile.mkstemp(dir=outdir)
+                    os.fchmod(tmpfd, stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH)
+                    os.rename(tmpname, output)
+                    os.close(fd)
+                    fd = tmpfd
+
+                # at this point we know we are going to download everything.
+                # Make sure to truncate the file so no stale data is left on
+                # the end
+                os.ftruncate(fd, 0)
+                oz.ozutil.unlink_if_exists(partialname)
+            else:
+                self.log.info("Resuming the download of the original install media, %d bytes left" % (sum([end - start + 1 for start, end in ranges])))
+
+            # whatever was recorded about the old contents no longer applies
+            oz.ozutil.unlink_if_exists(output + ".ozdigest")
+
+            # mark output as incomplete before any space is reserved for it,
+            # so that a download that dies early never leaves behind a
+            # full-size file that looks complete
+            if ranges is None:
+                oz.ozutil.write_json_file(partialname, dict(validators or {}))
+
+            # compute the checksum (if any) while the data comes in, so that
+            # we do not have to read the whole file back afterwards.  The
+            # media store always needs the SHA-256 digest
+            hashnames = ['sha256']
+            hashname = self._get_csum_url()[1]
+            if hashname is not None and hashname not in hashnames:
+                hashnames.append(hashname)
 
             self.log.info("Fetching the original install media from %s" % (url))
-            oz.ozutil.http_download_file(url, fd, True, self.log)
+            if self._use_byte_ranges(info):
+                # the server told us it can do byte ranges, so fetch the
+                # media over several connections at once.  Use the URL we
+                # were redirected to (if any) so that all of the segments come
+                # from the same mirror
+                def _checkpoint(segments):
+                    """
+                    Method that is called back from the segmented downloader
+                    to record the progress of the download.
+                    """
+                    partial = dict(validators or {})
+                    partial['segments'] = segments
+                    oz.ozutil.write_json_file(partialname, partial)
+
+                digests = self.http.download_file_segmented(info['effective-url'],
+                                                            fd, True, self.log,
+                                                            content_length,
+                                                            self.download_segments,
+                                                            ranges, _checkpoint,
+                                                            hashnames=hashnames)
+            else:
+                digests = self.http.download_file(url, fd, True, self.log,
+                                                  hashnames=hashnames)
 
             filesize = os.fstat(fd)[stat.ST_SIZE]
 
@@ -887,11 +1538,199 @@ class Guest(object):
                 # originally saw from the headers, something went wrong
                 raise oz.OzException.OzException("Expected to download %d bytes, downloaded %d" % (content_length, filesize))
 
-            if not self._get_csums(url, outdir, fd):
+            if not self._get_csums(url, output, fd, digests.get(hashname)):
+                # the data is complete but wrong, so there is nothing to
+                # resume; throw it away
+                os.ftruncate(fd, 0)
+                oz.ozutil.unlink_if_exists(partialname)
                 raise oz.OzException.OzException("Checksum for downloaded file does not match!")
+
+            # all of the data is here and verified; the file is no longer
+            # partial
+            oz.ozutil.unlink_if_exists(partialname)
+
+            if self.cache_original_media:
+                self.media_store.add(output, digests, url, validators)
+                self._rekey_digest_record(output)
         finally:
             os.close(fd)
 
+    def _media_digest(self, path):
+        """
+        Method to return the SHA-256 digest of the original media at path.
+        The digest is known without reading the media if it is a link into
+        the media store; otherwise it is computed once and recorded in a
+        sidecar file next to the media, which is used as long as the media
+        does not change.
+        """
+        digest = self.media_store.digest(path)
+        if digest is not None:
+            return digest
+
+        digest = oz.ozutil.read_sidecar_digest(path)
+        if digest is not None:
+            return digest
+
+        self.log.debug("Calculating SHA-256 digest of %s" % (path))
+        csum = hashlib.sha256()
+        with open(path, 'rb') as f:
+            buf = f.read(1024*1024)
+            while len(buf) > 0:
+                csum.update(buf)
+                buf = f.read(1024*1024)
+
+        record = oz.ozutil.digest_sidecar_key(path)
+        record['digest'] = csum.hexdigest()
+        oz.ozutil.write_json_file(path + ".ozsha256", record)
+        return record['digest']
+
+    def _render_auto_file(self, outname):
+        """
+        Base method to write the automated install file (kickstart, preseed,
+        and so on) for this install to outname.  Subclasses are expected to
+        override this.
+        """
+        raise oz.OzException.OzException("Internal error, subclass didn't override render_auto_file")
+
+    def _rendered_auto_file(self):
+        """
+        Method to return the contents of the automated install file for this
+        install, as _render_auto_file() writes it.
+        """
+        oz.ozutil.mkdir_p(self.icicle_tmp)
+        autofile = os.path.join(self.icicle_tmp, "rendered-auto")
+        self._render_auto_file(autofile)
+        try:
+            with open(autofile, 'rb') as f:
+                return f.read()
+        finally:
+            os.unlink(autofile)
+
+    def _jeos_inputs(self):
+        """
+        Method to return the dictionary of install inputs that a cached JEOS
+        has to match to be used for this install.
+        """
+        return {'auto_sha256': hashlib.sha256(self._rendered_auto_file()).hexdigest(),
+                'disksize': self.disksize,
+                'image_type': self.image_type,
+                'diskbus': self.disk_bus,
+                'nicmodel': self.nicmodel}
+
+    def _get_jeos_filename(self):
+        """
+        Method to return the path to the cached JEOS for this install.  The
+        name includes a digest of the install inputs from _jeos_inputs(), so
+        installs with a different kickstart, disk size, and so on each get
+        their own cached JEOS.
+        """
+        if self._jeos_filename is None:
+            self.jeos_inputs = self._jeos_inputs()
+            csum = hashlib.sha256()
+            for key in sorted(self.jeos_inputs):
+                csum.update(("%s=%s\0" % (key, self.jeos_inputs[key])).encode('utf-8'))
+
+            if self.image_type == 'raw':
+                # backwards compatible
+                extension = 'dsk'
+            else:
+                extension = self.image_type
+
+            self._jeos_filename = self.jeos_cache.path(self.tdl.distro + self.tdl.update + self.tdl.arch,
+                                                       csum.hexdigest()[:16],
+                                                       extension)
+        return self._jeos_filename
+
+    jeos_filename = property(_get_jeos_filename)
+
+    def _modified_media_key(self, originals):
+        """
+        Method to return the key that the modified media for this install is
+        cached under.  The key is a digest of the original media in the list
+        of paths originals, the rendered automated install file, the boot
+        arguments, and the Oz version, so any change to one of them (a new
+        kickstart or root password, for instance) gives a different key.
+        """
+        csum = hashlib.sha256()
+
+        def _add(value):
+            """
+            Method to add a string to the key.
+            """
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            csum.update(value)
+            csum.update(b'\0')
+
+        for path in originals:
+            _add(self._media_digest(path))
+
+        _add(self._rendered_auto_file())
+        _add(self.url or "")
+        _add(getattr(self, "cmdline", None) or "")
+        _add(oz.__version__)
+
+        return csum.hexdigest()
+
+    def _modified_media_cache_path(self, base, originals):
+        """
+        Method to return the path that the modified media made from the
+        original media in the list of paths originals is cached at.  The
+        path is base with the key from _modified_media_key() added before the
+        extension, so several variants of the modified media are kept side by
+        side.
+        """
+        root, ext = os.path.splitext(base)
+        return "%s-%s%s" % (root, self._modified_media_key(originals), ext)
+
+    def _cache_modified_media(self, media, cached):
+        """
+        Method to store the modified media at media in the cache at cached.
+        The media is written to a temporary file first, so concurrent builds
+        never see a partial copy.
+        """
+        self.log.info("Caching modified media for future use")
+        tmp = "%s.%d.tmp" % (cached, os.getpid())
+        try:
+            oz.ozutil.clone_file(media, tmp)
+            os.rename(tmp, cached)
+        except:
+            oz.ozutil.unlink_if_exists(tmp)
+            raise
+        self._catalog_cache_use(cached, "modified")
+
+    def _use_cached_modified_media(self, cached, dest):
+        """
+        Method to copy the cached modified media at cached to dest.
+        """
+        self.log.info("Using cached modified media %s" % (cached))
+        oz.ozutil.clone_file(cached, dest)
+        self._catalog_cache_use(cached, "modified")
+
+    def _catalog_cache_use(self, path, category, provenance=None):
+        """
+        Method to record in the cache catalog that the cached file at path,
+        of the given category, was just added to the cache or used from it.
+        """
+        if provenance is None:
+            provenance = {}
+        provenance.setdefault('os', self.tdl.distro + self.tdl.update + self.tdl.arch)
+        provenance.setdefault('tdl', self.tdl.name)
+        self.cache_catalog.use(path, category, provenance)
+
+    def enforce_cache_quotas(self):
+        """
+        Method to remove the least recently used files from the cache until
+        it is within the max_size and per-category quotas from the cache
+        section of the configuration.  This is meant to be called when a
+        build starts, before anything new is cached.
+        """
+        if self.cache_max_size is None and all(quota is None for quota in self.cache_quotas.values()):
+            return
+        for path in self.cache_catalog.enforce(self.cache_quotas,
+                                               self.cache_max_size):
+            self.log.info("Removed %s from the cache to stay within the cache quota" % (path))
+
     def _capture_screenshot(self, libvirt_dom):
         """
         Method to capture a screenshot of the VM.
@@ -1221,14 +2060,14 @@ class Guest(object):
         if iso and self.tdl.installtype == 'iso':
             url = self.tdl.iso
         elif url and self.tdl.installtype == 'url':
-            url = self.tdl.url
-
             # when doing URL installs, we can't allow localhost URLs (the URL
             # will be embedded into the installer, so the install is guaranteed
             # to fail with localhost URLs).  Disallow them here
-            if urlparse.urlparse(url)[1] in ["localhost", "127.0.0.1",
-                                             "localhost.localdomain"]:
-                raise oz.OzException.OzException("Can not use localhost for an URL based install")
+            for candidate in [self.tdl.url] + self.tdl.mirrors:
+                if self._is_localhost_url(candidate):
+                    raise oz.OzException.OzException("Can not use localhost for an URL based install")
+
+            url = self._select_mirror(self._get_mirror_candidates())
         else:
             if iso and url:
                 raise oz.OzException.OzException("%s installs must be done via url or iso" % (self.tdl.distro))
@@ -1241,6 +2080,143 @@ class Guest(object):
 
         return url
 
+    # the file, relative to the root of the install tree, that is fetched to
+    # measure the speed of install mirrors, and whether mirrors have to
+    # support byte ranges to be usable
+    _mirror_probe_path = ""
+    _mirror_requires_ranges = False
+
+    def _is_localhost_url(self, url):
+        """
+        Internal method to check whether url points at the local machine.
+        """
+        return urlparse.urlparse(url).hostname in ["localhost", "127.0.0.1",
+                                                   "localhost.localdomain"]
+
+    def _parse_metalink(self, data):
+        """
+        Internal method to extract the mirror URLs out of a metalink (version
+        3 or 4) or a plain mirrorlist with one URL per line.  URLs that point
+        at the probe file inside an install tree (like the repomd.xml URLs in
+        Fedora metalinks) are turned into the URL of the tree itself.  The
+        URLs are returned in the order of preference given by the metalink.
+        """
+        urls = []
+        try:
+            doc = libxml2.parseDoc(data)
+        except libxml2.parserError:
+            doc = None
+
+        if doc is not None:
+            try:
+                ranked = []
+                for node in doc.xpathEval("//*[local-name()='url']"):
+                    # metalink 3 has a preference from 0 to 100, where higher
+                    # is better; metalink 4 has a priority where lower is
+                    # better
+                    rank = 0
+                    preference = node.prop('preference')
+                    priority = node.prop('priority')
+                    if preference is not None:
+                        rank = -int(preference)
+                    elif priority is not None:
+                        rank = int(priority)
+                    ranked.append((rank, len(ranked), node.getContent().strip()))
+                ranked.sort()
+                urls = [url for rank, index, url in ranked]
+            finally:
+                doc.freeDoc()
+        else:
+            for line in data.splitlines():
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    urls.append(line)
+
+        trees = []
+        for url in urls:
+            if urlparse.urlparse(url)[0] not in ['http', 'https', 'ftp']:
+                continue
+            if self._mirror_probe_path and url.endswith('/' + self._mirror_probe_path):
+                url = url[:-len(self._mirror_probe_path)]
+            trees.append(url.rstrip('/'))
+
+        return trees
+
+    def _get_mirror_candidates(self):
+        """
+        Internal method to collect the URLs of all of the mirrors that can be
+        used for a URL install: the TDL install URL, any additional mirrors
+        listed in the TDL, and the mirrors from the TDL metalink.
+        """
+        candidates = [self.tdl.url] + self.tdl.mirrors
+
+        if self.tdl.metalink is not None:
+            self.log.debug("Fetching mirrors from %s" % (self.tdl.metalink))
+            fp = tempfile.TemporaryFile()
+            try:
+                self.http.download_file(self.tdl.metalink, fp.fileno(), False,
+                                        self.log)
+                fp.seek(0)
+                data = fp.read()
+            finally:
+                fp.close()
+            for url in self._parse_metalink(data.decode('utf-8', 'replace')):
+                if not self._is_localhost_url(url):
+                    candidates.append(url)
+
+        unique = []
+        for url in candidates:
+            if url.rstrip('/') not in [u.rstrip('/') for u in unique]:
+                unique.append(url)
+
+        return unique
+
+    def _select_mirror(self, candidates):
+        """
+        Internal method to pick the fastest usable mirror out of a list of
+        candidate install URLs.  The candidates are raced against each other
+        by fetching the probe file from all of them at once.  The choice is
+        remembered under data_dir/mirrors for mirror_cache_ttl seconds, so
+        builds in quick succession do not race the mirrors again.  If there
+        is only one candidate, or none of them can be reached, the first
+        candidate is returned.
+        """
+        if len(candidates) < 2:
+            return candidates[0]
+
+        key = json.dumps([candidates, self._mirror_probe_path,
+                          self._mirror_requires_ranges])
+        cachename = os.path.join(self.data_dir, "mirrors",
+                                 hashlib.sha256(key.encode('utf-8')).hexdigest() + ".json")
+
+        if self.mirror_cache_ttl > 0:
+            entry = oz.ozutil.read_json_file(cachename)
+            if entry is not None and 0 <= time.time() - entry['time'] < self.mirror_cache_ttl:
+                self.log.debug("Using cached mirror choice %s" % (entry['url']))
+                return entry['url']
+
+        self.log.info("Probing %d mirrors" % (len(candidates)))
+        probes = {}
+        for url in candidates:
+            probes[url.rstrip('/') + '/' + self._mirror_probe_path] = url
+        results = self.http.probe_mirrors(list(probes.keys()),
+                                          self._mirror_requires_ranges)
+
+        if not results:
+            self.log.warning("None of the mirrors could be used, falling back to %s" % (candidates[0]))
+            return candidates[0]
+
+        url = probes[results[0][0]]
+        self.log.info("Using mirror %s (%dkB/s)" % (url, results[0][1]/1024))
+
+        if self.mirror_cache_ttl > 0:
+            oz.ozutil.mkdir_p(os.path.dirname(cachename))
+            oz.ozutil.write_json_file(cachename, {'time': time.time(),
+                                                  'url': url,
+                                                  'results': results})
+
+        return url
+
     def _generate_openssh_key(self, privname):
         """
         Method to generate an OpenSSH compatible public/private keypair.
@@ -1319,6 +2295,34 @@ class CDGuest(Guest):
         self.iso_contents = os.path.join(self.data_dir, "isocontent",
                                          self.tdl.name + "-" + self.tdl.installtype)
 
+        # configuration from 'iso' section
+        self.iso_staging = oz.ozutil.config_get_key(config, 'iso', 'staging',
+                                                    'overlay')
+        if self.iso_staging not in ["overlay", "copy"]:
+            raise oz.OzException.OzException("Invalid ISO staging mode %s, must be overlay or copy" % (self.iso_staging))
+        self.iso_mount = None
+        self.iso_remaster = oz.ozutil.config_get_boolean_key(config, 'iso',
+                                                             'remaster',
+                                                             True)
+        self.iso_tree_cache = None
+        if oz.ozutil.config_get_boolean_key(config, 'iso', 'tree_cache',
+                                            True):
+            self.iso_tree_cache = oz.TreeCache.TreeCache(os.path.join(self.data_dir, "isotrees"),
+                                                         int(oz.ozutil.config_get_key(config, 'iso', 'tree_cache_max', 2)))
+        # the pristine tree (the mounted ISO, or a tree in the ISO tree
+        # cache) that the unmodified files in iso_contents come from
+        self.iso_original_tree = None
+        self.iso_side_media = oz.ozutil.config_get_boolean_key(config, 'iso',
+                                                               'side_media',
+                                                               False)
+        # when installing from side media, the device holding the answer
+        # file, and the kernel command line if the installer is booted
+        # directly
+        self.side_media = None
+        self.side_media_cmdline = None
+        self.side_media_path = os.path.join(self.output_dir,
+                                            self.tdl.name + "-" + self.tdl.installtype + "-oz-side")
+
         self.log.debug("Original ISO path: %s" % self.orig_iso)
         self.log.debug("Modified ISO cache: %s" % self.modified_iso_cache)
         self.log.debug("Output ISO path: %s" % self.output_iso)
@@ -1342,6 +2346,270 @@ class CDGuest(Guest):
                 raise
         os.makedirs(self.iso_contents)
 
+        modified = self._modified_iso_files()
+        if self.iso_staging == "overlay":
+            if modified is None:
+                self.log.debug("%s does not declare the ISO files it modifies, copying the whole ISO" % (self.tdl.distro))
+            elif self._stage_iso_overlay(modified):
+                return
+
+        if self.iso_tree_cache is not None:
+            digest = self._original_iso_digest()
+            tree = self.iso_tree_cache.get(digest, self._extract_iso)
+            self.log.debug("Cloning cached ISO contents from %s" % (tree))
+            self.iso_tree_cache.clone(digest, self.iso_contents, modified)
+            if modified is not None:
+                self.iso_original_tree = tree
+            return
+
+        self._extract_iso(self.iso_contents)
+
+    def _original_iso_digest(self):
+        """
+        Method to return the SHA-256 digest of the original ISO.
+        """
+        return self._media_digest(self.orig_iso)
+
+    def _extract_iso(self, dest):
+        """
+        Method to extract the whole original ISO into the existing, empty
+        directory dest.
+        """
+        try:
+            iso = oz.ISO.ISO9660Image(self.orig_iso)
+        except oz.OzException.OzException as err:
+            self.log.debug("Could not read ISO directly, falling back to guestfs: %s" % (err))
+            return self._copy_iso_guestfs(dest)
+
+        try:
+            if iso.udf:
+                # media with a UDF filesystem (like Windows install DVDs)
+                # usually only has a placeholder in the ISO9660 filesystem,
+                # so let guestfs mount the UDF filesystem instead
+                self.log.debug("ISO has a UDF filesystem, falling back to guestfs")
+                return self._copy_iso_guestfs(dest)
+
+            self.log.debug("Checking if there is enough space on the filesystem")
+            outputstat = os.statvfs(dest)
+            if (outputstat.f_bsize*outputstat.f_bavail) < iso.tree_size():
+                raise oz.OzException.OzException("Not enough room on %s to extract install media" % (dest))
+
+            self.log.debug("Extracting ISO contents")
+            try:
+                iso.extract(dest)
+            except oz.OzException.OzException as err:
+                self.log.debug("Could not extract ISO directly, falling back to guestfs: %s" % (err))
+                shutil.rmtree(dest)
+                os.makedirs(dest)
+                return self._copy_iso_guestfs(dest)
+        finally:
+            iso.close()
+
+    def _modified_iso_files(self):
+        """
+        Method to return the paths, relative to the root of the ISO, of the
+        files on the original ISO that _modify_iso() and _generate_new_iso()
+        change in place, including the boot image that genisoimage patches
+        with -boot-info-table.  Files that only get created do not need to be
+        listed.  Returning None (the default) means that the whole ISO has
+        to be copied.
+        """
+        return None
+
+    def _mount_iso(self, mountdir):
+        """
+        Method to mount the original ISO read-only on mountdir.  As root, a
+        loop mount is used; otherwise fuseiso or guestmount are tried.
+        Returns True if the ISO was mounted, and False if none of the
+        methods worked.
+        """
+        oz.ozutil.mkdir_p(mountdir)
+
+        udf = True
+        try:
+            iso = oz.ISO.ISO9660Image(self.orig_iso)
+            udf = iso.udf
+            iso.close()
+        except oz.OzException.OzException:
+            pass
+
+        methods = []
+        if os.geteuid() == 0:
+            methods.append((["mount", "-o", "loop,ro", self.orig_iso, mountdir],
+                            ["umount", mountdir]))
+        if not udf:
+            # fuseiso only understands the ISO9660 filesystem, so it would
+            # show just the placeholder files of UDF media
+            methods.append((["fuseiso", self.orig_iso, mountdir],
+                            ["fusermount", "-u", mountdir]))
+        methods.append((["guestmount", "-a", self.orig_iso, "--ro", "-m",
+                         "/dev/sda", mountdir],
+                        ["fusermount", "-u", mountdir]))
+
+        for mountcmd, umountcmd in methods:
+            try:
+                oz.ozutil.subprocess_check_output(mountcmd)
+            except Exception as err:
+                self.log.debug("Could not mount ISO with %s: %s" % (mountcmd[0], err))
+                continue
+            self.iso_mount = (mountdir, umountcmd)
+            return True
+
+        return False
+
+    def _umount_iso(self):
+        """
+        Method to unmount the original ISO, if it is mounted.
+        """
+        if self.iso_mount is None:
+            return
+
+        mountdir, umountcmd = self.iso_mount
+        self.iso_mount = None
+        try:
+            oz.ozutil.subprocess_check_output(umountcmd)
+            os.rmdir(mountdir)
+        except Exception as err:
+            self.log.warning("Could not unmount %s: %s" % (mountdir, err))
+
+    def _stage_iso_overlay(self, modified):
+        """
+        Method to stage the ISO contents as an overlay of the original ISO
+        instead of copying all of it.  The original ISO is mounted read-only,
+        and iso_contents is populated with real directories and symlinks to
+        the files on the mounted ISO; only the files in the list modified are
+        copied.  Writing to any other file fails instead of modifying the
+        original.  genisoimage then follows the symlinks when generating the
+        new ISO.  Returns True if the overlay was staged, and False if the
+        whole ISO has to be copied instead.
+        """
+        mountdir = os.path.join(self.icicle_tmp, "isomount")
+        if not self._mount_iso(mountdir):
+            self.log.debug("Could not mount ISO, copying the whole ISO")
+            return False
+
+        self.log.debug("Staging ISO contents as an overlay of %s" % (mountdir))
+        modified = set([os.path.normpath(path) for path in modified])
+        try:
+            for dirpath, dirnames, filenames in os.walk(mountdir):
+                relpath = os.path.relpath(dirpath, mountdir)
+                destdir = os.path.normpath(os.path.join(self.iso_contents,
+                                                        relpath))
+                if relpath != ".":
+                    os.mkdir(destdir)
+
+                for name in dirnames:
+                    if os.path.islink(os.path.join(dirpath, name)):
+                        # genisoimage -f would follow (and possibly loop
+                        # through) links to directories
+                        raise oz.OzException.OzException("ISO contains a link to directory %s" % (os.path.join(relpath, name)))
+
+                for name in filenames:
+                    src = os.path.join(dirpath, name)
+                    dest = os.path.join(destdir, name)
+                    if os.path.normpath(os.path.join(relpath, name)) in modified:
+                        shutil.copyfile(src, dest)
+                    elif os.path.islink(src):
+                        os.symlink(os.readlink(src), dest)
+                    else:
+                        os.symlink(src, dest)
+        except oz.OzException.OzException as err:
+            self.log.debug("Could not stage ISO as an overlay, copying the whole ISO: %s" % (err))
+            self._umount_iso()
+            shutil.rmtree(self.iso_contents)
+            os.makedirs(self.iso_contents)
+            return False
+        except:
+            self._umount_iso()
+            raise
+
+        self.iso_original_tree = mountdir
+        return True
+
+    def _run_genisoimage(self, args):
+        """
+        Method to generate the output ISO from the ISO contents, given the
+        genisoimage arguments in args.  If the ISO contents were staged as an
+        overlay or cloned from the ISO tree cache, the original ISO is
+        remastered in place where possible.  Otherwise genisoimage is run,
+        and told to follow the symlinks to the original ISO if the contents
+        are an overlay.
+        """
+        if self.iso_original_tree is not None and self.iso_remaster:
+            try:
+                self._remaster_iso(args)
+                return
+            except oz.OzException.OzException as err:
+                self.log.debug("Could not remaster ISO in place, falling back to genisoimage: %s" % (err))
+
+        cmd = ["genisoimage"]
+        if self.iso_mount is not None:
+            cmd.append("-f")
+        oz.ozutil.subprocess_check_output(cmd + args)
+
+    def _remaster_iso(self, args):
+        """
+        Method to generate the output ISO by remastering the original ISO in
+        place, instead of rebuilding it with genisoimage.  args are the
+        genisoimage arguments; the options that only control how genisoimage
+        names files do not matter, since the original ISO keeps its names.
+        Raises an OzException if args or the ISO can not be handled this way.
+        """
+        # genisoimage options that take a value, and the corresponding
+        # ISORemaster.write() argument (None for options that are ignored)
+        value_options = {"-o": "output", "-b": "boot_image", "-c": None,
+                         "-V": "volume_identifier",
+                         "-boot-load-size": "boot_load_size",
+                         "-boot-load-seg": "boot_load_segment",
+                         "-iso-level": None}
+        ignored = ["-r", "-R", "-J", "-T", "-l", "-D", "-N", "-v", "-pad",
+                   "-joliet-long", "-relaxed-filenames", "-cache-inodes",
+                   "-allow-leading-dots", "-graft-points"]
+
+        options = {}
+        source = None
+        index = 0
+        while index < len(args):
+            arg = args[index]
+            index += 1
+            if arg in value_options:
+                if index >= len(args):
+                    raise oz.OzException.OzException("genisoimage option %s needs a value" % (arg))
+                if value_options[arg] is not None:
+                    options[value_options[arg]] = args[index]
+                index += 1
+            elif arg == "-no-emul-boot":
+                options["no_emul_boot"] = True
+            elif arg == "-boot-info-table":
+                options["boot_info_table"] = True
+            elif arg in ignored:
+                pass
+            elif arg.startswith("-"):
+                raise oz.OzException.OzException("genisoimage option %s is not supported" % (arg))
+            else:
+                source = arg
+
+        if source != self.iso_contents or "output" not in options:
+            raise oz.OzException.OzException("genisoimage arguments do not generate the ISO contents")
+        for key in ["boot_load_size", "boot_load_segment"]:
+            if key in options:
+                options[key] = int(options[key])
+
+        self.log.debug("Remastering %s in place" % (self.orig_iso))
+        output = options.pop("output")
+        remaster = oz.ISORemaster.ISORemaster(self.orig_iso, self.iso_contents,
+                                              self.iso_original_tree)
+        try:
+            remaster.write(output, **options)
+        finally:
+            remaster.close()
+
+    def _copy_iso_guestfs(self, dest):
+        """
+        Method to copy the data out of an ISO into the directory dest by
+        mounting it in a guestfs appliance.  This is only used for media that
+        oz.ISO can not read.
+        """
         self.log.info("Setting up guestfs handle for %s" % (self.tdl.name))
         gfs = guestfs.GuestFS()
         self.log.debug("Adding ISO image %s" % (self.orig_iso))
@@ -1354,68 +2622,32 @@ class CDGuest(Guest):
 
             self.log.debug("Checking if there is enough space on the filesystem")
             isostat = gfs.statvfs("/")
-            outputstat = os.statvfs(self.iso_contents)
+            outputstat = os.statvfs(dest)
             if (outputstat.f_bsize*outputstat.f_bavail) < (isostat['blocks']*isostat['bsize']):
-                raise oz.OzException.OzException("Not enough room on %s to extract install media" % (self.iso_contents))
+                raise oz.OzException.OzException("Not enough room on %s to extract install media" % (dest))
 
             self.log.debug("Extracting ISO contents")
-            current = os.getcwd()
-            os.chdir(self.iso_contents)
+            rd, wr = os.pipe()
             try:
-                rd, wr = os.pipe()
-
+                # guestfs writes the tar stream from this thread, so read it
+                # from another one
+                extractor = _TarExtractor(os.fdopen(rd, 'rb'), dest)
+                rd = None
+                extractor.start()
                 try:
-                    # NOTE: it is very, very important that we use temporary
-                    # files for collecting stdout and stderr here.  There is a
-                    # nasty bug in python subprocess; if your process produces
-                    # more than 64k of data on an fd that is using
-                    # subprocess.PIPE, the whole thing will hang. To avoid
-                    # this, we use temporary fds to capture the data
-                    stdouttmp = tempfile.TemporaryFile()
-                    stderrtmp = tempfile.TemporaryFile()
-
-                    try:
-                        tar = subprocess.Popen(["tar", "-x", "-v"], stdin=rd,
-                                               stdout=stdouttmp,
-                                               stderr=stderrtmp)
-                        try:
-                            gfs.tar_out("/", "/dev/fd/%d" % wr)
-                        except:
-                            # we need this here if gfs.tar_out throws an
-                            # exception.  In that case, we need to manually
-                            # kill off the tar process and re-raise the
-                            # exception, otherwise we hang forever
-                            tar.kill()
-                            raise
-
-                        # FIXME: we really should check tar.poll() here to get
-                        # the return code, and print out stdout and stderr if
-                        # we fail.  This will make debugging problems easier
-                    finally:
-                        stdouttmp.close()
-                        stderrtmp.close()
+                    gfs.tar_out("/", "/dev/fd/%d" % wr)
                 finally:
-                    os.close(rd)
+                    # closing the write end tells the extractor that the
+                    # stream is complete
                     os.close(wr)
-
-                # since we extracted from an ISO, there are no write bits
-                # on any of the directories.  Fix that here
-                for dirpath, dirnames, filenames in os.walk(self.iso_contents):
-                    st = os.stat(dirpath)
-                    os.chmod(dirpath, st.st_mode|stat.S_IWUSR)
-                    for name in filenames:
-                        fullpath = os.path.join(dirpath, name)
-                        try:
-                            # if there are broken symlinks in the ISO,
-                            # then the below might fail.  This probably
-                            # isn't fatal, so just allow it and go on
-                            st = os.stat(fullpath)
-                            os.chmod(fullpath, st.st_mode|stat.S_IWUSR)
-                        except OSError as err:
-                            if err.errno != errno.ENOENT:
-                                raise
+                    wr = None
+                    extractor.join()
+                if extractor.error is not None:
+                    raise oz.OzException.OzException("Could not extract ISO contents: %s" % (extractor.error))
             finally:
-                os.chdir(current)
+                for fd in [rd, wr]:
+                    if fd is not None:
+                        os.close(fd)
         finally:
             gfs.sync()
             gfs.umount_all()
@@ -1453,109 +2685,61 @@ class CDGuest(Guest):
         if outfile is None:
             raise oz.OzException.OzException("output file is None")
 
-        cdfd = open(cdfile, "r")
+        # the boot catalog of the original ISO is remembered by its digest,
+        # which is already known by the time the ISO is modified
+        digest = None
+        if cdfile == self.orig_iso:
+            digest = self._original_iso_digest()
 
-        self._get_primary_volume_descriptor(cdfd)
+        catalog = oz.ElTorito.boot_catalog(cdfile, digest)
+        oz.ElTorito.extract_boot_image(cdfile, catalog.default, outfile)
 
-        # the 17th sector contains the boot specification and the offset of the
-        # boot sector
-        cdfd.seek(17*2048)
+    def _generate_side_media(self):
+        """
+        Method to generate side media: a small floppy or CD that holds the
+        answer file, for installers that can read it from a second device.
+        The original ISO is then used for the install as is.  Returns True
+        if side media was generated, or False if the operating system has
+        to be installed from a modified ISO instead.  Subclasses that
+        support side media are expected to override this.
+        """
+        return False
 
-        # NOTE: With "native" alignment (the default for struct), there is
-        # some padding that happens that causes the unpacking to fail.
-        # Instead we force "standard" alignment, which has no padding
-        fmt = "=B5sB23s41sI"
-        (boot, isoIdent, version, toritoSpec, unused, bootP) = struct.unpack(fmt,
-                                                                             cdfd.read(struct.calcsize(fmt)))
-        if boot != 0x0:
-            raise oz.OzException.OzException("invalid CD boot sector")
-        if isoIdent != "CD001":
-            raise oz.OzException.OzException("invalid CD isoIdentification")
-        if version != 0x1:
-            raise oz.OzException.OzException("invalid CD version")
-        if toritoSpec != "EL TORITO SPECIFICATION":
-            raise oz.OzException.OzException("invalid CD torito specification")
-
-        # OK, this looks like a bootable CD.  Seek to the boot sector, and
-        # look for the header, 0x55, and 0xaa in the first 32 bytes
-        cdfd.seek(bootP*2048)
-        fmt = "=BBH24sHBB"
-        bootdata = cdfd.read(struct.calcsize(fmt))
-        (header, platform, unused, manu, unused2, five, aa) = struct.unpack(fmt,
-                                                                            bootdata)
-        if header != 0x1:
-            raise oz.OzException.OzException("invalid CD boot sector header")
-        if platform != 0x0 and platform != 0x1 and platform != 0x2:
-            raise oz.OzException.OzException("invalid CD boot sector platform")
-        if unused != 0x0:
-            raise oz.OzException.OzException("invalid CD unused boot sector field")
-        if five != 0x55 or aa != 0xaa:
-            raise oz.OzException.OzException("invalid CD boot sector footer")
-
-        def _checksum(data):
-            """
-            Method to compute the checksum on the ISO.  Note that this is *not*
-            a 1's complement checksum; when an addition overflows, the carry
-            bit is discarded, not added to the end.
-            """
-            s = 0
-            for i in range(0, len(data), 2):
-                w = ord(data[i]) + (ord(data[i+1]) << 8)
-                s = (s + w) & 0xffff
-            return s
-
-        csum = _checksum(bootdata)
-        if csum != 0:
-            raise oz.OzException.OzException("invalid CD checksum: expected 0, saw %d" % (csum))
-
-        # OK, everything so far has checked out.  Read the default/initial
-        # boot entry
-        cdfd.seek(bootP*2048+32)
-        fmt = "=BBHBBHIB"
-        (boot, media, loadsegment, systemtype, unused, scount, imgstart, unused2) = struct.unpack(fmt, cdfd.read(struct.calcsize(fmt)))
-
-        if boot != 0x88:
-            raise oz.OzException.OzException("invalid CD initial boot indicator")
-        if unused != 0x0 or unused2 != 0x0:
-            raise oz.OzException.OzException("invalid CD initial boot unused field")
-
-        if media == 0 or media == 4:
-            count = scount
-        elif media == 1:
-            # 1.2MB floppy in sectors
-            count = 1200*1024/512
-        elif media == 2:
-            # 1.44MB floppy in sectors
-            count = 1440*1024/512
-        elif media == 3:
-            # 2.88MB floppy in sectors
-            count = 2880*1024/512
-        else:
-            raise oz.OzException.OzException("invalid CD media type")
-
-        # finally, seek to "imgstart", and read "count" sectors, which
-        # contains the boot image
-        cdfd.seek(imgstart*2048)
-
-        # The eltorito specification section 2.5 says:
-        #
-        # Sector Count. This is the number of virtual/emulated sectors the
-        # system will store at Load Segment during the initial boot
-        # procedure.
-        #
-        # and then Section 1.5 says:
-        #
-        # Virtual Disk - A series of sectors on the CD which INT 13 presents
-        # to the system as a drive with 200 byte virtual sectors. There
-        # are 4 virtual sectors found in each sector on a CD.
-        #
-        # (note that the bytes above are in hex).  So we read count*512
-        eltoritodata = cdfd.read(count*512)
-        cdfd.close()
-
-        out = open(outfile, "w")
-        out.write(eltoritodata)
-        out.close()
+    def _create_side_floppy(self, files):
+        """
+        Method to create a floppy image holding files, a dictionary mapping
+        the path of each file to its name on the floppy, and to use it as
+        the side media.
+        """
+        path = self.side_media_path + ".img"
+        oz.ozutil.unlink_if_exists(path)
+        oz.ozutil.subprocess_check_output(["mformat", "-C", "-f", "1440",
+                                           "-i", path, "::"])
+        for src in files:
+            oz.ozutil.subprocess_check_output(["mcopy", "-i", path, src,
+                                               "::" + files[src]])
+        self.side_media = self._InstallDev("floppy", path, "fda")
+
+    def _create_side_iso(self, files, volume_identifier):
+        """
+        Method to create an ISO holding files, a dictionary mapping the path
+        of each file to its name on the ISO, and to use it as the side media.
+        """
+        path = self.side_media_path + ".iso"
+        staging = os.path.join(self.icicle_tmp, "side")
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        try:
+            for src in files:
+                shutil.copyfile(src, os.path.join(staging, files[src]))
+            oz.ozutil.unlink_if_exists(path)
+            oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-J",
+                                               "-V", volume_identifier,
+                                               "-o", path, staging])
+        finally:
+            shutil.rmtree(staging)
+        self.side_media = self._InstallDev("cdrom", path, "hdd")
 
     def _do_install(self, timeout=None, force=False, reboots=0, cmdline=None):
         """
@@ -1563,12 +2747,17 @@ class CDGuest(Guest):
         """
         if not force and os.access(self.jeos_filename, os.F_OK):
             self.log.info("Found cached JEOS (%s), using it" % (self.jeos_filename))
-            oz.ozutil.copyfile_sparse(self.jeos_filename, self.diskimage)
+            self._restore_jeos()
             return self._generate_xml("hd", None)
 
         self.log.info("Running install for %s" % (self.tdl.name))
 
-        cddev = self._InstallDev("cdrom", self.output_iso, "hdc")
+        if self.side_media is not None:
+            # the answer file is on the side media, so the installer boots
+            # from the original ISO
+            cddev = self._InstallDev("cdrom", self.orig_iso, "hdc")
+        else:
+            cddev = self._InstallDev("cdrom", self.output_iso, "hdc")
 
         if timeout is None:
             timeout = 1200
@@ -1580,24 +2769,27 @@ class CDGuest(Guest):
             """
             return hasattr(self, name) and os.access(getattr(self, name), os.F_OK)
 
-        if exists("kernelfname") and exists("initrdfname") and cmdline:
+        if self.side_media is not None and self.side_media_cmdline:
+            xml = self._generate_xml(None, cddev, self.kernelfname,
+                                     self.initrdfname, self.side_media_cmdline,
+                                     self.side_media)
+        elif exists("kernelfname") and exists("initrdfname") and cmdline:
             xml = self._generate_xml(None, None, self.kernelfname,
                                      self.initrdfname, self.cmdline)
         else:
-            xml = self._generate_xml("cdrom", cddev)
+            xml = self._generate_xml("cdrom", cddev, sidedev=self.side_media)
 
         dom = self.libvirt_conn.createXML(xml, 0)
         self._wait_for_install_finish(dom, timeout)
 
         for i in range(0, reboots):
-            dom = self.libvirt_conn.createXML(self._generate_xml("hd", cddev),
+            dom = self.libvirt_conn.createXML(self._generate_xml("hd", cddev,
+                                                                 sidedev=self.side_media),
                                               0)
             self._wait_for_install_finish(dom, timeout)
 
         if self.cache_jeos:
-            self.log.info("Caching JEOS")
-            oz.ozutil.mkdir_p(self.jeos_cache_dir)
-            oz.ozutil.copyfile_sparse(self.diskimage, self.jeos_filename)
+            self._cache_jeos()
 
         return self._generate_xml("hd", None)
 
@@ -1643,26 +2835,46 @@ class CDGuest(Guest):
         """
         self.log.info("Generating install media")
 
-        if not force_download:
-            if os.access(self.jeos_filename, os.F_OK):
-                # if we found a cached JEOS, we don't need to do anything here;
-                # we'll copy the JEOS itself later on
-                return
-            elif os.access(self.modified_iso_cache, os.F_OK):
-                self.log.info("Using cached modified media")
-                shutil.copyfile(self.modified_iso_cache, self.output_iso)
-                return
+        if not force_download and os.access(self.jeos_filename, os.F_OK):
+            # if we found a cached JEOS, we don't need to do anything here;
+            # we'll copy the JEOS itself later on
+            return
 
+        # the key of the cached modified media includes the digest of the
+        # original media, so the original media has to be fetched first
         self._get_original_iso(url, force_download)
+
+        self.side_media = None
+        self.side_media_cmdline = None
+        if self.iso_side_media:
+            self._check_pvd()
+            try:
+                if self._generate_side_media():
+                    self.log.info("Using the original ISO with side media %s" % (self.side_media.path))
+                    return
+                self.log.debug("%s does not support side media, modifying the ISO" % (self.tdl.distro))
+            except (oz.OzException.OzException,
+                    oz.ozutil.SubprocessException, OSError) as err:
+                self.log.debug("Could not generate side media, modifying the ISO instead: %s" % (err))
+                self.side_media = None
+                self.side_media_cmdline = None
+
+        cached = None
+        if self.cache_modified_media:
+            cached = self._modified_media_cache_path(self.modified_iso_cache,
+                                                     [self.orig_iso])
+            if not force_download and os.access(cached, os.F_OK):
+                self._use_cached_modified_media(cached, self.output_iso)
+                return
+
         self._check_pvd()
-        self._copy_iso()
-        self._check_iso_tree(customize_or_icicle)
         try:
+            self._copy_iso()
+            self._check_iso_tree(customize_or_icicle)
             self._modify_iso()
             self._generate_new_iso()
-            if self.cache_modified_media:
-                self.log.info("Caching modified media for future use")
-                shutil.copyfile(self.output_iso, self.modified_iso_cache)
+            if cached is not None:
+                self._cache_modified_media(self.output_iso, cached)
         finally:
             self._cleanup_iso()
 
@@ -1678,28 +2890,42 @@ class CDGuest(Guest):
         return self._iso_generate_install_media(self.url, force_download,
                                                 customize_or_icicle)
 
+    def _iso_prefetch_media(self, url, force_download):
+        """
+        Method to fetch and verify the original ISO ahead of time.  Nothing
+        is fetched if the install would use a cached JEOS anyway.  The
+        original ISO is needed even if there is cached modified media, to
+        find out which of the cached variants matches it.
+        """
+        if not force_download and os.access(self.jeos_filename, os.F_OK):
+            self.log.info("Found cached JEOS, not fetching media")
+            return
+
+        self._get_original_iso(url, force_download)
+
+    def prefetch_media(self, force_download=False):
+        """
+        Method to fetch and verify the original install media for the
+        operating system ahead of time.  If force_download is False (the
+        default), then the original media will only be fetched if it is not
+        cached locally.  If force_download is True, then the original media
+        will be downloaded regardless of whether it is cached locally.
+        """
+        return self._iso_prefetch_media(self.url, force_download)
+
     def _cleanup_iso(self):
         """
         Method to cleanup the local ISO contents.
         """
         self.log.info("Cleaning up old ISO data")
-        # if we are running as non-root, then there might be some files left
-        # around that are not writable, which means that the rmtree below would
-        # fail.  Recurse into the iso_contents tree, doing a chmod +w on
-        # every file and directory to make sure the rmtree succeeds
-        for dirpath, dirnames, filenames in os.walk(self.iso_contents):
-            os.chmod(dirpath, stat.S_IWUSR|stat.S_IXUSR|stat.S_IRUSR)
-            for name in filenames:
-                try:
-                    # if there are broken symlinks in the ISO,
-                    # then the below might fail.  This probably
-                    # isn't fatal, so just allow it and go on
-                    os.chmod(os.path.join(dirpath, name), stat.S_IRUSR|stat.S_IWUSR)
-                except OSError as err:
-                    if err.errno != errno.ENOENT:
-                        raise
+        self._umount_iso()
+        self.iso_original_tree = None
 
-        oz.ozutil.rmtree_and_sync(self.iso_contents)
+        # every directory in iso_contents was made writable when it was
+        # extracted, so the tree can be removed as it is.  Removing a whole
+        # ISO tree takes a while, so do it in the background instead of
+        # holding up the install
+        oz.ozutil.rmtree_deferred(self.iso_contents, self.trash_dir)
 
     def cleanup_install(self):
         """
@@ -1707,10 +2933,12 @@ class CDGuest(Guest):
         """
         self.log.info("Cleaning up after install")
 
-        try:
-            os.unlink(self.output_iso)
-        except:
-            pass
+        for fname in [self.output_iso, self.side_media_path + ".img",
+                      self.side_media_path + ".iso"]:
+            try:
+                os.unlink(fname)
+            except:
+                pass
 
         if not self.cache_original_media:
             try:
@@ -1759,7 +2987,7 @@ class FDGuest(Guest):
         """
         if not force and os.access(self.jeos_filename, os.F_OK):
             self.log.info("Found cached JEOS, using it")
-            oz.ozutil.copyfile_sparse(self.jeos_filename, self.diskimage)
+            self._restore_jeos()
             return self._generate_xml("hd", None)
 
         self.log.info("Running install for %s" % (self.tdl.name))
@@ -1774,9 +3002,7 @@ class FDGuest(Guest):
         self._wait_for_install_finish(dom, timeout)
 
         if self.cache_jeos:
-            self.log.info("Caching JEOS")
-            oz.ozutil.mkdir_p(self.jeos_cache_dir)
-            oz.ozutil.copyfile_sparse(self.diskimage, self.jeos_filename)
+            self._cache_jeos()
 
         return self._generate_xml("hd", None)
 
@@ -1785,7 +3011,7 @@ class FDGuest(Guest):
         Method to cleanup the temporary floppy data.
         """
         self.log.info("Cleaning up floppy data")
-        oz.ozutil.rmtree_and_sync(self.floppy_contents)
+        oz.ozutil.rmtree_deferred(self.floppy_contents, self.trash_dir)
 
     def cleanup_install(self):
         """
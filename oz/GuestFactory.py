@@ -20,6 +20,7 @@ Factory functions.
 """
 
 import oz.OzException
+import oz.MediaIndex
 
 os_dict = { 'Fedora': 'Fedora',
             'FedoraCore': 'FedoraCore',
@@ -67,7 +68,8 @@ def guest_factory(tdl, config, auto, output_disk=None, netdev=None,
     The arguments are:
 
     tdl    - The TDL object to be used.  The object will be determined based
-             on the distro and version from the TDL.
+             on the distro and version from the TDL, which are detected
+             from the ISO if the TDL leaves them out.
     config - A ConfigParser object that contains configuration.  If None is
              passed for the config, Oz defaults will be used.
     auto   - An unattended installation file to be used for the
@@ -75,6 +77,9 @@ def guest_factory(tdl, config, auto, output_disk=None, netdev=None,
              a known-working unattended installation file.
     """
 
+    if tdl.distro is None or tdl.update is None or tdl.arch is None:
+        oz.MediaIndex.detect_tdl_os(tdl, config)
+
     klass = None
     for name, importname in os_dict.items():
         if tdl.distro == name:
@@ -0,0 +1,566 @@
+# Copyright (C) 2013  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Reader for ISO9660 images, with support for the Joliet and Rock Ridge
+extensions
+"""
+
+import os
+import stat
+import struct
+import calendar
+
+import oz.ozutil
+import oz.OzException
+
+SECTOR_SIZE = 2048
+
+# volume descriptor types, from ECMA-119 section 8.1.1
+VD_BOOT_RECORD = 0
+VD_PRIMARY = 1
+VD_SUPPLEMENTARY = 2
+VD_TERMINATOR = 255
+
+# directory record flags, from ECMA-119 section 9.1.6
+FLAG_DIRECTORY = 0x02
+FLAG_MULTI_EXTENT = 0x80
+
+def _fsname(name):
+    """
+    Function to turn a name read from the image into a string that can be
+    used as a filename.  Names that are not valid UTF-8 are passed through
+    byte for byte.
+    """
+    if isinstance(name, str):
+        # python 2, where bytes and str are the same thing
+        return name
+    return name.decode('utf-8', 'surrogateescape')
+
+def _parse_date(data, offset):
+    """
+    Function to parse the 7 byte recording date of a directory record (or a
+    Rock Ridge TF entry) into seconds since the epoch.  Returns None if the
+    date is not set.
+    """
+    (year, month, day, hour, minute, second,
+     gmtoff) = struct.unpack_from("=BBBBBBb", bytes(data), offset)
+    if month == 0 or day == 0:
+        return None
+    try:
+        secs = calendar.timegm((1900 + year, month, day, hour, minute, second,
+                                0, 0, 0))
+    except (ValueError, OverflowError):
+        return None
+    # gmtoff is the offset from GMT in 15 minute intervals
+    return secs - gmtoff * 15 * 60
+
+def _parse_long_date(data, offset):
+    """
+    Function to parse the 17 byte date format of a volume descriptor (or a
+    Rock Ridge TF entry with the LONG_FORM flag) into seconds since the
+    epoch.  Returns None if the date is not set.
+    """
+    digits = bytes(data[offset:offset + 14])
+    gmtoff = struct.unpack_from("=b", bytes(data), offset + 16)[0]
+    try:
+        secs = calendar.timegm((int(digits[0:4]), int(digits[4:6]),
+                                int(digits[6:8]), int(digits[8:10]),
+                                int(digits[10:12]), int(digits[12:14]),
+                                0, 0, 0))
+    except (ValueError, OverflowError):
+        return None
+    return secs - gmtoff * 15 * 60
+
+class DirectoryRecord(object):
+    """
+    Class to hold the information about one file, directory or symlink in
+    an ISO image.  A file can be stored in several extents; extents is the
+    list of (block, length) tuples making up the file, in order.
+    """
+    def __init__(self, name, extents, flags, mtime):
+        self.name = name
+        self.extents = extents
+        self.flags = flags
+        self.mtime = mtime
+        # Rock Ridge information, if the image has it
+        self.mode = None
+        self.symlink = None
+        self.child_link = None
+        self.relocated = False
+
+    def is_dir(self):
+        """
+        Method to check whether this record is a directory.
+        """
+        if self.symlink is not None:
+            return False
+        return bool(self.flags & FLAG_DIRECTORY) or self.child_link is not None
+
+    def is_symlink(self):
+        """
+        Method to check whether this record is a symbolic link.
+        """
+        return self.symlink is not None
+
+    def size(self):
+        """
+        Method to return the size of the file in bytes.
+        """
+        return sum([length for block, length in self.extents])
+
+class _SymlinkState(object):
+    """
+    Class to collect the components of a Rock Ridge symbolic link, which may
+    be spread over several SL entries.
+    """
+    def __init__(self):
+        self.parts = None
+        self.continued = False
+
+    def add(self, body):
+        """
+        Method to add the components of one SL entry.
+        """
+        if self.parts is None:
+            self.parts = []
+        pos = 1
+        while pos + 2 <= len(body):
+            cflags = body[pos]
+            clen = body[pos + 1]
+            content = bytes(body[pos + 2:pos + 2 + clen])
+            pos += 2 + clen
+            if cflags & 0x02:
+                text = b"."
+            elif cflags & 0x04:
+                text = b".."
+            elif cflags & 0x08:
+                text = b""
+            else:
+                text = content
+            if self.continued and self.parts:
+                self.parts[-1] += text
+            else:
+                self.parts.append(text)
+            self.continued = bool(cflags & 0x01)
+
+    def target(self):
+        """
+        Method to return the target of the link, or None if there were no SL
+        entries.
+        """
+        if self.parts is None:
+            return None
+        if self.parts == [b""]:
+            return "/"
+        return _fsname(b"/".join(self.parts))
+
+class ISO9660Image(object):
+    """
+    Class to read the directory tree and file contents of an ISO9660 image
+    without mounting it.  If the image has Rock Ridge extensions, the long
+    names, permissions and symbolic links they describe are used; otherwise,
+    if the image has Joliet extensions, the Joliet names are used; otherwise
+    the plain ISO9660 names are used, lowercased and without the version
+    suffix, the same way the Linux kernel presents them.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            self.block_size = SECTOR_SIZE
+            self.space_size = 0
+            self.volume_identifier = None
+            self.system_identifier = None
+            self.boot_catalog = None
+            self.joliet = False
+            self.rock_ridge = False
+            self.susp_skip = 0
+            self.udf = False
+
+            self._read_volume_descriptors()
+            self._detect_rock_ridge()
+        except:
+            os.close(self.fd)
+            raise
+
+    def close(self):
+        """
+        Method to close the image.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read(self, offset, length):
+        """
+        Method to read length bytes from the image at offset.  Raises an
+        OzException if the image is too short.
+        """
+        data = b""
+        while len(data) < length:
+            buf = oz.ozutil.pread(self.fd, length - len(data),
+                                  offset + len(data))
+            if not buf:
+                raise oz.OzException.OzException("ISO %s is truncated" % (self.path))
+            data += buf
+        return data
+
+    def _read_volume_descriptors(self):
+        """
+        Internal method to read the volume descriptor set, starting at sector
+        16, and any UDF volume recognition sequence following it.
+        """
+        root = None
+        joliet_root = None
+        sector = 16
+        while True:
+            data = bytearray(self.read(sector * SECTOR_SIZE, SECTOR_SIZE))
+            desc_type = data[0]
+            identifier = bytes(data[1:6])
+            sector += 1
+
+            if identifier in [b"BEA01", b"NSR02", b"NSR03", b"TEA01"]:
+                if identifier in [b"NSR02", b"NSR03"]:
+                    self.udf = True
+                continue
+            if identifier != b"CD001":
+                break
+
+            if desc_type == VD_PRIMARY:
+                self.system_identifier = bytes(data[8:40]).decode('ascii', 'replace').strip()
+                self.volume_identifier = bytes(data[40:72]).decode('ascii', 'replace').strip()
+                self.space_size = struct.unpack_from("<I", bytes(data), 80)[0]
+                self.block_size = struct.unpack_from("<H", bytes(data), 128)[0]
+                root = data[156:190]
+            elif desc_type == VD_SUPPLEMENTARY:
+                escapes = bytes(data[88:120])
+                if b"%/@" in escapes or b"%/C" in escapes or b"%/E" in escapes:
+                    joliet_root = data[156:190]
+            elif desc_type == VD_BOOT_RECORD:
+                if bytes(data[7:30]) == b"EL TORITO SPECIFICATION":
+                    self.boot_catalog = struct.unpack_from("<I", bytes(data), 71)[0]
+            elif desc_type == VD_TERMINATOR:
+                # a UDF volume recognition sequence may follow
+                continue
+
+        if root is None:
+            raise oz.OzException.OzException("ISO %s has no primary volume descriptor" % (self.path))
+        if self.block_size not in [512, 1024, 2048]:
+            raise oz.OzException.OzException("ISO %s has invalid logical block size %d" % (self.path, self.block_size))
+
+        self.root = self._parse_record(root, False)
+        if joliet_root is not None:
+            self.joliet = True
+            self.joliet_root = self._parse_record(joliet_root, True)
+
+    def _detect_rock_ridge(self):
+        """
+        Internal method to check for the SUSP "SP" entry in the "." record
+        of the root directory, which says that Rock Ridge (or another SUSP
+        extension) is in use, and how many bytes to skip at the start of the
+        system use area of every record.
+        """
+        block, length = self.root.extents[0]
+        data = bytearray(self.read(block * self.block_size,
+                                   min(length, self.block_size)))
+        reclen = data[0]
+        namelen = data[32]
+        sysuse = 33 + namelen + (1 - namelen % 2)
+        entry = data[sysuse:reclen]
+        if len(entry) >= 7 and bytes(entry[0:2]) == b"SP" and entry[4] == 0xbe and entry[5] == 0xef:
+            self.rock_ridge = True
+            self.susp_skip = entry[6]
+
+    def _parse_record(self, data, joliet):
+        """
+        Internal method to parse one directory record.  Returns a
+        DirectoryRecord, with the name left as the raw bytes for the "." and
+        ".." records.
+        """
+        reclen = data[0]
+        if reclen < 34:
+            raise oz.OzException.OzException("ISO %s has a short directory record" % (self.path))
+        (extent, datalen) = struct.unpack_from("<I4xI", bytes(data), 2)
+        mtime = _parse_date(data, 18)
+        flags = data[25]
+        namelen = data[32]
+        rawname = bytes(data[33:33 + namelen])
+
+        record = DirectoryRecord(rawname, [(extent, datalen)], flags, mtime)
+        if rawname in [b"\x00", b"\x01"]:
+            return record
+
+        if joliet:
+            name = rawname.decode('utf-16-be', 'replace')
+        else:
+            name = _fsname(rawname)
+        # strip the ";1" version suffix, and the trailing "." of files
+        # without an extension
+        if not flags & FLAG_DIRECTORY:
+            if ";" in name:
+                name = name[:name.rindex(";")]
+            if name.endswith("."):
+                name = name[:-1]
+        if not joliet and not self.rock_ridge:
+            name = name.lower()
+        record.name = name
+
+        if self.rock_ridge and not joliet:
+            sysuse = 33 + namelen + (1 - namelen % 2) + self.susp_skip
+            self._parse_rock_ridge(data[sysuse:reclen], record)
+
+        return record
+
+    def _parse_rock_ridge(self, data, record):
+        """
+        Internal method to parse the SUSP entries in the system use area of a
+        directory record, following continuation areas.
+        """
+        names = []
+        symlink = _SymlinkState()
+        while data is not None:
+            continuation = None
+            pos = 0
+            while pos + 4 <= len(data):
+                sig = bytes(data[pos:pos + 2])
+                length = data[pos + 2]
+                if length < 4:
+                    break
+                body = data[pos + 4:pos + length]
+                pos += length
+
+                if sig == b"CE":
+                    (block, offset, celen) = struct.unpack_from("<I4xI4xI", bytes(body), 0)
+                    continuation = (block * self.block_size + offset, celen)
+                elif sig == b"NM":
+                    if not body[0] & 0x06:
+                        names.append(bytes(body[1:]))
+                elif sig == b"PX":
+                    record.mode = struct.unpack_from("<I", bytes(body), 0)[0]
+                elif sig == b"SL":
+                    symlink.add(body)
+                elif sig == b"TF":
+                    self._parse_timestamps(body, record)
+                elif sig == b"CL":
+                    record.child_link = struct.unpack_from("<I", bytes(body), 0)[0]
+                elif sig == b"RE":
+                    record.relocated = True
+                elif sig == b"ST":
+                    break
+
+            data = None
+            if continuation is not None:
+                data = bytearray(self.read(continuation[0], continuation[1]))
+
+        if names:
+            record.name = _fsname(b"".join(names))
+        record.symlink = symlink.target()
+
+    def _parse_timestamps(self, body, record):
+        """
+        Internal method to take the modification time out of a Rock Ridge TF
+        entry.
+        """
+        tflags = body[0]
+        if not tflags & 0x02:
+            return
+        size = 7
+        parse = _parse_date
+        if tflags & 0x80:
+            size = 17
+            parse = _parse_long_date
+        # skip the creation time, if present
+        offset = 1
+        if tflags & 0x01:
+            offset += size
+        if offset + size <= len(body):
+            mtime = parse(body, offset)
+            if mtime is not None:
+                record.mtime = mtime
+
+    def _dir_length(self, block):
+        """
+        Internal method to find the length of the directory at block, from
+        its "." record.  This is needed for Rock Ridge relocated directories,
+        where the CL entry only gives the location.
+        """
+        data = bytearray(self.read(block * self.block_size, 34))
+        return struct.unpack_from("<I", bytes(data), 10)[0]
+
+    def directory_records(self, directory, joliet):
+        """
+        Method to return every record stored in directory, including the "."
+        and ".." records, as a list of (DirectoryRecord, raw record) tuples
+        in the order they appear on the image.  joliet says whether directory
+        belongs to the Joliet hierarchy.  Multi-extent files have one record
+        per extent.
+        """
+        if directory.child_link is not None:
+            extents = [(directory.child_link, self._dir_length(directory.child_link))]
+        else:
+            extents = directory.extents
+
+        records = []
+        for block, length in extents:
+            data = bytearray(self.read(block * self.block_size, length))
+            pos = 0
+            while pos < len(data):
+                reclen = data[pos]
+                if reclen == 0:
+                    # records never cross a sector boundary; the rest of
+                    # this sector is padding
+                    pos = (pos // self.block_size + 1) * self.block_size
+                    continue
+                raw = data[pos:pos + reclen]
+                records.append((self._parse_record(raw, joliet), bytes(raw)))
+                pos += reclen
+
+        return records
+
+    def listdir(self, directory=None):
+        """
+        Method to return the DirectoryRecords of the entries in directory (the
+        root directory if None), not including "." and "..".  Directories
+        that Rock Ridge relocated are listed where they belong, and not in
+        the directory they were moved to.
+        """
+        joliet = self.joliet and not self.rock_ridge
+        if directory is None:
+            directory = self.root
+            if joliet:
+                directory = self.joliet_root
+
+        records = []
+        pending = None
+        for record, raw in self.directory_records(directory, joliet):
+            if record.name in [b"\x00", b"\x01"] or record.relocated:
+                continue
+
+            if pending is not None and pending.name == record.name:
+                # the next extent of a multi-extent file
+                pending.extents.extend(record.extents)
+                pending.flags = record.flags
+            else:
+                records.append(record)
+                pending = record
+            if not pending.flags & FLAG_MULTI_EXTENT:
+                pending = None
+
+        return records
+
+    def lookup(self, path):
+        """
+        Method to find the DirectoryRecord for path, relative to the root of
+        the image.  Returns None if there is no such file or directory.
+        """
+        record = None
+        for part in [p for p in path.split("/") if p]:
+            if record is not None and not record.is_dir():
+                return None
+            for child in self.listdir(record):
+                if child.name == part:
+                    record = child
+                    break
+            else:
+                return None
+        return record
+
+    def read_file(self, record):
+        """
+        Method to return the contents of the file described by record.
+        """
+        data = b""
+        for block, length in record.extents:
+            data += self.read(block * self.block_size, length)
+        return data
+
+    def extract_file(self, record, dest, mode=None):
+        """
+        Method to write the contents of the file described by record to the
+        new file dest.  The data is copied with sendfile() where the
+        platform supports it, so it never passes through Python.
+        """
+        if mode is None:
+            mode = self._mode(record)
+        fd = os.open(dest, os.O_WRONLY|os.O_CREAT|os.O_EXCL, mode)
+        try:
+            for block, length in record.extents:
+                oz.ozutil.copy_range(self.fd, fd, block * self.block_size,
+                                     length)
+        finally:
+            os.close(fd)
+        os.chmod(dest, mode)
+        if record.mtime is not None:
+            os.utime(dest, (record.mtime, record.mtime))
+
+    def _mode(self, record):
+        """
+        Internal method to return the permissions that an extracted copy of
+        record gets.  The owner can always write to extracted files and
+        directories, so that they can be modified.
+        """
+        if record.mode is not None:
+            return stat.S_IMODE(record.mode) | stat.S_IWUSR
+        if record.is_dir():
+            return 0o755
+        return 0o644
+
+    def _check_name(self, name):
+        """
+        Internal method to make sure that name, read from the image, is safe
+        to use as a filename in the directory a record is extracted to.  A
+        crafted image could otherwise use names like ".." or "a/../.." to
+        write files outside of it.
+        """
+        if name in ["", ".", ".."] or "/" in name or "\0" in name:
+            raise oz.OzException.OzException("ISO %s contains the invalid filename %r" % (self.path, name))
+
+    def extract(self, dest, directory=None):
+        """
+        Method to extract the whole tree under directory (the root directory
+        if None) into the existing directory dest.  Raises an OzException if
+        a name in the image would place a file outside of dest.
+        """
+        self._extract_tree(dest, directory, os.path.realpath(dest))
+
+    def _extract_tree(self, dest, directory, root):
+        """
+        Internal method to extract the tree under directory into dest, which
+        is root or a directory under it.
+        """
+        for record in self.listdir(directory):
+            self._check_name(record.name)
+            path = os.path.join(dest, record.name)
+            if not os.path.realpath(path).startswith(root + os.sep):
+                raise oz.OzException.OzException("ISO %s contains %s, which is outside of %s" % (self.path, path, root))
+            if record.is_symlink():
+                os.symlink(record.symlink, path)
+            elif record.is_dir():
+                os.mkdir(path, 0o700)
+                self._extract_tree(path, record, root)
+                os.chmod(path, self._mode(record))
+                if record.mtime is not None:
+                    os.utime(path, (record.mtime, record.mtime))
+            else:
+                self.extract_file(record, path)
+
+    def tree_size(self):
+        """
+        Method to return the number of bytes the image occupies, which is an
+        upper bound for the space its extracted tree needs.
+        """
+        return self.space_size * self.block_size
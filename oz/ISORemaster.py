@@ -0,0 +1,743 @@
+# Copyright (C) 2013  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Writer to remaster ISO9660 images in place
+"""
+
+import os
+import re
+import time
+import struct
+
+import oz.ISO
+import oz.ozutil
+import oz.OzException
+
+SECTOR_SIZE = oz.ISO.SECTOR_SIZE
+
+# El Torito media types of the emulated floppies, by image size, from the
+# El Torito specification section 2.2
+EMULATION_TYPES = {1228800: 1, 1474560: 2, 2949120: 3}
+
+def _both16(value):
+    """
+    Function to encode value in the ISO9660 16-bit both-byte-order format.
+    """
+    return struct.pack("<H", value) + struct.pack(">H", value)
+
+def _both32(value):
+    """
+    Function to encode value in the ISO9660 32-bit both-byte-order format.
+    """
+    return struct.pack("<I", value) + struct.pack(">I", value)
+
+def _sectors(length):
+    """
+    Function to return the number of sectors needed to hold length bytes.
+    """
+    return (length + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+def _identifier(raw):
+    """
+    Function to return the file identifier of the raw directory record raw.
+    """
+    return bytes(raw[33:33 + bytearray(raw)[32]])
+
+def _make_record(identifier, flags, sysuse=b"", mtime=None):
+    """
+    Function to build a new directory record.  The extent and length are
+    left at 0, to be filled in once the record is laid out.
+    """
+    if mtime is None:
+        mtime = time.time()
+    date = time.gmtime(mtime)
+    pad = b""
+    if len(identifier) % 2 == 0:
+        pad = b"\0"
+    reclen = 33 + len(identifier) + len(pad) + len(sysuse)
+    if reclen % 2:
+        sysuse += b"\0"
+        reclen += 1
+    if reclen > 255:
+        raise oz.OzException.OzException("Directory record for %s is too long" % (identifier))
+    return bytearray(struct.pack("=BB", reclen, 0) + _both32(0) + _both32(0) +
+                     struct.pack("=BBBBBBb", date.tm_year - 1900, date.tm_mon,
+                                 date.tm_mday, date.tm_hour, date.tm_min,
+                                 date.tm_sec, 0) +
+                     struct.pack("=BBB", flags, 0, 0) + _both16(1) +
+                     struct.pack("=B", len(identifier)) + identifier + pad +
+                     sysuse)
+
+def _set_extent(raw, block, length):
+    """
+    Function to point the raw directory record raw at length bytes starting
+    at block.
+    """
+    raw[2:10] = _both32(block)
+    raw[10:18] = _both32(length)
+
+def _pack_records(records):
+    """
+    Function to pack directory records into sectors.  Records never cross a
+    sector boundary, so a record that does not fit into the rest of a sector
+    starts the next one.
+    """
+    data = bytearray()
+    for raw in records:
+        used = len(data) % SECTOR_SIZE
+        if used + len(raw) > SECTOR_SIZE:
+            data += b"\0" * (SECTOR_SIZE - used)
+        data += raw
+    data += b"\0" * (_sectors(len(data)) * SECTOR_SIZE - len(data))
+    return data
+
+def _encode_name(name):
+    """
+    Function to turn a filename into bytes for a Rock Ridge NM entry.
+    """
+    if isinstance(name, bytes):
+        # python 2, where bytes and str are the same thing
+        return name
+    return name.encode('utf-8', 'surrogateescape')
+
+def _decode_name(name):
+    """
+    Function to turn a filename into text for a Joliet identifier.
+    """
+    if isinstance(name, bytes):
+        return name.decode('utf-8', 'replace')
+    return name.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
+
+class _Directory(object):
+    """
+    Class to hold one directory of a hierarchy of the remastered image while
+    it is laid out.
+    """
+    def __init__(self, identifier, dot, dotdot, parent):
+        self.identifier = identifier
+        self.dot = dot
+        self.dotdot = dotdot
+        self.parent = parent
+        self.entries = []
+        self.block = None
+        self.size = None
+        self.number = None
+
+    def records(self):
+        """
+        Method to return all of the raw records of the directory, in order.
+        """
+        records = [self.dot, self.dotdot]
+        for entry in self.entries:
+            records.extend(entry.records)
+        return records
+
+    def add(self, entry):
+        """
+        Method to add a new entry, keeping the entries sorted by identifier.
+        """
+        for index, existing in enumerate(self.entries):
+            if existing.identifier() > entry.identifier():
+                self.entries.insert(index, entry)
+                return
+        self.entries.append(entry)
+
+class _Entry(object):
+    """
+    Class to hold the raw records of one file, directory or symlink in a
+    directory of the remastered image.  A multi-extent file has several
+    records.  For a subdirectory, directory is its _Directory; for a file
+    whose data moved, data is the (block, length) it moved to.
+    """
+    def __init__(self, records, directory=None, data=None):
+        self.records = records
+        self.directory = directory
+        self.data = data
+
+    def identifier(self):
+        """
+        Method to return the file identifier of the entry.
+        """
+        return _identifier(self.records[0])
+
+class ISORemaster(object):
+    """
+    Class to remaster an ISO9660 image without rebuilding it.  The new image
+    starts out as a copy (a reflink where the filesystem supports it) of the
+    original, so all of the original file data stays where it was.  Files
+    that were changed or added are appended to the end of the image, along
+    with new directory hierarchies and path tables pointing at both the old
+    and new file data; finally the volume descriptors and the El Torito boot
+    catalog are updated to use them.  The work done is proportional to the
+    size of the changes, not the size of the image.
+
+    The changes are taken from contents, a tree staged from original_root,
+    which holds the original image (mounted, or extracted): files in
+    contents that are symlinks or hard links to the same file under
+    original_root are unchanged, and other files are new or changed.  Anything the writer can not represent (like
+    removed files, or relocated directories) raises an OzException before
+    the new image is written, so the caller can fall back to genisoimage.
+    """
+    def __init__(self, path, contents, original_root):
+        self.path = path
+        self.contents = contents
+        self.original_root = os.path.normpath(original_root)
+        self.iso = oz.ISO.ISO9660Image(path)
+        self.out = None
+        self.next_block = None
+        self.catalog_block = None
+        # the names of the subdirectories in each directory, in the
+        # hierarchy that the names in contents come from
+        self.dirs = {}
+        # changed files, by the block their original data starts at
+        self.changed = {}
+        # new files and directories, by the directory they were added to
+        self.added = {}
+        # the (block, length) of the data of every new file, by path
+        self.new_files = {}
+        # the number of file records using each block
+        self.file_blocks = {}
+        # the (block, length) that data moved to, by the original block; a
+        # length of None keeps the length of the original record
+        self.moved = {}
+        # the root directory and path tables of each hierarchy
+        self.hierarchies = {}
+        # the directories in self.added that were found while building the
+        # current hierarchy
+        self.consumed = set()
+
+    def close(self):
+        """
+        Method to close the original image.
+        """
+        self.iso.close()
+
+    def _scan(self, directory, rel):
+        """
+        Internal method to compare the directory rel in contents with the
+        original directory, recording the changed and new files.
+        """
+        path = os.path.join(self.contents, rel)
+        staged = set(os.listdir(path))
+        self.dirs[rel] = []
+        for record in self.iso.listdir(directory):
+            if record.child_link is not None:
+                raise oz.OzException.OzException("ISO %s has relocated directories" % (self.path))
+            child = os.path.join(rel, record.name)
+            if record.name not in staged:
+                raise oz.OzException.OzException("%s was removed from %s" % (child, self.contents))
+            staged.remove(record.name)
+
+            staged_path = os.path.join(self.contents, child)
+            if record.is_symlink():
+                if not os.path.islink(staged_path) or os.readlink(staged_path) != record.symlink:
+                    raise oz.OzException.OzException("Symlink %s was changed" % (child))
+            elif record.is_dir():
+                if os.path.islink(staged_path) or not os.path.isdir(staged_path):
+                    raise oz.OzException.OzException("Directory %s was replaced" % (child))
+                self.dirs[rel].append(record.name)
+                self._scan(record, child)
+            else:
+                block = record.extents[0][0]
+                self.file_blocks[block] = self.file_blocks.get(block, 0) + 1
+                if os.path.islink(staged_path):
+                    target = os.path.normpath(os.readlink(staged_path))
+                    if target != os.path.join(self.original_root, child):
+                        raise oz.OzException.OzException("File %s was replaced by a symlink" % (child))
+                elif os.path.isfile(staged_path):
+                    original = os.path.join(self.original_root, child)
+                    if os.path.exists(original) and os.path.samefile(staged_path, original):
+                        # a hard link to the original tree
+                        continue
+                    if not self._same_contents(staged_path, record):
+                        self.changed[block] = staged_path
+                else:
+                    raise oz.OzException.OzException("File %s was replaced" % (child))
+
+        for name in sorted(staged):
+            self.added.setdefault(rel, []).append(name)
+            self._scan_new(rel, name)
+
+    def _scan_new(self, rel, name):
+        """
+        Internal method to record the new file or directory name in the
+        directory rel of contents.
+        """
+        child = os.path.join(rel, name)
+        staged_path = os.path.join(self.contents, child)
+        if os.path.islink(staged_path):
+            raise oz.OzException.OzException("New symlink %s is not supported" % (child))
+        elif os.path.isdir(staged_path):
+            self.dirs[rel].append(name)
+            self.dirs[child] = []
+            for subname in sorted(os.listdir(staged_path)):
+                self._scan_new(child, subname)
+        elif os.path.isfile(staged_path):
+            self.new_files[staged_path] = None
+        else:
+            raise oz.OzException.OzException("New file %s is not a regular file" % (child))
+
+    def _same_contents(self, staged_path, record):
+        """
+        Internal method to check whether the real file staged_path still has
+        the same contents as the file described by record.  Oz copies the
+        files it might modify, so unmodified copies are common.
+        """
+        if os.path.getsize(staged_path) != record.size():
+            return False
+        staged = open(staged_path, 'rb')
+        try:
+            for block, length in record.extents:
+                offset = block * SECTOR_SIZE
+                while length > 0:
+                    chunk = min(length, 1024*1024)
+                    if staged.read(chunk) != self.iso.read(offset, chunk):
+                        return False
+                    offset += chunk
+                    length -= chunk
+        finally:
+            staged.close()
+        return True
+
+    def _append(self, length):
+        """
+        Internal method to reserve room for length bytes at the end of the
+        new image.  Returns the first block of the room.
+        """
+        block = self.next_block
+        self.next_block += _sectors(length)
+        return block
+
+    def _append_file(self, staged_path):
+        """
+        Internal method to append the contents of staged_path to the new
+        image.  Returns the (block, length) of the data.
+        """
+        length = os.path.getsize(staged_path)
+        if length >= 2**32:
+            raise oz.OzException.OzException("File %s is too large" % (staged_path))
+        block = self._append(length)
+        fd = os.open(staged_path, os.O_RDONLY)
+        try:
+            os.lseek(self.out, block * SECTOR_SIZE, os.SEEK_SET)
+            oz.ozutil.copy_range(fd, self.out, 0, length)
+        finally:
+            os.close(fd)
+        return (block, length)
+
+    def _write_boot_catalog(self, boot_image, no_emul_boot, boot_load_size,
+                            boot_load_segment, boot_info_table):
+        """
+        Internal method to point the default entry of the El Torito boot
+        catalog at boot_image.  If the entry does not change, the original
+        catalog is kept; otherwise an updated copy is appended to the image.
+        """
+        if self.iso.boot_catalog is None:
+            raise oz.OzException.OzException("ISO %s has no El Torito boot catalog" % (self.path))
+
+        staged_path = os.path.join(self.contents, boot_image)
+        record = self.iso.lookup(boot_image)
+        rewritten = True
+        if self.new_files.get(staged_path) is not None:
+            block, length = self.new_files[staged_path]
+        elif record is not None and not record.is_dir() and record.extents[0][0] in self.moved:
+            block, length = self.moved[record.extents[0][0]]
+        elif record is not None and not record.is_dir():
+            block, length = record.extents[0]
+            rewritten = False
+        else:
+            raise oz.OzException.OzException("Boot image %s does not exist" % (boot_image))
+
+        if rewritten and boot_info_table:
+            self._write_boot_info_table(block, length)
+
+        catalog = bytearray(self.iso.read(self.iso.boot_catalog * SECTOR_SIZE,
+                                          SECTOR_SIZE))
+        if catalog[0] != 1 or catalog[30:32] != b"\x55\xaa":
+            raise oz.OzException.OzException("ISO %s has an invalid El Torito validation entry" % (self.path))
+
+        media = 0
+        if not no_emul_boot:
+            if length not in EMULATION_TYPES:
+                raise oz.OzException.OzException("Boot image %s is not the size of a floppy" % (boot_image))
+            media = EMULATION_TYPES[length]
+        count = boot_load_size
+        if count is None:
+            count = 1
+            if no_emul_boot:
+                count = min((length + 511) // 512, 0xffff)
+
+        entry = struct.pack("<BBHBBHI", 0x88, media, boot_load_segment,
+                            catalog[36], 0, count, block)
+        if bytes(catalog[32:44]) == entry:
+            return
+        catalog[32:44] = entry
+
+        self.catalog_block = self._append(SECTOR_SIZE)
+        oz.ozutil.pwrite_all(self.out, bytes(catalog),
+                             self.catalog_block * SECTOR_SIZE)
+        self.moved[self.iso.boot_catalog] = (self.catalog_block, None)
+
+    def _write_boot_info_table(self, block, length):
+        """
+        Internal method to fill in the boot info table of the boot image
+        written at block, the same way genisoimage -boot-info-table does.
+        """
+        if length < 64:
+            raise oz.OzException.OzException("Boot image is too small for a boot info table")
+        data = oz.ozutil.pread(self.out, length, block * SECTOR_SIZE)[64:]
+        data += b"\0" * ((4 - len(data) % 4) % 4)
+        checksum = sum(struct.unpack("<%dI" % (len(data) // 4), data)) & 0xffffffff
+        table = struct.pack("<IIII", 16, block, length, checksum) + b"\0" * 40
+        oz.ozutil.pwrite_all(self.out, table, block * SECTOR_SIZE + 8)
+
+    def _pair(self, rel, name):
+        """
+        Internal method to find the directory in contents that the directory
+        name in rel corresponds to, for a hierarchy other than the one the
+        names in contents come from.  Returns None if there is no unique
+        match.
+        """
+        if rel is None:
+            return None
+        names = self.dirs.get(rel, [])
+        if name in names:
+            return os.path.join(rel, name)
+        matches = [n for n in names if n.lower() == name.lower()]
+        if len(matches) != 1:
+            return None
+        return os.path.join(rel, matches[0])
+
+    def _uses_versions(self, directory, joliet):
+        """
+        Internal method to check whether the identifiers of files in
+        directory end with a version number (like ";1").  Directories without
+        files follow their parent.
+        """
+        semicolon = b";"
+        if joliet:
+            semicolon = ";".encode('utf-16-be')
+        files = [entry.identifier() for entry in directory.entries
+                 if entry.directory is None]
+        if files:
+            return bool([f for f in files if semicolon in f])
+        if directory.parent is not None:
+            return self._uses_versions(directory.parent, joliet)
+        return True
+
+    def _new_identifier(self, name, is_dir, joliet, directory):
+        """
+        Internal method to make up the identifier of a new file or directory
+        called name in directory.  Joliet identifiers are the name itself;
+        ISO9660 identifiers are the name squeezed into 8.3 format, with Rock
+        Ridge providing the real name.
+        """
+        version = self._uses_versions(directory, joliet)
+        if joliet:
+            taken = set([entry.identifier() for entry in directory.entries])
+            identifier = _decode_name(name)[:64].encode('utf-16-be')
+            if not is_dir and version:
+                identifier += ";1".encode('utf-16-be')
+            if identifier in taken:
+                raise oz.OzException.OzException("Joliet name of %s is already in use" % (name))
+            return identifier
+
+        taken = set([entry.identifier().split(b";")[0]
+                     for entry in directory.entries])
+
+        upper = _decode_name(name).upper()
+        if is_dir:
+            stem, ext = upper, ""
+        elif "." in upper:
+            stem, ext = upper.rsplit(".", 1)
+        else:
+            stem, ext = upper, ""
+        stem = re.sub("[^A-Z0-9_]", "_", stem)
+        ext = re.sub("[^A-Z0-9_]", "_", ext)[:3]
+        count = 0
+        while True:
+            suffix = ""
+            if count:
+                suffix = "_%d" % (count)
+            identifier = (stem[:8 - len(suffix)] + suffix).encode('ascii')
+            if not is_dir:
+                identifier += b"." + ext.encode('ascii')
+            if identifier not in taken:
+                break
+            count += 1
+        if not is_dir and version:
+            identifier += b";1"
+        return identifier
+
+    def _rock_ridge(self, name, mode):
+        """
+        Internal method to build the Rock Ridge entries for a new record, with
+        the real name and the permissions.
+        """
+        sysuse = b"\0" * self.iso.susp_skip
+        sysuse += (b"PX" + struct.pack("=BB", 36, 1) + _both32(mode) +
+                   _both32(1) + _both32(0) + _both32(0))
+        if name is not None:
+            name = _encode_name(name)
+            while True:
+                chunk = name[:250]
+                name = name[250:]
+                flags = 0
+                if name:
+                    flags = 0x01
+                sysuse += b"NM" + struct.pack("=BBB", 5 + len(chunk), 1, flags) + chunk
+                if not name:
+                    break
+        return sysuse
+
+    def _new_record(self, identifier, name, is_dir, joliet):
+        """
+        Internal method to build the record for a new file or directory, or
+        the "." or ".." record of a new directory if name is None.
+        """
+        flags = 0
+        mode = 0o100444
+        if is_dir:
+            flags = oz.ISO.FLAG_DIRECTORY
+            mode = 0o40555
+        sysuse = b""
+        if self.iso.rock_ridge and not joliet:
+            sysuse = self._rock_ridge(name, mode)
+        return _make_record(identifier, flags, sysuse)
+
+    def _build(self, record, joliet, rel, parent, identifier):
+        """
+        Internal method to build the _Directory for the original directory
+        record, and recursively for all of its subdirectories.  rel is the
+        corresponding directory in contents, or None if it is not known.
+        """
+        records = self.iso.directory_records(record, joliet)
+        if len(records) < 2:
+            raise oz.OzException.OzException("ISO %s has a directory without . and .." % (self.path))
+        directory = _Directory(identifier, bytearray(records[0][1]),
+                               bytearray(records[1][1]), parent)
+
+        pending = None
+        for child, raw in records[2:]:
+            if child.relocated or child.child_link is not None:
+                raise oz.OzException.OzException("ISO %s has relocated directories" % (self.path))
+            if pending is not None:
+                pending.records.append(bytearray(raw))
+            elif child.is_dir():
+                subdir = self._build(child, joliet, self._pair(rel, child.name),
+                                     directory, _identifier(raw))
+                pending = _Entry([bytearray(raw)], directory=subdir)
+            else:
+                pending = _Entry([bytearray(raw)])
+                block = child.extents[0][0]
+                if not child.is_symlink() and block in self.moved:
+                    pending.data = self.moved[block]
+            if not child.flags & oz.ISO.FLAG_MULTI_EXTENT:
+                if pending.data is not None:
+                    # the new data is in a single extent
+                    pending.records = pending.records[:1]
+                    pending.records[0][25] &= ~oz.ISO.FLAG_MULTI_EXTENT & 0xff
+                directory.entries.append(pending)
+                pending = None
+
+        if rel is not None and rel in self.added:
+            for name in self.added[rel]:
+                self._add_new(directory, joliet, os.path.join(rel, name))
+            self.consumed.add(rel)
+
+        return directory
+
+    def _add_new(self, directory, joliet, rel):
+        """
+        Internal method to add the new file or directory rel in contents to
+        directory, recursively.
+        """
+        name = os.path.basename(rel)
+        staged_path = os.path.join(self.contents, rel)
+        is_dir = os.path.isdir(staged_path)
+        identifier = self._new_identifier(name, is_dir, joliet, directory)
+        raw = self._new_record(identifier, name, is_dir, joliet)
+        if not is_dir:
+            directory.add(_Entry([raw], data=self.new_files[staged_path]))
+            return
+
+        subdir = _Directory(identifier,
+                            self._new_record(b"\0", None, True, joliet),
+                            self._new_record(b"\1", None, True, joliet),
+                            directory)
+        for subname in sorted(os.listdir(staged_path)):
+            self._add_new(subdir, joliet, os.path.join(rel, subname))
+        directory.add(_Entry([raw], directory=subdir))
+
+    def _write_hierarchy(self, root):
+        """
+        Internal method to append the directories under root and their path
+        tables to the new image.  Returns the size of a path table and the
+        blocks of the L and M path tables.
+        """
+        # the path tables list the directories level by level, and the
+        # directories of a level by parent and name
+        directories = [root]
+        index = 0
+        while index < len(directories):
+            directory = directories[index]
+            index += 1
+            directory.number = index
+            directory.size = len(_pack_records(directory.records()))
+            directory.block = self._append(directory.size)
+            subdirs = [entry.directory for entry in directory.entries
+                       if entry.directory is not None]
+            directories.extend(sorted(subdirs, key=lambda d: d.identifier))
+        if len(directories) > 0xffff:
+            raise oz.OzException.OzException("ISO %s has too many directories for the path tables" % (self.path))
+
+        ltable = b""
+        mtable = b""
+        for directory in directories:
+            parent = directory.parent
+            if parent is None:
+                parent = directory
+            _set_extent(directory.dot, directory.block, directory.size)
+            _set_extent(directory.dotdot, parent.block, parent.size)
+            for entry in directory.entries:
+                if entry.directory is not None:
+                    _set_extent(entry.records[0], entry.directory.block,
+                                entry.directory.size)
+                elif entry.data is not None:
+                    block, length = entry.data
+                    if length is None:
+                        length = struct.unpack_from("<I", bytes(entry.records[0]), 10)[0]
+                    _set_extent(entry.records[0], block, length)
+            oz.ozutil.pwrite_all(self.out,
+                                 bytes(_pack_records(directory.records())),
+                                 directory.block * SECTOR_SIZE)
+
+            pad = b""
+            if len(directory.identifier) % 2:
+                pad = b"\0"
+            ltable += (struct.pack("<BBIH", len(directory.identifier), 0,
+                                   directory.block, parent.number) +
+                       directory.identifier + pad)
+            mtable += (struct.pack(">BBIH", len(directory.identifier), 0,
+                                   directory.block, parent.number) +
+                       directory.identifier + pad)
+
+        lblock = self._append(len(ltable))
+        oz.ozutil.pwrite_all(self.out, ltable, lblock * SECTOR_SIZE)
+        mblock = self._append(len(mtable))
+        oz.ozutil.pwrite_all(self.out, mtable, mblock * SECTOR_SIZE)
+        return (len(ltable), lblock, mblock)
+
+    def _update_descriptor(self, data, joliet, volume_identifier):
+        """
+        Internal method to point a primary or Joliet volume descriptor at the
+        new hierarchy.
+        """
+        root, table_size, lblock, mblock = self.hierarchies[joliet]
+        data[80:88] = _both32(self.next_block)
+        data[132:140] = _both32(table_size)
+        data[140:148] = struct.pack("<II", lblock, 0)
+        data[148:156] = struct.pack(">II", mblock, 0)
+        data[158:174] = _both32(root.block) + _both32(root.size)
+        if volume_identifier is not None:
+            if joliet:
+                identifier = volume_identifier[:16].encode('utf-16-be')
+                data[40:72] = identifier + b"\0 " * ((32 - len(identifier)) // 2)
+            else:
+                data[40:72] = volume_identifier[:32].encode('ascii', 'replace').ljust(32, b" ")
+
+    def _update_volume_descriptors(self, volume_identifier):
+        """
+        Internal method to update the volume descriptor set of the new image.
+        """
+        sector = 16
+        while True:
+            offset = sector * SECTOR_SIZE
+            data = bytearray(oz.ozutil.pread(self.out, SECTOR_SIZE, offset))
+            sector += 1
+            if len(data) < SECTOR_SIZE or bytes(data[1:6]) != b"CD001":
+                break
+            if data[0] == oz.ISO.VD_PRIMARY:
+                self._update_descriptor(data, False, volume_identifier)
+            elif data[0] == oz.ISO.VD_SUPPLEMENTARY:
+                escapes = bytes(data[88:120])
+                if self.iso.joliet and (b"%/@" in escapes or b"%/C" in escapes or b"%/E" in escapes):
+                    self._update_descriptor(data, True, volume_identifier)
+            elif data[0] == oz.ISO.VD_BOOT_RECORD:
+                if self.catalog_block is not None:
+                    data[71:75] = struct.pack("<I", self.catalog_block)
+            elif data[0] == oz.ISO.VD_TERMINATOR:
+                break
+            oz.ozutil.pwrite_all(self.out, bytes(data), offset)
+
+    def write(self, output, volume_identifier=None, boot_image=None,
+              no_emul_boot=False, boot_load_size=None, boot_load_segment=0,
+              boot_info_table=False):
+        """
+        Method to write the remastered image to output.  volume_identifier
+        replaces the volume identifier if it is not None.  If boot_image (a
+        path relative to the root of contents) is not None, the default El
+        Torito boot entry is pointed at it with the given options, which have
+        the same meaning as the genisoimage options of the same name.
+        """
+        if self.iso.block_size != SECTOR_SIZE:
+            raise oz.OzException.OzException("ISO %s has a logical block size of %d" % (self.path, self.iso.block_size))
+        if self.iso.udf:
+            raise oz.OzException.OzException("ISO %s has a UDF filesystem" % (self.path))
+
+        self._scan(None, "")
+        for block in self.changed:
+            if self.file_blocks[block] > 1:
+                raise oz.OzException.OzException("Changed file %s shares its data with other files" % (self.changed[block]))
+
+        self.next_block = max(self.iso.space_size,
+                              _sectors(os.path.getsize(self.path)))
+
+        oz.ozutil.clone_file(self.path, output)
+        self.out = os.open(output, os.O_RDWR)
+        try:
+            for block in sorted(self.changed):
+                self.moved[block] = self._append_file(self.changed[block])
+            for staged_path in sorted(self.new_files):
+                self.new_files[staged_path] = self._append_file(staged_path)
+
+            if boot_image is not None:
+                self._write_boot_catalog(boot_image, no_emul_boot,
+                                         boot_load_size, boot_load_segment,
+                                         boot_info_table)
+
+            roots = [(False, self.iso.root)]
+            if self.iso.joliet:
+                roots.append((True, self.iso.joliet_root))
+            for joliet, record in roots:
+                self.consumed = set()
+                root = self._build(record, joliet, "", None, b"\0")
+                missing = set(self.added) - self.consumed
+                if missing:
+                    raise oz.OzException.OzException("Could not find directory %s in every hierarchy of ISO %s" % (sorted(missing)[0], self.path))
+                self.hierarchies[joliet] = (root,) + self._write_hierarchy(root)
+
+            self._update_volume_descriptors(volume_identifier)
+            os.ftruncate(self.out, self.next_block * SECTOR_SIZE)
+        except:
+            os.close(self.out)
+            self.out = None
+            oz.ozutil.unlink_if_exists(output)
+            raise
+
+        os.close(self.out)
+        self.out = None
@@ -0,0 +1,213 @@
+# Copyright (C) 2013  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Cache of installed operating systems (JEOS)
+"""
+
+import os
+import time
+import errno
+import fcntl
+
+import oz.ozutil
+
+class JeosCache(object):
+    """
+    Class to keep installed operating systems (JEOS) for reuse.  Every
+    operating system can have several variants, one for each combination of
+    install inputs (the automated install file, disk size, image type and so
+    on); the variant is identified by a digest of those inputs, which is
+    part of its filename.  A small index records the inputs of each variant
+    and when it was last used, and only max_variants variants of each
+    operating system are kept; the least recently used ones are removed to
+    make room for new ones.
+
+    Overlays on a variant use a hard link snapshot of it as their backing
+    file, so that replacing or removing the variant does not affect them.
+    The overlays using each snapshot are recorded in a second index, and a
+    snapshot is removed as soon as none of them uses it any more.
+    """
+    def __init__(self, cache_dir, max_variants):
+        self.cache_dir = cache_dir
+        self.max_variants = max_variants
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock_path = os.path.join(cache_dir, "index.lock")
+        self.snapshots_path = os.path.join(cache_dir, "snapshots.json")
+        # how long (in seconds) an overlay that was registered on a snapshot
+        # has to be created before the snapshot may be removed
+        self.snapshot_grace = 3600
+
+    def path(self, osname, key, extension):
+        """
+        Method to return the path to the variant of the operating system
+        osname (for instance Fedora19x86_64) with the install input digest
+        key.
+        """
+        return os.path.join(self.cache_dir,
+                            "%s-%s.%s" % (osname, key, extension))
+
+    def _read_index(self):
+        """
+        Internal method to read the index, returning an empty one if there is
+        no index yet.
+        """
+        index = oz.ozutil.read_json_file(self.index_path)
+        if index is None:
+            index = {}
+        return index
+
+    def _update(self, func):
+        """
+        Internal method to remove the snapshots that are no longer used, and
+        then call func with the index and the snapshot index, with the index
+        lock held, and write both indexes back afterwards.  Returns what func
+        returns.
+        """
+        oz.ozutil.mkdir_p(self.cache_dir)
+        lockfd = os.open(self.lock_path, os.O_RDWR|os.O_CREAT)
+        try:
+            fcntl.lockf(lockfd, fcntl.LOCK_EX)
+            index = self._read_index()
+            snapshots = oz.ozutil.read_json_file(self.snapshots_path)
+            if snapshots is None:
+                snapshots = {}
+            self._prune_snapshots(snapshots)
+            ret = func(index, snapshots)
+            oz.ozutil.write_json_file(self.index_path, index)
+            oz.ozutil.write_json_file(self.snapshots_path, snapshots)
+        finally:
+            os.close(lockfd)
+        return ret
+
+    def touch(self, path):
+        """
+        Method to record that the variant at path was just used.
+        """
+        def _touch(index, snapshots):
+            entry = index.get(os.path.basename(path))
+            if entry is not None:
+                entry['last_used'] = time.time()
+        self._update(_touch)
+
+    def add(self, path, osname, inputs):
+        """
+        Method to record the variant of the operating system osname that was
+        just stored at path, installed with the dictionary of install inputs
+        inputs, and to remove the least recently used variants of osname if
+        there are more than max_variants of them.
+        """
+        def _add(index, snapshots):
+            now = time.time()
+            index[os.path.basename(path)] = {'os': osname, 'inputs': inputs,
+                                             'created': now, 'last_used': now}
+            self._evict(index, osname, os.path.basename(path))
+        self._update(_add)
+
+    def _evict(self, index, osname, keep):
+        """
+        Internal method to remove variants of osname, least recently used
+        first, until there are at most max_variants of them.  The variant
+        named keep is never removed.  Must be called with the index lock
+        held.
+        """
+        for name in list(index.keys()):
+            if not os.path.exists(os.path.join(self.cache_dir, name)):
+                # removed behind our back
+                del index[name]
+
+        if self.max_variants is None:
+            return
+
+        variants = [name for name in index if index[name].get('os') == osname]
+        variants.sort(key=lambda name: index[name].get('last_used', 0))
+        for name in list(variants):
+            if len(variants) <= self.max_variants:
+                break
+            if name == keep:
+                continue
+            # overlays use hard link snapshots of the variant, so they are not
+            # affected by this; the snapshots are removed once no overlay
+            # uses them
+            oz.ozutil.unlink_if_exists(os.path.join(self.cache_dir, name))
+            del index[name]
+            variants.remove(name)
+
+    def snapshot(self, path, overlay):
+        """
+        Method to return a snapshot of the variant at path for the overlay
+        that is about to be created at overlay to use as its backing file.
+        The snapshot is a hard link named after the identity of the variant,
+        so overlays created on the same variant share it, and overlays
+        created before the variant was replaced keep using the old one.  The
+        snapshot is kept for as long as the overlay (or any other overlay
+        registered on it) has it as its backing file.
+        """
+        def _snapshot(index, snapshots):
+            st = os.stat(path)
+            snapshot = "%s-%d-%d" % (path, st.st_ino, int(st.st_mtime))
+            try:
+                os.link(path, snapshot)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            entry = snapshots.setdefault(os.path.basename(snapshot),
+                                         {'variant': os.path.basename(path),
+                                          'overlays': {}})
+            entry['overlays'][os.path.abspath(overlay)] = time.time()
+            return snapshot
+        return self._update(_snapshot)
+
+    def _uses(self, overlay, snapshot):
+        """
+        Internal method to check whether the qcow2 image overlay has the
+        snapshot as its backing file.
+        """
+        backing = oz.ozutil.qcow2_backing_file(overlay)
+        if backing is None:
+            return False
+        backing = os.path.join(os.path.dirname(overlay), backing)
+        return os.path.abspath(backing) == os.path.abspath(snapshot)
+
+    def _prune_snapshots(self, snapshots):
+        """
+        Internal method to forget the overlays that no longer use their
+        snapshot (once they are older than snapshot_grace, so that overlays
+        that are still being created are not forgotten), and to remove the
+        snapshots that no overlay uses any more.  Must be called with the
+        index lock held.
+        """
+        now = time.time()
+        for name in list(snapshots.keys()):
+            snapshot = os.path.join(self.cache_dir, name)
+            overlays = snapshots[name].get('overlays', {})
+            for overlay in list(overlays.keys()):
+                if now - overlays[overlay] < self.snapshot_grace:
+                    continue
+                if not self._uses(overlay, snapshot):
+                    del overlays[overlay]
+            if not overlays:
+                oz.ozutil.unlink_if_exists(snapshot)
+                del snapshots[name]
+
+    def in_use(self, path):
+        """
+        Method to check whether path is a snapshot that an overlay still
+        uses.
+        """
+        def _in_use(index, snapshots):
+            return os.path.basename(path) in snapshots
+        return self._update(_in_use)
@@ -43,16 +43,18 @@ class MandrakeGuest(oz.Guest.CDGuest):
         if self.auto is None:
             self.auto = oz.ozutil.generate_full_auto_path("mandrake-" + self.tdl.update + "-jeos.cfg")
 
-    def _modify_iso(self):
+    def _modified_iso_files(self):
         """
-        Method to make the boot ISO auto-boot with appropriate parameters.
+        Method to return the files on the Mandrake ISO that are changed in
+        place.
         """
-        self.log.debug("Modifying ISO")
-
-        self.log.debug("Copying cfg file")
-
-        outname = os.path.join(self.iso_contents, "auto_inst.cfg")
+        return ["auto_inst.cfg", "isolinux/isolinux.cfg",
+                "isolinux/isolinux.bin"]
 
+    def _render_auto_file(self, outname):
+        """
+        Method to write the auto_inst.cfg for the install to outname.
+        """
         if self.auto == oz.ozutil.generate_full_auto_path("mandrake-" + self.tdl.update + "-jeos.cfg"):
 
             def _cfg_sub(line):
@@ -69,6 +71,15 @@ class MandrakeGuest(oz.Guest.CDGuest):
         else:
             shutil.copy(self.auto, outname)
 
+    def _modify_iso(self):
+        """
+        Method to make the boot ISO auto-boot with appropriate parameters.
+        """
+        self.log.debug("Modifying ISO")
+
+        self.log.debug("Copying cfg file")
+        self._render_auto_file(os.path.join(self.iso_contents, "auto_inst.cfg"))
+
         self.log.debug("Modifying isolinux.cfg")
         isolinuxcfg = os.path.join(self.iso_contents, "isolinux",
                                    "isolinux.cfg")
@@ -86,14 +97,14 @@ class MandrakeGuest(oz.Guest.CDGuest):
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.info("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-l", "-no-emul-boot",
-                                           "-b", "isolinux/isolinux.bin",
-                                           "-c", "isolinux/boot.cat",
-                                           "-boot-load-size", "4",
-                                           "-cache-inodes", "-boot-info-table",
-                                           "-v", "-v", "-o", self.output_iso,
-                                           self.iso_contents])
+        self._run_genisoimage(["-r", "-V", "Custom",
+                               "-J", "-l", "-no-emul-boot",
+                               "-b", "isolinux/isolinux.bin",
+                               "-c", "isolinux/boot.cat",
+                               "-boot-load-size", "4",
+                               "-cache-inodes", "-boot-info-table",
+                               "-v", "-v", "-o", self.output_iso,
+                               self.iso_contents])
 
 class Mandrake82Guest(oz.Guest.CDGuest):
     """
@@ -110,13 +121,17 @@ class Mandrake82Guest(oz.Guest.CDGuest):
         if self.auto is None:
             self.auto = oz.ozutil.generate_full_auto_path("mandrake-" + self.tdl.update + "-jeos.cfg")
 
-    def _modify_iso(self):
+    def _modified_iso_files(self):
         """
-        Method to make the boot ISO auto-boot with appropriate parameters.
+        Method to return the files on the Mandrake 8.2 ISO that are changed
+        in place; the boot floppy image is modified with mcopy.
         """
-        self.log.debug("Modifying ISO")
+        return ["auto_inst.cfg", "Boot/cdrom.img"]
 
-        outname = os.path.join(self.iso_contents, "auto_inst.cfg")
+    def _render_auto_file(self, outname):
+        """
+        Method to write the auto_inst.cfg for the install to outname.
+        """
         if self.auto == oz.ozutil.generate_full_auto_path("mandrake-" + self.tdl.update + "-jeos.cfg"):
 
             def _cfg_sub(line):
@@ -133,6 +148,14 @@ class Mandrake82Guest(oz.Guest.CDGuest):
         else:
             shutil.copy(self.auto, outname)
 
+    def _modify_iso(self):
+        """
+        Method to make the boot ISO auto-boot with appropriate parameters.
+        """
+        self.log.debug("Modifying ISO")
+
+        self._render_auto_file(os.path.join(self.iso_contents, "auto_inst.cfg"))
+
         syslinux = os.path.join(self.icicle_tmp, 'syslinux.cfg')
         f = open(syslinux, 'w')
         f.write("default customiso\n")
@@ -153,12 +176,12 @@ class Mandrake82Guest(oz.Guest.CDGuest):
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.info("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-cache-inodes",
-                                           "-b", "Boot/cdrom.img",
-                                           "-c", "Boot/boot.cat",
-                                           "-v", "-v", "-o", self.output_iso,
-                                           self.iso_contents])
+        self._run_genisoimage(["-r", "-V", "Custom",
+                               "-J", "-cache-inodes",
+                               "-b", "Boot/cdrom.img",
+                               "-c", "Boot/boot.cat",
+                               "-v", "-v", "-o", self.output_iso,
+                               self.iso_contents])
 
     def install(self, timeout=None, force=False):
         internal_timeout = timeout
@@ -44,21 +44,23 @@ class MandrivaGuest(oz.Guest.CDGuest):
         if self.mandriva_arch == "i386":
             self.mandriva_arch = "i586"
 
-    def _modify_iso(self):
+    def _modified_iso_files(self):
         """
-        Method to make the boot ISO auto-boot with appropriate parameters.
+        Method to return the files on the Mandriva ISO that are changed in
+        place.  Some releases keep them in a per-architecture directory.
         """
-        self.log.debug("Modifying ISO")
-
-        self.log.debug("Copying cfg file")
-
+        pathdir = ""
         if self.tdl.update in ["2007.0", "2008.0"]:
-            pathdir = os.path.join(self.iso_contents, self.mandriva_arch)
-        else:
-            pathdir = self.iso_contents
+            pathdir = self.mandriva_arch
 
-        outname = os.path.join(pathdir, "auto_inst.cfg")
+        return [os.path.join(pathdir, "auto_inst.cfg"),
+                os.path.join(pathdir, "isolinux/isolinux.cfg"),
+                os.path.join(pathdir, "isolinux/isolinux.bin")]
 
+    def _render_auto_file(self, outname):
+        """
+        Method to write the auto_inst.cfg for the install to outname.
+        """
         if self.auto == oz.ozutil.generate_full_auto_path("mandriva-" + self.tdl.update + "-jeos.cfg"):
 
             def _cfg_sub(line):
@@ -75,6 +77,21 @@ class MandrivaGuest(oz.Guest.CDGuest):
         else:
             shutil.copy(self.auto, outname)
 
+    def _modify_iso(self):
+        """
+        Method to make the boot ISO auto-boot with appropriate parameters.
+        """
+        self.log.debug("Modifying ISO")
+
+        self.log.debug("Copying cfg file")
+
+        if self.tdl.update in ["2007.0", "2008.0"]:
+            pathdir = os.path.join(self.iso_contents, self.mandriva_arch)
+        else:
+            pathdir = self.iso_contents
+
+        self._render_auto_file(os.path.join(pathdir, "auto_inst.cfg"))
+
         self.log.debug("Modifying isolinux.cfg")
         isolinuxcfg = os.path.join(pathdir, "isolinux", "isolinux.cfg")
         f = open(isolinuxcfg, 'w')
@@ -99,14 +116,14 @@ class MandrivaGuest(oz.Guest.CDGuest):
         isolinuxbin = os.path.join(isolinuxdir, "isolinux/isolinux.bin")
         isolinuxboot = os.path.join(isolinuxdir, "isolinux/boot.cat")
 
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-l", "-no-emul-boot",
-                                           "-b", isolinuxbin,
-                                           "-c", isolinuxboot,
-                                           "-boot-load-size", "4",
-                                           "-cache-inodes", "-boot-info-table",
-                                           "-v", "-v", "-o", self.output_iso,
-                                           self.iso_contents])
+        self._run_genisoimage(["-r", "-V", "Custom",
+                               "-J", "-l", "-no-emul-boot",
+                               "-b", isolinuxbin,
+                               "-c", isolinuxboot,
+                               "-boot-load-size", "4",
+                               "-cache-inodes", "-boot-info-table",
+                               "-v", "-v", "-o", self.output_iso,
+                               self.iso_contents])
 
 def get_class(tdl, config, auto, output_disk=None, netdev=None, diskbus=None,
               macaddress=None):
@@ -0,0 +1,360 @@
+# Copyright (C) 2013  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Detection of the operating system on installation ISOs
+"""
+
+import os
+import re
+import fcntl
+import logging
+
+import oz.ISO
+import oz.MediaStore
+import oz.OzException
+import oz.ozutil
+
+# the files on installation media that identify the operating system.  They
+# are all tiny, so reading them straight out of the ISO takes a handful of
+# sector reads
+_FINGERPRINT_FILES = [".treeinfo", ".discinfo", "README.diskdefines",
+                      ".disk/info", "content"]
+
+# map from the product names used by .treeinfo and .discinfo to the
+# prefix of the GuestFactory.os_dict name
+_FAMILIES = [("Red Hat Enterprise Linux", "RHEL"),
+             ("Red Hat Linux", "RHL"),
+             ("Fedora Core", "FedoraCore"),
+             ("Fedora", "Fedora"),
+             ("CentOS", "CentOS"),
+             ("Scientific Linux CERN", "SLC"),
+             ("Scientific Linux", "SL"),
+             ("Oracle Linux", "OEL"),
+             ("Enterprise Linux", "OEL")]
+
+def _normalize_arch(arch):
+    """
+    Function to map the architecture names used by the various
+    distributions to the ones Oz uses.  Returns None for architectures that
+    Oz does not support.
+    """
+    if arch is None:
+        return None
+    arch = arch.strip().lower()
+    if arch in ["x86_64", "amd64"]:
+        return "x86_64"
+    if arch in ["i386", "i486", "i586", "i686"]:
+        return "i386"
+    return None
+
+def _family_os(family, version):
+    """
+    Function to map a product name and version, as found in .treeinfo and
+    .discinfo, to the (name, version) pair that the TDL would use.  Returns
+    None if the product is not one Oz knows about.
+    """
+    for prefix, name in _FAMILIES:
+        if family.startswith(prefix):
+            break
+    else:
+        return None
+
+    if name in ["Fedora", "FedoraCore"]:
+        return (name, version.split(".")[0])
+    if name == "RHL":
+        return (name, version)
+
+    parts = version.split(".")
+    major = parts[0]
+    minor = "0"
+    if len(parts) > 1:
+        minor = parts[1]
+    if int(major) >= 6:
+        update = minor
+    elif minor == "0":
+        update = "GOLD"
+    else:
+        update = "U" + minor
+    return ("%s-%s" % (name, major), update)
+
+def _parse_treeinfo(data):
+    """
+    Function to identify the operating system from the [general] section of
+    a .treeinfo file.
+    """
+    general = {}
+    section = None
+    for line in data.splitlines():
+        line = line.strip()
+        if line.startswith("[") and line.endswith("]"):
+            section = line[1:-1].strip()
+        elif section == "general" and "=" in line:
+            key, value = line.split("=", 1)
+            general[key.strip()] = value.strip()
+
+    if not re.match(r"\d+(\.\d+)?$", general.get("version", "")):
+        return None
+    osinfo = _family_os(general.get("family", ""), general["version"])
+    if osinfo is None:
+        return None
+    return osinfo + (_normalize_arch(general.get("arch")),)
+
+def _parse_discinfo(data):
+    """
+    Function to identify the operating system from a .discinfo file, whose
+    second line is the product name and version and whose third line is the
+    architecture.
+    """
+    lines = data.splitlines()
+    if len(lines) < 3:
+        return None
+    match = re.match(r"(.*?)\s+(\d+(\.\d+)?)\b", lines[1].strip())
+    if match is None:
+        return None
+    osinfo = _family_os(match.group(1), match.group(2))
+    if osinfo is None:
+        return None
+    return osinfo + (_normalize_arch(lines[2]),)
+
+def _parse_diskname(data):
+    """
+    Function to identify the operating system from the disk name of Debian
+    and Ubuntu media, as found in README.diskdefines and .disk/info, for
+    instance 'Ubuntu-Server 12.04.2 LTS "Precise Pangolin" - Release amd64'.
+    """
+    match = re.search(r"#define\s+DISKNAME\s+(.*)", data)
+    if match is not None:
+        data = match.group(1)
+    match = re.match(r"\s*(Ubuntu|Debian)\S*\s+(GNU/Linux\s+)?(\d+\.\d+(\.\d+)?)", data)
+    if match is None:
+        return None
+    version = match.group(3)
+    if match.group(1) == "Debian":
+        version = version.split(".")[0]
+    arch = None
+    for word in re.split(r"[\s,]+", data):
+        arch = _normalize_arch(word)
+        if arch is not None:
+            break
+    return (match.group(1), version, arch)
+
+def _parse_suse_content(data):
+    """
+    Function to identify the operating system from the content file of
+    openSUSE media.
+    """
+    fields = {}
+    for line in data.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            fields[parts[0]] = parts[1].strip()
+    label = fields.get("LABEL", fields.get("PRODUCT", ""))
+    if not label.lower().startswith("opensuse") or "VERSION" not in fields:
+        return None
+    arch = None
+    for word in fields.get("BASEARCHS", "").split():
+        arch = _normalize_arch(word)
+        if arch is not None:
+            break
+    return ("OpenSUSE", fields["VERSION"], arch)
+
+def _parse_volume_id(volid):
+    """
+    Function to identify the operating system from the volume identifier
+    in the Primary Volume Descriptor, for instance 'Fedora 18 x86_64 DVD' or
+    'CentOS_6.4_Final'.  This is only a fallback for media that has none of
+    the files above, since volume identifiers are not very descriptive.
+    """
+    match = re.match(r"(Fedora|CentOS|RHEL)[ _-]+(\d+(\.\d+)?)\b", volid)
+    if match is None:
+        return None
+    family = match.group(1)
+    if family == "RHEL":
+        family = "Red Hat Enterprise Linux"
+    osinfo = _family_os(family, match.group(2))
+    match = re.search(r"(x86_64|amd64|i[3-6]86)", volid)
+    if match is None:
+        return osinfo + (None,)
+    return osinfo + (_normalize_arch(match.group(1)),)
+
+_PARSERS = [(".treeinfo", _parse_treeinfo),
+            (".discinfo", _parse_discinfo),
+            ("README.diskdefines", _parse_diskname),
+            (".disk/info", _parse_diskname),
+            ("content", _parse_suse_content)]
+
+def fingerprint(path):
+    """
+    Function to read the fingerprint of the ISO at path: the system and
+    volume identifiers from the Primary Volume Descriptor, and the contents
+    of the small files that installation media use to describe themselves.
+    Only the volume descriptors, the directories on the way to those files,
+    and the files themselves are read, so this is fast even for a DVD.
+    """
+    iso = oz.ISO.ISO9660Image(path)
+    try:
+        result = {'system_id': iso.system_identifier,
+                  'volume_id': iso.volume_identifier,
+                  'files': {}}
+        for name in _FINGERPRINT_FILES:
+            record = iso.lookup(name)
+            if record is None or record.is_dir() or record.size() > 64*1024:
+                continue
+            data = iso.read_file(record)
+            result['files'][name] = data.decode('utf-8', 'replace')
+    finally:
+        iso.close()
+
+    return result
+
+def identify(fprint):
+    """
+    Function to identify the operating system described by fprint, as
+    returned by fingerprint().  Returns a dictionary with the 'distro',
+    'update', and 'arch' the TDL would use, with None for what could not be
+    worked out, or None if the operating system is not recognized at all.
+    """
+    for name, parser in _PARSERS:
+        data = fprint['files'].get(name)
+        if data is None:
+            continue
+        osinfo = parser(data)
+        if osinfo is not None:
+            break
+    else:
+        osinfo = _parse_volume_id(fprint['volume_id'] or "")
+        if osinfo is None:
+            return None
+
+    distro, update, arch = osinfo
+    if distro not in _os_names():
+        return None
+    return {'distro': distro, 'update': update, 'arch': arch}
+
+def _os_names():
+    """
+    Function to return the names of the operating systems Oz supports.
+    """
+    # imported here since GuestFactory uses this module
+    import oz.GuestFactory
+    return oz.GuestFactory.os_dict
+
+class MediaIndex(object):
+    """
+    Class to remember what operating system is on each installation ISO.
+    The index is keyed by the SHA-256 digest of the ISO where that is known
+    without reading the whole ISO (media in the media store, and media with
+    a digest sidecar), and by the identity and modification time of the
+    file otherwise.
+    """
+    def __init__(self, index_dir, media_store):
+        self.index_dir = index_dir
+        self.media_store = media_store
+        self.index_path = os.path.join(index_dir, "index.json")
+        self.lock_path = os.path.join(index_dir, "index.lock")
+
+    def _key(self, path, digest):
+        """
+        Internal method to return the index key of the ISO at path, whose
+        SHA-256 digest may already be known.
+        """
+        if digest is None:
+            digest = self.media_store.digest(path)
+        if digest is None:
+            digest = oz.ozutil.read_sidecar_digest(path)
+        if digest is not None:
+            return "sha256:" + digest
+        st = os.stat(path)
+        return "file:%d:%d:%d:%s" % (st.st_dev, st.st_ino, st.st_size,
+                                     st.st_mtime)
+
+    def lookup(self, path, digest=None):
+        """
+        Method to return the operating system on the ISO at path, as returned
+        by identify().  digest is the SHA-256 digest of the ISO, if the
+        caller knows it.  The ISO is only fingerprinted the first time it is
+        seen.
+        """
+        key = self._key(path, digest)
+        index = oz.ozutil.read_json_file(self.index_path)
+        if index is not None and key in index:
+            return index[key]
+
+        result = identify(fingerprint(path))
+
+        oz.ozutil.mkdir_p(self.index_dir)
+        lockfd = os.open(self.lock_path, os.O_RDWR|os.O_CREAT)
+        try:
+            fcntl.lockf(lockfd, fcntl.LOCK_EX)
+            index = oz.ozutil.read_json_file(self.index_path)
+            if index is None:
+                index = {}
+            index[key] = result
+            oz.ozutil.write_json_file(self.index_path, index)
+        finally:
+            os.close(lockfd)
+
+        return result
+
+def _local_iso(url, media_store):
+    """
+    Function to return a (path, digest) tuple for a local copy of the ISO at
+    url: the file itself for file:// URLs, or the copy in the media store
+    for ISOs that were downloaded before.  The digest is None if it is not
+    known yet.  Returns None if there is no local copy.
+    """
+    if url.startswith("file://"):
+        return (url[len("file://"):], None)
+    if url.startswith("/"):
+        return (url, None)
+    blob = media_store.last_url_blob(url)
+    if blob is None:
+        return None
+    # blobs are named after their digest
+    return (blob, os.path.basename(blob))
+
+def detect_tdl_os(tdl, config):
+    """
+    Function to fill in the OS name, version, and architecture of an ISO
+    install TDL that left them out, by identifying the operating system on
+    the ISO.  Values given in the TDL are left alone.
+    """
+    log = logging.getLogger('%s' % (__name__))
+
+    if tdl.installtype != "iso":
+        raise oz.OzException.OzException("The OS name, version, and architecture can only be left out of the TDL for ISO installs")
+
+    data_dir = oz.ozutil.config_get_key(config, 'paths', 'data_dir',
+                                        oz.ozutil.default_data_dir())
+    store = oz.MediaStore.MediaStore(os.path.join(data_dir, "store"))
+    local = _local_iso(tdl.iso, store)
+    if local is None:
+        raise oz.OzException.OzException("Cannot detect the OS on %s before it is downloaded; specify the OS name, version, and architecture in the TDL" % (tdl.iso))
+
+    index = MediaIndex(os.path.join(data_dir, "fingerprints"), store)
+    result = index.lookup(local[0], local[1])
+    if result is None:
+        raise oz.OzException.OzException("Could not detect the OS on %s; specify the OS name, version, and architecture in the TDL" % (tdl.iso))
+
+    for attr in ['distro', 'update', 'arch']:
+        if getattr(tdl, attr) is None:
+            if result[attr] is None:
+                raise oz.OzException.OzException("Could not detect the OS %s on %s; specify it in the TDL" % (attr, tdl.iso))
+            setattr(tdl, attr, result[attr])
+
+    log.info("Detected %s %s %s on %s" % (tdl.distro, tdl.update, tdl.arch,
+                                          tdl.iso))
@@ -0,0 +1,201 @@
+# Copyright (C) 2013  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Content-addressed store for original installation media
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+
+import oz.ozutil
+
+class MediaStore(object):
+    """
+    Class to store original installation media by the SHA-256 digest of its
+    contents.  Each piece of media is stored once as a blob, and the cached
+    files that Oz uses (like data_dir/isos/Fedora19x86_64-iso.iso) are hard
+    links to the blob.  An index maps the URLs the media was fetched from,
+    the upstream checksums it was verified against, and the names of the
+    cached files to the digest of the blob, so that identical media is only
+    downloaded and stored once.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index_path = os.path.join(store_dir, "index.json")
+        self.lock_path = os.path.join(store_dir, "index.lock")
+
+    def blob_path(self, digest):
+        """
+        Method to return the path to the blob with the given SHA-256 digest.
+        """
+        return os.path.join(self.store_dir, "blobs", digest[:2], digest)
+
+    def _read_index(self):
+        """
+        Internal method to read the index, returning an empty one if there is
+        no index yet.
+        """
+        index = oz.ozutil.read_json_file(self.index_path)
+        if index is None:
+            index = {}
+        for key in ['urls', 'sums', 'names']:
+            index.setdefault(key, {})
+        return index
+
+    def _lookup(self, digest):
+        """
+        Internal method to return the path to the blob with the given digest,
+        or None if the blob is not in the store.
+        """
+        if digest is None:
+            return None
+        blob = self.blob_path(digest)
+        if not os.access(blob, os.F_OK):
+            return None
+        return blob
+
+    def lookup_url(self, url, validators):
+        """
+        Method to find the blob that was downloaded from url.  validators is
+        the dictionary of HTTP validators (ETag, Last-Modified, and length) of
+        the remote file as it is now; the blob is only returned if it was
+        downloaded when the remote file had the same validators.  Returns the
+        path to the blob, or None if there is no such blob.
+        """
+        if validators is None:
+            return None
+        entry = self._read_index()['urls'].get(url)
+        if entry is None:
+            return None
+        for key in validators:
+            if entry.get(key) != validators[key]:
+                return None
+        return self._lookup(entry.get('digest'))
+
+    def last_url_blob(self, url):
+        """
+        Method to find the blob that was last downloaded from url, without
+        checking whether the remote file has changed since.  Returns the path
+        to the blob, or None if there is no such blob.
+        """
+        entry = self._read_index()['urls'].get(url)
+        if entry is None:
+            return None
+        return self._lookup(entry.get('digest'))
+
+    def lookup_sum(self, hashname, hexsum):
+        """
+        Method to find the blob whose contents have the given checksum.
+        Returns the path to the blob, or None if there is no such blob.
+        """
+        sums = self._read_index()['sums']
+        return self._lookup(sums.get(hashname + ':' + hexsum.lower()))
+
+    def sums(self, blob):
+        """
+        Method to return all of the checksums recorded for blob, as a
+        dictionary of hash name to hex digest.
+        """
+        digest = os.path.basename(blob)
+        sums = {}
+        for key, value in self._read_index()['sums'].items():
+            if value == digest:
+                hashname, hexsum = key.split(':', 1)
+                sums[hashname] = hexsum
+        return sums
+
+    def name_url(self, path):
+        """
+        Method to return the URL that the cached file at path was last
+        fetched from, or None if the store has no record of path.
+        """
+        entry = self._read_index()['names'].get(os.path.abspath(path))
+        if entry is None:
+            return None
+        return entry.get('url')
+
+    def digest(self, path):
+        """
+        Method to return the SHA-256 digest of the cached file at path, if it
+        is a link to a blob in the store, or None otherwise.
+        """
+        entry = self._read_index()['names'].get(os.path.abspath(path))
+        if entry is None:
+            return None
+        blob = self._lookup(entry.get('digest'))
+        if blob is None or not os.path.exists(path) or not os.path.samefile(blob, path):
+            return None
+        return entry['digest']
+
+    def link(self, blob, path):
+        """
+        Method to make path a hard link to blob.  The link is created next to
+        path and renamed into place, so path always refers to complete data.
+        """
+        tmp = path + ".link"
+        oz.ozutil.unlink_if_exists(tmp)
+        os.link(blob, tmp)
+        os.rename(tmp, path)
+
+    def add(self, path, digests, url, validators):
+        """
+        Method to add the verified media at path to the store.  digests is a
+        dictionary of hash name to hex digest of the media, and must contain
+        at least the 'sha256' digest.  If an identical blob is already in the
+        store, path is replaced with a link to it, freeing the space used by
+        the duplicate.  url and validators record where the media came from,
+        so a later lookup_url() can find it without downloading it again.
+        Returns the path to the blob.
+        """
+        digest = digests['sha256']
+        blob = self.blob_path(digest)
+
+        oz.ozutil.mkdir_p(os.path.dirname(blob))
+
+        lockfd = os.open(self.lock_path, os.O_RDWR|os.O_CREAT)
+        try:
+            fcntl.lockf(lockfd, fcntl.LOCK_EX)
+
+            if not os.access(blob, os.F_OK):
+                try:
+                    os.link(path, blob)
+                except OSError as err:
+                    if err.errno != errno.EXDEV:
+                        raise
+                    # the store is on a different filesystem than path, so
+                    # keep a copy in the store instead
+                    shutil.copyfile(path, blob + ".tmp")
+                    os.rename(blob + ".tmp", blob)
+            elif not os.path.samefile(blob, path):
+                self.link(blob, path)
+
+            index = self._read_index()
+            entry = {'digest': digest}
+            if validators is not None:
+                entry.update(validators)
+            index['urls'][url] = entry
+            for hashname, hexsum in digests.items():
+                index['sums'][hashname + ':' + hexsum.lower()] = digest
+            index['names'][os.path.abspath(path)] = {'url': url,
+                                                     'digest': digest}
+            oz.ozutil.write_json_file(self.index_path, index)
+        finally:
+            os.close(lockfd)
+
+        return blob
@@ -50,14 +50,19 @@ class OpenSUSEGuest(oz.Guest.CDGuest):
 
         self.sshprivkey = os.path.join('/etc', 'oz', 'id_rsa-icicle-gen')
 
-    def _modify_iso(self):
+    def _modified_iso_files(self):
         """
-        Method to make the boot ISO auto-boot with appropriate parameters.
+        Method to return the files on the OpenSUSE ISO that are changed in
+        place.
         """
-        self.log.debug("Putting the autoyast in place")
-
-        outname = os.path.join(self.iso_contents, "autoinst.xml")
+        loader = "boot/" + self.tdl.arch + "/loader/"
+        return ["autoinst.xml", loader + "isolinux.cfg",
+                loader + "isolinux.bin"]
 
+    def _render_auto_file(self, outname):
+        """
+        Method to write the autoyast file for the install to outname.
+        """
         if self.autoyast == oz.ozutil.generate_full_auto_path("opensuse-" + self.tdl.update + "-jeos.xml"):
             doc = libxml2.parseFile(self.autoyast)
 
@@ -71,6 +76,13 @@ class OpenSUSEGuest(oz.Guest.CDGuest):
         else:
             shutil.copy(self.autoyast, outname)
 
+    def _modify_iso(self):
+        """
+        Method to make the boot ISO auto-boot with appropriate parameters.
+        """
+        self.log.debug("Putting the autoyast in place")
+        self._render_auto_file(os.path.join(self.iso_contents, "autoinst.xml"))
+
         self.log.debug("Modifying the boot options")
         isolinux_cfg = os.path.join(self.iso_contents, "boot", self.tdl.arch,
                                     "loader", "isolinux.cfg")
@@ -95,16 +107,16 @@ class OpenSUSEGuest(oz.Guest.CDGuest):
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.info("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-no-emul-boot",
-                                           "-b", "boot/" + self.tdl.arch + "/loader/isolinux.bin",
-                                           "-c", "boot/" + self.tdl.arch + "/loader/boot.cat",
-                                           "-boot-load-size", "4",
-                                           "-boot-info-table", "-graft-points",
-                                           "-iso-level", "4", "-pad",
-                                           "-allow-leading-dots", "-l",
-                                           "-o", self.output_iso,
-                                           self.iso_contents])
+        self._run_genisoimage(["-r", "-V", "Custom",
+                               "-J", "-no-emul-boot",
+                               "-b", "boot/" + self.tdl.arch + "/loader/isolinux.bin",
+                               "-c", "boot/" + self.tdl.arch + "/loader/boot.cat",
+                               "-boot-load-size", "4",
+                               "-boot-info-table", "-graft-points",
+                               "-iso-level", "4", "-pad",
+                               "-allow-leading-dots", "-l",
+                               "-o", self.output_iso,
+                               self.iso_contents])
 
     def install(self, timeout=None, force=False):
         """
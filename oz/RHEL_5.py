@@ -20,7 +20,6 @@ RHEL-5 installation
 """
 
 import re
-import os
 
 import oz.ozutil
 import oz.RedHat
@@ -42,19 +41,6 @@ class RHEL5Guest(oz.RedHat.RedHatCDYumGuest):
 
         self.auto = auto
 
-    def _modify_iso(self):
-        """
-        Method to make the boot ISO auto-boot with appropriate parameters.
-        """
-        self._copy_kickstart(os.path.join(self.iso_contents, "ks.cfg"))
-
-        initrdline = "  append initrd=initrd.img ks=cdrom:/ks.cfg method="
-        if self.tdl.installtype == "url":
-            initrdline += self.url + "\n"
-        else:
-            initrdline += "cdrom:/dev/cdrom\n"
-        self._modify_isolinux(initrdline)
-
     def _check_pvd(self):
         """
         Method to ensure that boot ISO is a DVD (we cannot use boot CDs to
@@ -19,8 +19,6 @@
 RHEL-6 installation
 """
 
-import os
-
 import oz.ozutil
 import oz.RedHat
 import oz.OzException
@@ -38,18 +36,16 @@ class RHEL6Guest(oz.RedHat.RedHatCDYumGuest):
 
         self.auto = auto
 
-    def _modify_iso(self):
+    def _boot_args(self, ks):
         """
-        Method to modify the ISO for autoinstallation.
+        Method to return the kernel command line arguments that start an
+        automated install with the kickstart at ks, and tell the installer
+        where to install from.
         """
-        self._copy_kickstart(os.path.join(self.iso_contents, "ks.cfg"))
-
-        initrdline = "  append initrd=initrd.img ks=cdrom:/ks.cfg"
+        args = "ks=" + ks
         if self.tdl.installtype == "url":
-            initrdline += " repo=" + self.url + "\n"
-        else:
-            initrdline += "\n"
-        self._modify_isolinux(initrdline)
+            args += " repo=" + self.url
+        return args
 
 def get_class(tdl, config, auto, output_disk=None, netdev=None, diskbus=None,
               macaddress=None):
@@ -20,7 +20,6 @@ RHL installation
 """
 
 import re
-import os
 import shutil
 
 import oz.ozutil
@@ -45,14 +44,10 @@ class RHL9Guest(oz.RedHat.RedHatCDGuest):
         if self.tdl.arch != "i386":
             raise oz.OzException.OzException("Invalid arch " + self.tdl.arch + "for RHL guest")
 
-    def _modify_iso(self):
+    def _render_auto_file(self, outname):
         """
-        Method to modify the ISO for autoinstallation.
+        Method to write the kickstart for the install to outname.
         """
-        self.log.debug("Putting the kickstart in place")
-
-        outname = os.path.join(self.iso_contents, "ks.cfg")
-
         if self.auto is None:
             def _kssub(line):
                 """
@@ -73,8 +68,13 @@ class RHL9Guest(oz.RedHat.RedHatCDGuest):
         else:
             shutil.copy(self.auto, outname)
 
-        initrdline = "  append initrd=initrd.img ks=cdrom:/ks.cfg method=" + self.url + "\n"
-        self._modify_isolinux(initrdline)
+    def _boot_args(self, ks):
+        """
+        Method to return the kernel command line arguments that start an
+        automated install with the kickstart at ks, and tell the installer
+        where to install from.
+        """
+        return "ks=" + ks + " method=" + self.url
 
 class RHL70and71and72and73and8Guest(oz.RedHat.RedHatFDGuest):
     """
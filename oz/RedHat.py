@@ -32,6 +32,7 @@ import guestfs
 import pycurl
 
 import oz.Guest
+import oz.ISO
 import oz.ozutil
 import oz.OzException
 import oz.linuxutil
@@ -81,6 +82,7 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
                                         self.tdl.distro + self.tdl.update + self.tdl.arch + "-kernel")
         self.initrdcache = os.path.join(self.data_dir, "kernels",
                                         self.tdl.distro + self.tdl.update + self.tdl.arch + "-ramdisk")
+        self.modified_initrd_cache = self.initrdcache + "-oz"
 
         self.cmdline = "method=" + self.url + " ks=file:/ks.cfg"
 
@@ -93,20 +95,57 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.debug("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-T", "-J",
-                                           "-V", "Custom", "-no-emul-boot",
-                                           "-b", "isolinux/isolinux.bin",
-                                           "-c", "isolinux/boot.cat",
-                                           "-boot-load-size", "4",
-                                           "-boot-info-table", "-v", "-v",
-                                           "-o", self.output_iso,
-                                           self.iso_contents])
+        self._run_genisoimage(["-r", "-T", "-J",
+                               "-V", "Custom", "-no-emul-boot",
+                               "-b", "isolinux/isolinux.bin",
+                               "-c", "isolinux/boot.cat",
+                               "-boot-load-size", "4",
+                               "-boot-info-table", "-v", "-v",
+                               "-o", self.output_iso,
+                               self.iso_contents])
 
     def _check_iso_tree(self, customize_or_icicle):
         kernel = os.path.join(self.iso_contents, "isolinux", "vmlinuz")
         if not os.path.exists(kernel):
             raise oz.OzException.OzException("Fedora/Red Hat installs can only be done using a boot.iso (netinst) or DVD image (LiveCDs are not supported)")
 
+    def _modified_iso_files(self):
+        """
+        Method to return the files on a RedHat style ISO that are changed in
+        place: the isolinux configuration and boot image, and the kickstart.
+        """
+        return ["isolinux/isolinux.cfg", "isolinux/isolinux.bin", "ks.cfg"]
+
+    def _cdrom_kickstart(self):
+        """
+        Method to return where the installer finds the kickstart on the
+        modified ISO.
+        """
+        return "cdrom:/ks.cfg"
+
+    def _boot_args(self, ks):
+        """
+        Method to return the kernel command line arguments that start an
+        automated install with the kickstart at ks (for instance
+        cdrom:/ks.cfg), and tell the installer where to install from.
+        """
+        args = "ks=" + ks + " method="
+        if self.tdl.installtype == "url":
+            args += self.url
+        else:
+            args += "cdrom:/dev/cdrom"
+        return args
+
+    def _modify_iso(self):
+        """
+        Method to make the boot ISO auto-boot with appropriate parameters.
+        """
+        self.log.debug("Putting the kickstart in place")
+        self._render_auto_file(os.path.join(self.iso_contents, "ks.cfg"))
+
+        initrdline = "  append initrd=initrd.img " + self._boot_args(self._cdrom_kickstart()) + "\n"
+        self._modify_isolinux(initrdline)
+
     def _modify_isolinux(self, initrdline):
         """
         Method to modify the isolinux.cfg file on a RedHat style CD.
@@ -146,6 +185,57 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
         else:
             shutil.copy(self.auto, outname)
 
+    def _render_auto_file(self, outname):
+        """
+        Method to write the kickstart for the install to outname.
+        """
+        self._copy_kickstart(outname)
+
+    def _generate_side_media(self):
+        """
+        Method to generate a floppy holding the kickstart.  The installer is
+        booted directly with the kernel and initrd from the original ISO,
+        and pointed at the kickstart on the floppy, so this is only done for
+        versions that support direct kernel boot.
+        """
+        if self.initrdtype is None:
+            return False
+
+        iso = oz.ISO.ISO9660Image(self.orig_iso)
+        try:
+            kernel = iso.lookup("isolinux/vmlinuz")
+            initrd = iso.lookup("isolinux/initrd.img")
+            if kernel is None or initrd is None:
+                return False
+
+            try:
+                for record, dest in [(kernel, self.kernelfname),
+                                     (initrd, self.initrdfname)]:
+                    oz.ozutil.unlink_if_exists(dest)
+                    iso.extract_file(record, dest, 0o644)
+
+                oz.ozutil.mkdir_p(self.icicle_tmp)
+                kspath = os.path.join(self.icicle_tmp, "ks.cfg")
+                self._render_auto_file(kspath)
+                try:
+                    self._create_side_floppy({kspath: "ks.cfg"})
+                finally:
+                    os.unlink(kspath)
+            except:
+                # a kernel and initrd left behind would make the install
+                # boot them instead of the modified ISO
+                oz.ozutil.unlink_if_exists(self.kernelfname)
+                oz.ozutil.unlink_if_exists(self.initrdfname)
+                raise
+        finally:
+            iso.close()
+
+        # the kickstart on the floppy is the only difference from the
+        # modified ISO; the installer still has to be told where to install
+        # from
+        self.side_media_cmdline = self._boot_args("hd:fd0:/ks.cfg")
+        return True
+
     def _get_service_runlevel_link(self, g_handle, service):
         """
         Method to find the runlevel link(s) for a service based on the name
@@ -529,8 +619,8 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
 
         # first we check if the .treeinfo exists; this throws an exception if
         # it is missing
-        info = oz.ozutil.http_get_header(treeinfourl)
-        if info['HTTP-Code'] != 200:
+        info = self.http.get_header(treeinfourl)
+        if info['http-code'] != 200:
             raise oz.OzException.OzException("Could not find %s" % (treeinfourl))
 
         treeinfo = os.path.join(self.icicle_tmp, "treeinfo")
@@ -540,8 +630,8 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
         fp = os.fdopen(treeinfofd)
         try:
             self.log.debug("Trying to get treeinfo from " + treeinfourl)
-            oz.ozutil.http_download_file(treeinfourl, treeinfofd,
-                                         False, self.log)
+            self.http.download_file(treeinfourl, treeinfofd, False,
+                                    self.log)
 
             # if we made it here, the .treeinfo existed.  Parse it and
             # find out the location of the vmlinuz and initrd
@@ -633,9 +723,10 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
         finally:
             os.unlink(ext2file)
 
-    def _initrd_inject_ks(self, fetchurl, force_download):
+    def _get_original_kernel_and_initrd(self, fetchurl, force_download):
         """
-        Internal method to download and inject a kickstart into an initrd.
+        Internal method to download the original kernel and initrd of an
+        install tree into the kernel cache.
         """
         # we first see if we can use direct kernel booting, as that is
         # faster than downloading the ISO
@@ -661,18 +752,30 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
                                            kernel.lstrip('/')]),
                                  self.kernelcache, force_download)
 
-        try:
-            self._get_original_media('/'.join([self.url.rstrip('/'),
-                                               initrd.lstrip('/')]),
-                                     self.initrdcache, force_download)
-        except:
-            os.unlink(self.kernelfname)
-            raise
+        self._get_original_media('/'.join([self.url.rstrip('/'),
+                                           initrd.lstrip('/')]),
+                                 self.initrdcache, force_download)
+
+    def _initrd_inject_ks(self, fetchurl, force_download):
+        """
+        Internal method to download and inject a kickstart into an initrd.
+        """
+        self._get_original_kernel_and_initrd(fetchurl, force_download)
+
+        cached = None
+        if self.cache_modified_media:
+            cached = self._modified_media_cache_path(self.modified_initrd_cache,
+                                                     [self.kernelcache,
+                                                      self.initrdcache])
 
         # if we made it here, then we can copy the kernel into place
         shutil.copyfile(self.kernelcache, self.kernelfname)
 
         try:
+            if cached is not None and not force_download and os.access(cached, os.F_OK):
+                self._use_cached_modified_media(cached, self.initrdfname)
+                return
+
             kspath = os.path.join(self.icicle_tmp, self.stock_ks)
             self._copy_kickstart(kspath)
 
@@ -685,6 +788,9 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
                     raise oz.OzException.OzException("Invalid initrdtype, this is a programming error")
             finally:
                 os.unlink(kspath)
+
+            if cached is not None:
+                self._cache_modified_media(self.initrdfname, cached)
         except:
             os.unlink(self.kernelfname)
             raise
@@ -719,13 +825,36 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
         return self._iso_generate_install_media(fetchurl, force_download,
                                                 customize_or_icicle)
 
+    def prefetch_media(self, force_download=False):
+        """
+        Method to fetch and verify the original install media for RedHat
+        based operating systems ahead of time.  For URL installs this is
+        the kernel and initrd if direct kernel boot is possible, and the
+        boot.iso otherwise.
+        """
+        fetchurl = self.url
+        if self.tdl.installtype == 'url':
+            fetchurl += "/images/boot.iso"
+
+            if self.initrdtype is not None:
+                try:
+                    return self._get_original_kernel_and_initrd(self.url,
+                                                                force_download)
+                except Exception as err:
+                    self.log.debug("Could not fetch kernel and initrd, fetching boot.iso instead")
+                    self.log.debug(err)
+
+        return self._iso_prefetch_media(fetchurl, force_download)
+
     def cleanup_install(self):
         """
         Method to cleanup any transient install data.
         """
         self.log.info("Cleaning up after install")
 
-        for fname in [self.output_iso, self.initrdfname, self.kernelfname]:
+        for fname in [self.output_iso, self.initrdfname, self.kernelfname,
+                      self.side_media_path + ".img",
+                      self.side_media_path + ".iso"]:
             try:
                 os.unlink(fname)
             except:
@@ -748,6 +877,10 @@ class RedHatCDYumGuest(RedHatCDGuest):
     """
     Class for RedHat-based CD guests with yum support.
     """
+    # anaconda fetches the repository metadata first, and needs byte ranges
+    _mirror_probe_path = "repodata/repomd.xml"
+    _mirror_requires_ranges = True
+
     def _check_url(self, iso=True, url=True):
         """
         Method to check if a URL specified by the user is one that will work
@@ -789,10 +922,10 @@ class RedHatCDYumGuest(RedHatCDGuest):
             # supports byte ranges, fail.
             count = 5
             while count > 0:
-                info = oz.ozutil.http_get_header(url, redirect=False)
+                info = self.http.get_header(url, redirect=False)
 
-                if 'Accept-Ranges' in info and info['Accept-Ranges'] == "none":
-                    if url == info['Redirect-URL']:
+                if 'accept-ranges' in info and info['accept-ranges'] == "none":
+                    if url == info['redirect-url']:
                         # optimization; if the URL we resolved to is exactly
                         # the same as what we started with, this is *not*
                         # a redirect, and we should fail immediately
@@ -802,8 +935,8 @@ class RedHatCDYumGuest(RedHatCDGuest):
                     count -= 1
                     continue
 
-                if 'Redirect-URL' in info and info['Redirect-URL'] is not None:
-                    url = info['Redirect-URL']
+                if 'redirect-url' in info and info['redirect-url'] is not None:
+                    url = info['redirect-url']
                 break
 
             if count == 0:
@@ -854,7 +987,7 @@ class RedHatCDYumGuest(RedHatCDGuest):
             """
             pass
 
-        crl = pycurl.Curl()
+        crl = self.http.get_handle()
         crl.setopt(crl.URL, full_url)
         crl.setopt(crl.CONNECTTIMEOUT, 5)
         crl.setopt(crl.WRITEFUNCTION, _writefunc)
@@ -887,7 +1020,7 @@ class RedHatCDYumGuest(RedHatCDGuest):
             self.log.debug("Unable to route to the repo host from here, and SSH tunnel will never be established")
             self.log.debug(err)
             host = False
-        crl.close()
+        self.http.put_handle(crl)
 
         # now check if we can access it remotely
         try:
@@ -1228,16 +1361,10 @@ class RedHatFDGuest(oz.Guest.FDGuest):
         if self.ks_file is None:
             self.ks_file = oz.ozutil.generate_full_auto_path(self.ks_name)
 
-    def _modify_floppy(self):
+    def _render_auto_file(self, outname):
         """
-        Method to make the floppy auto-boot with appropriate parameters.
+        Method to write the kickstart for the install to outname.
         """
-        oz.ozutil.mkdir_p(self.floppy_contents)
-
-        self.log.debug("Putting the kickstart in place")
-
-        output_ks = os.path.join(self.floppy_contents, "ks.cfg")
-
         if self.ks_file == oz.ozutil.generate_full_auto_path(self.ks_name):
             def _kssub(line):
                 """
@@ -1251,9 +1378,20 @@ class RedHatFDGuest(oz.Guest.FDGuest):
                 else:
                     return line
 
-            oz.ozutil.copy_modify_file(self.ks_file, output_ks, _kssub)
+            oz.ozutil.copy_modify_file(self.ks_file, outname, _kssub)
         else:
-            shutil.copy(self.ks_file, output_ks)
+            shutil.copy(self.ks_file, outname)
+
+    def _modify_floppy(self):
+        """
+        Method to make the floppy auto-boot with appropriate parameters.
+        """
+        oz.ozutil.mkdir_p(self.floppy_contents)
+
+        self.log.debug("Putting the kickstart in place")
+
+        output_ks = os.path.join(self.floppy_contents, "ks.cfg")
+        self._render_auto_file(output_ks)
 
         oz.ozutil.subprocess_check_output(["mcopy", "-i", self.output_floppy,
                                            output_ks, "::KS.CFG"])
@@ -1291,23 +1429,39 @@ class RedHatFDGuest(oz.Guest.FDGuest):
         """
         self.log.info("Generating install media")
 
-        if not force_download:
-            if os.access(self.jeos_filename, os.F_OK):
-                # if we found a cached JEOS, we don't need to do anything here;
-                # we'll copy the JEOS itself later on
-                return
-            elif os.access(self.modified_floppy_cache, os.F_OK):
-                self.log.info("Using cached modified media")
-                shutil.copyfile(self.modified_floppy_cache, self.output_floppy)
-                return
+        if not force_download and os.access(self.jeos_filename, os.F_OK):
+            # if we found a cached JEOS, we don't need to do anything here;
+            # we'll copy the JEOS itself later on
+            return
 
         self._get_original_floppy(self.url + "/images/bootnet.img",
                                   force_download)
+
+        cached = None
+        if self.cache_modified_media:
+            cached = self._modified_media_cache_path(self.modified_floppy_cache,
+                                                     [self.orig_floppy])
+            if not force_download and os.access(cached, os.F_OK):
+                self._use_cached_modified_media(cached, self.output_floppy)
+                return
+
         self._copy_floppy()
         try:
             self._modify_floppy()
-            if self.cache_modified_media:
-                self.log.info("Caching modified media for future use")
-                shutil.copyfile(self.output_floppy, self.modified_floppy_cache)
+            if cached is not None:
+                self._cache_modified_media(self.output_floppy, cached)
         finally:
             self._cleanup_floppy()
+
+    def prefetch_media(self, force_download=False):
+        """
+        Method to fetch and verify the original floppy for RedHat based
+        operating systems ahead of time.  Nothing is fetched if the install
+        would use a cached JEOS anyway.
+        """
+        if not force_download and os.access(self.jeos_filename, os.F_OK):
+            self.log.info("Found cached JEOS, not fetching media")
+            return
+
+        self._get_original_floppy(self.url + "/images/bootnet.img",
+                                  force_download)
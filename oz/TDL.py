@@ -147,11 +147,16 @@ class TDL(object):
     arch         - The architecture of the operating system this TDL
                    represents. Currently this must be one of "i386" or
                    "x86_64".
+                   (distro, update, and arch may be None for an "iso"
+                   install, if they are to be detected from the ISO)
     key          - The installation key necessary to install this operating
                    system (optional).
     description  - A free-form description of this TDL (optional).
     installtype  - The method to be used to install this operating system.
                    Currently this must be one of "url" or "iso".
+    mirrors      - A list of alternative URLs for a "url" install (optional).
+    metalink     - The URL of a metalink or mirrorlist describing more
+                   mirrors for a "url" install (optional).
     packages     - A list of Package objects describing the packages to be
                    installed on the operating system.  This list may be
                    empty.
@@ -180,14 +185,18 @@ class TDL(object):
 
         self.name = _xml_get_value(self.doc, '/template/name', 'template name')
 
-        self.distro = _xml_get_value(self.doc, '/template/os/name', 'OS name')
+        # the OS name, version, and architecture may be left out for ISO
+        # installs, in which case oz.GuestFactory detects them from the ISO;
+        # they are checked for the other install types below
+        self.distro = _xml_get_value(self.doc, '/template/os/name', 'OS name',
+                                     optional=True)
 
         self.update = _xml_get_value(self.doc, '/template/os/version',
-                                     'OS version')
+                                     'OS version', optional=True)
 
         self.arch = _xml_get_value(self.doc, '/template/os/arch',
-                                   'OS architecture')
-        if self.arch != "i386" and self.arch != "x86_64":
+                                   'OS architecture', optional=True)
+        if self.arch is not None and self.arch != "i386" and self.arch != "x86_64":
             raise oz.OzException.OzException("Architecture must be one of 'i386' or 'x86_64'")
 
         self.key = _xml_get_value(self.doc, '/template/os/key', 'OS key',
@@ -214,9 +223,22 @@ class TDL(object):
         self.iso_sha1_url = None
         self.iso_sha256_url = None
 
+        # likewise, alternative mirrors are only supported for URL installs
+        self.mirrors = []
+        self.metalink = None
+
         if self.installtype == "url":
             self.url = _xml_get_value(self.doc, '/template/os/install/url',
                                       'OS install URL')
+            for mirror in self.doc.xpathEval('/template/os/install/mirror'):
+                mirrorurl = mirror.getContent().strip()
+                if not mirrorurl:
+                    raise oz.OzException.OzException("OS install mirror must not be empty")
+                self.mirrors.append(mirrorurl)
+            self.metalink = _xml_get_value(self.doc,
+                                           '/template/os/install/metalink',
+                                           'OS install metalink',
+                                           optional=True)
         elif self.installtype == "iso":
             self.iso = _xml_get_value(self.doc, '/template/os/install/iso',
                                       'OS install ISO')
@@ -239,6 +261,13 @@ class TDL(object):
         else:
             raise oz.OzException.OzException("Unknown install type " + self.installtype + " in TDL")
 
+        if self.installtype != "iso":
+            for value, component in [(self.distro, 'OS name'),
+                                     (self.update, 'OS version'),
+                                     (self.arch, 'OS architecture')]:
+                if value is None:
+                    raise oz.OzException.OzException("Failed to find %s in TDL" % (component))
+
         self.rootpw = _xml_get_value(self.doc, '/template/os/rootpw',
                                      "root/Administrator password",
                                      optional=not rootpw_required)
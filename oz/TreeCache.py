@@ -0,0 +1,247 @@
+# Copyright (C) 2013  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Cache of the extracted contents of installation ISOs
+"""
+
+import os
+import time
+import fcntl
+import errno
+import shutil
+import stat
+
+import oz.ozutil
+import oz.OzException
+
+class TreeCache(object):
+    """
+    Class to keep the extracted contents of installation ISOs, one pristine
+    tree per ISO, keyed by the digest of the ISO.  Builds never modify a
+    cached tree; instead each build gets a clone of it with clone(), which
+    is much cheaper than extracting the ISO again.  The files in a cached
+    tree are read-only, since clones share them.  Only max_entries trees are
+    kept; the least recently used ones are removed to make room for new
+    ones.
+    """
+    def __init__(self, cache_dir, max_entries):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock_path = os.path.join(cache_dir, "index.lock")
+        # root can write to read-only files, so when running as root hard
+        # links would not protect the cached trees from the builds
+        self.link_files = os.geteuid() != 0
+
+    def tree_path(self, digest):
+        """
+        Method to return the path to the cached tree of the ISO with the
+        given digest.
+        """
+        return os.path.join(self.cache_dir, digest)
+
+    def _entry_lock_path(self, digest):
+        """
+        Internal method to return the path to the lock file of the cached tree
+        with the given digest.  The lock is held shared while the tree is
+        being cloned, and exclusively while it is being extracted or removed.
+        The lock file is never removed, so that everybody always locks the
+        same file.
+        """
+        return os.path.join(self.cache_dir, digest + ".lock")
+
+    def _read_index(self):
+        """
+        Internal method to read the index, which records when each tree was
+        last used.
+        """
+        index = oz.ozutil.read_json_file(self.index_path)
+        if index is None:
+            index = {}
+        return index
+
+    def _touch(self, digest):
+        """
+        Internal method to record that the tree with the given digest was
+        just used.  Must be called with the index lock held.
+        """
+        index = self._read_index()
+        index[digest] = time.time()
+        oz.ozutil.write_json_file(self.index_path, index)
+
+    def _evict(self, keep):
+        """
+        Internal method to remove the least recently used trees until there
+        are at most max_entries left.  The tree with the digest keep, and
+        trees that are being cloned, are never removed.  Must be called with
+        the index lock held.
+        """
+        index = self._read_index()
+        # trees that were removed behind our back
+        for digest in list(index.keys()):
+            if not os.path.isdir(self.tree_path(digest)):
+                del index[digest]
+
+        for digest in sorted(index, key=lambda d: index[d]):
+            if len(index) <= self.max_entries:
+                break
+            if digest == keep:
+                continue
+            lockfd = os.open(self._entry_lock_path(digest), os.O_RDWR|os.O_CREAT)
+            try:
+                try:
+                    fcntl.lockf(lockfd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+                except (IOError, OSError) as err:
+                    if err.errno not in [errno.EACCES, errno.EAGAIN]:
+                        raise
+                    # somebody is cloning this tree right now
+                    continue
+                _rmtree_writable(self.tree_path(digest))
+                del index[digest]
+            finally:
+                os.close(lockfd)
+
+        oz.ozutil.write_json_file(self.index_path, index)
+
+    def get(self, digest, populate):
+        """
+        Method to return the path to the cached tree of the ISO with the
+        given digest.  If the tree is not cached yet, populate is called with
+        the path of an empty directory to extract the ISO into, and the
+        result is added to the cache, with all of its files made read-only.
+        """
+        oz.ozutil.mkdir_p(self.cache_dir)
+        tree = self.tree_path(digest)
+
+        entryfd = os.open(self._entry_lock_path(digest), os.O_RDWR|os.O_CREAT)
+        try:
+            # holding the lock of this tree while extracting means that
+            # concurrent builds from the same ISO wait for one extraction
+            # instead of all doing their own, while builds from other ISOs
+            # are not held up
+            fcntl.lockf(entryfd, fcntl.LOCK_EX)
+
+            if not os.path.isdir(tree):
+                tmp = tree + ".tmp"
+                _rmtree_writable(tmp)
+                os.mkdir(tmp)
+                try:
+                    populate(tmp)
+                    _make_files_read_only(tmp)
+                except:
+                    _rmtree_writable(tmp)
+                    raise
+                os.rename(tmp, tree)
+
+            # the index lock is only needed to update the index; the tree
+            # cannot be evicted while we hold its lock
+            lockfd = os.open(self.lock_path, os.O_RDWR|os.O_CREAT)
+            try:
+                fcntl.lockf(lockfd, fcntl.LOCK_EX)
+                self._touch(digest)
+                if self.max_entries is not None:
+                    self._evict(digest)
+            finally:
+                os.close(lockfd)
+        finally:
+            os.close(entryfd)
+
+        return tree
+
+    def clone(self, digest, dest, modified):
+        """
+        Method to populate the existing, empty directory dest with a clone of
+        the cached tree of the ISO with the given digest.  modified is the
+        list of paths, relative to the root of the tree, of the files that
+        will be changed in the clone; those are copied, and every other file
+        is a hard link to the cached tree, so the clone takes almost no time
+        or space.  The hard links are read-only like the cached tree, so
+        writing to a file that is missing from modified fails instead of
+        corrupting the cache.  That only holds when not running as root
+        (see link_files), so as root, or if modified is None (any file might
+        be changed), every file is cloned with clone_file() instead, which
+        shares the data blocks on filesystems that support reflinks, and
+        copies them otherwise.  Copied and cloned files are writable.
+        """
+        tree = self.tree_path(digest)
+        if not self.link_files:
+            modified = None
+        if modified is not None:
+            modified = set([os.path.normpath(path) for path in modified])
+
+        lockfd = os.open(self._entry_lock_path(digest), os.O_RDWR|os.O_CREAT)
+        try:
+            fcntl.lockf(lockfd, fcntl.LOCK_SH)
+            if not os.path.isdir(tree):
+                raise oz.OzException.OzException("Cached ISO contents %s were removed" % (tree))
+            for dirpath, dirnames, filenames in os.walk(tree):
+                relpath = os.path.relpath(dirpath, tree)
+                destdir = os.path.normpath(os.path.join(dest, relpath))
+                if relpath != ".":
+                    os.mkdir(destdir)
+                    shutil.copystat(dirpath, destdir)
+
+                # os.walk() lists symlinks to directories as directories
+                for name in dirnames + filenames:
+                    src = os.path.join(dirpath, name)
+                    target = os.path.join(destdir, name)
+                    if os.path.islink(src):
+                        os.symlink(os.readlink(src), target)
+                    elif os.path.isdir(src):
+                        continue
+                    elif modified is None:
+                        oz.ozutil.clone_file(src, target)
+                        shutil.copystat(src, target)
+                        _make_writable(target)
+                    elif os.path.normpath(os.path.join(relpath, name)) in modified:
+                        shutil.copy2(src, target)
+                        _make_writable(target)
+                    else:
+                        os.link(src, target)
+        finally:
+            os.close(lockfd)
+
+def _make_writable(path):
+    """
+    Function to give the owner of the file at path write permission.
+    """
+    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) | stat.S_IWUSR)
+
+def _make_files_read_only(path):
+    """
+    Function to remove the write permissions of all of the files (but not
+    the directories) in the tree at path.
+    """
+    writable = stat.S_IWUSR|stat.S_IWGRP|stat.S_IWOTH
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            filename = os.path.join(dirpath, name)
+            if os.path.islink(filename):
+                continue
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+            os.chmod(filename, mode & ~writable)
+
+def _rmtree_writable(path):
+    """
+    Function to remove the tree at path, making its directories writable
+    first, if it exists.
+    """
+    if not os.path.lexists(path):
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        os.chmod(dirpath, 0o700)
+    shutil.rmtree(path)
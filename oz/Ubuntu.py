@@ -88,6 +88,7 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
                                         self.tdl.distro + self.tdl.update + self.tdl.arch + "-kernel")
         self.initrdcache = os.path.join(self.data_dir, "kernels",
                                         self.tdl.distro + self.tdl.update + self.tdl.arch + "-ramdisk")
+        self.modified_initrd_cache = self.initrdcache + "-oz"
 
         self.cmdline = "priority=critical locale=en_US"
 
@@ -123,6 +124,21 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         else:
             shutil.copy(self.preseed_file, outname)
 
+    def _render_auto_file(self, outname):
+        """
+        Method to write the preseed file for the install to outname.
+        """
+        self._copy_preseed(outname)
+
+    def _modified_iso_files(self):
+        """
+        Method to return the files on the Ubuntu ISO that are changed in
+        place.  Older ISOs without an isolinux directory get a new one, so
+        the files at the root of the ISO are only read.
+        """
+        return ["isolinux/isolinux.cfg", "isolinux/isolinux.bin",
+                "preseed/customiso.seed"]
+
     def _modify_iso(self):
         """
         Method to make the boot ISO auto-boot with appropriate parameters.
@@ -169,14 +185,14 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.info("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-l", "-no-emul-boot",
-                                           "-b", "isolinux/isolinux.bin",
-                                           "-c", "isolinux/boot.cat",
-                                           "-boot-load-size", "4",
-                                           "-cache-inodes", "-boot-info-table",
-                                           "-v", "-v", "-o", self.output_iso,
-                                           self.iso_contents])
+        self._run_genisoimage(["-r", "-V", "Custom",
+                               "-J", "-l", "-no-emul-boot",
+                               "-b", "isolinux/isolinux.bin",
+                               "-c", "isolinux/boot.cat",
+                               "-boot-load-size", "4",
+                               "-cache-inodes", "-boot-info-table",
+                               "-v", "-v", "-o", self.output_iso,
+                               self.iso_contents])
 
     def install(self, timeout=None, force=False):
         """
@@ -603,8 +619,8 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
 
         # first we check if the txt.cfg exists; this throws an exception if
         # it is missing
-        info = oz.ozutil.http_get_header(txtcfgurl)
-        if info['HTTP-Code'] != 200:
+        info = self.http.get_header(txtcfgurl)
+        if info['http-code'] != 200:
             raise oz.OzException.OzException("Could not find %s" % (txtcfgurl))
 
         txtcfg = os.path.join(self.icicle_tmp, "txt.cfg")
@@ -614,7 +630,7 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         fp = os.fdopen(txtcfgfd)
         try:
             self.log.debug("Trying to get txt.cfg from " + txtcfgurl)
-            oz.ozutil.http_download_file(txtcfgurl, txtcfgfd, False, self.log)
+            self.http.download_file(txtcfgurl, txtcfgfd, False, self.log)
 
             # if we made it here, the txt.cfg existed.  Parse it and
             # find out the location of the kernel and ramdisk
@@ -672,9 +688,10 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         finally:
             os.unlink(extrafname)
 
-    def _initrd_inject_preseed(self, fetchurl, force_download):
+    def _get_original_kernel_and_initrd(self, fetchurl, force_download):
         """
-        Internal method to download and inject a preseed file into an initrd.
+        Internal method to download the original kernel and initrd of an
+        install tree into the kernel cache.
         """
         # we first see if we can use direct kernel booting, as that is
         # faster than downloading the ISO
@@ -700,18 +717,30 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
                                            kernel.lstrip('/')]),
                                  self.kernelcache, force_download)
 
-        try:
-            self._get_original_media('/'.join([self.url.rstrip('/'),
-                                               initrd.lstrip('/')]),
-                                     self.initrdcache, force_download)
-        except:
-            os.unlink(self.kernelfname)
-            raise
+        self._get_original_media('/'.join([self.url.rstrip('/'),
+                                           initrd.lstrip('/')]),
+                                 self.initrdcache, force_download)
+
+    def _initrd_inject_preseed(self, fetchurl, force_download):
+        """
+        Internal method to download and inject a preseed file into an initrd.
+        """
+        self._get_original_kernel_and_initrd(fetchurl, force_download)
+
+        cached = None
+        if self.cache_modified_media:
+            cached = self._modified_media_cache_path(self.modified_initrd_cache,
+                                                     [self.kernelcache,
+                                                      self.initrdcache])
 
         # if we made it here, then we can copy the kernel into place
         shutil.copyfile(self.kernelcache, self.kernelfname)
 
         try:
+            if cached is not None and not force_download and os.access(cached, os.F_OK):
+                self._use_cached_modified_media(cached, self.initrdfname)
+                return
+
             preseedpath = os.path.join(self.icicle_tmp, "preseed.cfg")
             self._copy_preseed(preseedpath)
 
@@ -719,6 +748,9 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
                 self._create_cpio_initrd(preseedpath)
             finally:
                 os.unlink(preseedpath)
+
+            if cached is not None:
+                self._cache_modified_media(self.initrdfname, cached)
         except:
             os.unlink(self.kernelfname)
             raise
@@ -752,6 +784,26 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         return self._iso_generate_install_media(fetchurl, force_download,
                                                 customize_or_icicle)
 
+    def prefetch_media(self, force_download=False):
+        """
+        Method to fetch and verify the original install media for Ubuntu
+        based operating systems ahead of time.  For URL installs this is the
+        kernel and initrd if direct kernel boot is possible, and the
+        mini.iso otherwise.
+        """
+        fetchurl = self.url
+        if self.tdl.installtype == 'url':
+            fetchurl += "/mini.iso"
+
+            try:
+                return self._get_original_kernel_and_initrd(self.url,
+                                                            force_download)
+            except Exception as err:
+                self.log.debug("Could not fetch kernel and initrd, fetching mini.iso instead")
+                self.log.debug(err)
+
+        return self._iso_prefetch_media(fetchurl, force_download)
+
     def customize(self, libvirt_xml):
         """
         Method to customize the operating system after installation.
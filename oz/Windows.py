@@ -19,7 +19,7 @@
 Windows installation
 """
 
-import random
+import hashlib
 import re
 import os
 import libxml2
@@ -66,16 +66,15 @@ class Windows_v5(Windows):
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.debug("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage",
-                                           "-b", "cdboot/boot.bin",
-                                           "-no-emul-boot", "-boot-load-seg",
-                                           "1984", "-boot-load-size", "4",
-                                           "-iso-level", "2", "-J", "-l", "-D",
-                                           "-N", "-joliet-long",
-                                           "-relaxed-filenames", "-v", "-v",
-                                           "-V", "Custom",
-                                           "-o", self.output_iso,
-                                           self.iso_contents])
+        self._run_genisoimage(["-b", "cdboot/boot.bin",
+                               "-no-emul-boot", "-boot-load-seg",
+                               "1984", "-boot-load-size", "4",
+                               "-iso-level", "2", "-J", "-l", "-D",
+                               "-N", "-joliet-long",
+                               "-relaxed-filenames", "-v", "-v",
+                               "-V", "Custom",
+                               "-o", self.output_iso,
+                               self.iso_contents])
 
     def generate_diskimage(self, size=10, force=False):
         """
@@ -100,6 +99,14 @@ class Windows_v5(Windows):
             createpart = True
         return self._internal_generate_diskimage(size, force, createpart)
 
+    def _modified_iso_files(self):
+        """
+        Method to return the files on the Windows ISO that are changed in
+        place.  The boot image is extracted from the El Torito catalog into
+        cdboot.
+        """
+        return ["cdboot/boot.bin", self.winarch + "/winnt.sif"]
+
     def _modify_iso(self):
         """
         Method to make the boot ISO auto-boot with appropriate parameters.
@@ -110,12 +117,20 @@ class Windows_v5(Windows):
         self._geteltorito(self.orig_iso, os.path.join(self.iso_contents,
                                                       "cdboot", "boot.bin"))
 
-        outname = os.path.join(self.iso_contents, self.winarch, "winnt.sif")
+        self._render_auto_file(os.path.join(self.iso_contents, self.winarch,
+                                            "winnt.sif"))
 
+    def _render_auto_file(self, outname):
+        """
+        Method to write the siffile for the install to outname.
+        """
         if self.siffile == oz.ozutil.generate_full_auto_path("windows-" + self.tdl.update + "-jeos.sif"):
             # if this is the oz default siffile, we modify certain parameters
-            # to make installation succeed
-            computername = "OZ" + str(random.randrange(1, 900000))
+            # to make installation succeed.  The computer name is derived
+            # from the template name, rather than picked at random, so that
+            # the siffile, and thus the cached modified media, is the same
+            # for every build of a template
+            computername = "OZ" + str(int(hashlib.sha1(self.tdl.name.encode('utf-8')).hexdigest(), 16) % 899999 + 1)
 
             def _sifsub(line):
                 """
@@ -139,6 +154,20 @@ class Windows_v5(Windows):
             # choices; the user gets to keep both pieces if something breaks
             shutil.copy(self.siffile, outname)
 
+    def _generate_side_media(self):
+        """
+        Method to generate a floppy holding the siffile.  Windows setup reads
+        winnt.sif from the floppy when it boots from the CD.
+        """
+        oz.ozutil.mkdir_p(self.icicle_tmp)
+        siffile = os.path.join(self.icicle_tmp, "winnt.sif")
+        self._render_auto_file(siffile)
+        try:
+            self._create_side_floppy({siffile: "WINNT.SIF"})
+        finally:
+            os.unlink(siffile)
+        return True
+
     def install(self, timeout=None, force=False):
         """
         Method to run the operating system installation.
@@ -172,15 +201,21 @@ class Windows_v6(Windows):
         self.log.debug("Generating new ISO")
         # NOTE: Windows 2008 is very picky about which arguments to genisoimage
         # will generate a bootable CD, so modify these at your own risk
-        oz.ozutil.subprocess_check_output(["genisoimage",
-                                           "-b", "cdboot/boot.bin",
-                                           "-no-emul-boot", "-c", "BOOT.CAT",
-                                           "-iso-level", "2", "-J", "-l", "-D",
-                                           "-N", "-joliet-long",
-                                           "-relaxed-filenames", "-v", "-v",
-                                           "-V", "Custom", "-udf",
-                                           "-o", self.output_iso,
-                                           self.iso_contents])
+        self._run_genisoimage(["-b", "cdboot/boot.bin",
+                               "-no-emul-boot", "-c", "BOOT.CAT",
+                               "-iso-level", "2", "-J", "-l", "-D",
+                               "-N", "-joliet-long",
+                               "-relaxed-filenames", "-v", "-v",
+                               "-V", "Custom", "-udf",
+                               "-o", self.output_iso,
+                               self.iso_contents])
+
+    def _modified_iso_files(self):
+        """
+        Method to return the files on the Windows ISO that are changed in
+        place.
+        """
+        return ["cdboot/boot.bin", "autounattend.xml"]
 
     def _modify_iso(self):
         """
@@ -192,8 +227,13 @@ class Windows_v6(Windows):
         self._geteltorito(self.orig_iso, os.path.join(self.iso_contents,
                                                       "cdboot", "boot.bin"))
 
-        outname = os.path.join(self.iso_contents, "autounattend.xml")
+        self._render_auto_file(os.path.join(self.iso_contents,
+                                            "autounattend.xml"))
 
+    def _render_auto_file(self, outname):
+        """
+        Method to write the unattend file for the install to outname.
+        """
         if self.unattendfile == oz.ozutil.generate_full_auto_path("windows-" + self.tdl.update + "-jeos.xml"):
             # if this is the oz default unattend file, we modify certain
             # parameters to make installation succeed
@@ -220,6 +260,21 @@ class Windows_v6(Windows):
             # breaks
             shutil.copy(self.unattendfile, outname)
 
+    def _generate_side_media(self):
+        """
+        Method to generate a CD holding the unattend file.  Windows setup
+        looks for autounattend.xml at the root of every removable drive.
+        """
+        oz.ozutil.mkdir_p(self.icicle_tmp)
+        unattendfile = os.path.join(self.icicle_tmp, "autounattend.xml")
+        self._render_auto_file(unattendfile)
+        try:
+            self._create_side_iso({unattendfile: "autounattend.xml"},
+                                  "OZUNATTEND")
+        finally:
+            os.unlink(unattendfile)
+        return True
+
     def install(self, timeout=None, force=False):
         internal_timeout = timeout
         if internal_timeout is None:
@@ -35,3 +35,6 @@ guest.generate_install_media()
 guest.generate_diskimage()
 guest.install()
 """
+
+# keep this in sync with VERSION in setup.py
+__version__ = '0.11.0'
@@ -24,8 +24,14 @@ import random
 import subprocess
 import tempfile
 import errno
+import fcntl
 import stat
+import struct
 import shutil
+import json
+import codecs
+import hashlib
+import threading
 import pycurl
 try:
     import configparser
@@ -72,10 +78,68 @@ def executable_exists(program):
 
     raise Exception("Could not find %s" % (program))
 
+# whence values for lseek() to find the data and the holes in a sparse file,
+# from linux/fs.h; python only has os.SEEK_DATA and os.SEEK_HOLE from 3.3 on
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+def _data_extents(fd, size):
+    """
+    Function to return the (offset, length) extents of file descriptor fd
+    that contain data, skipping over the holes.  If the filesystem cannot
+    tell where the holes are, the whole file is returned as one extent.
+    """
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # nothing but a hole from offset to the end of the file
+                break
+            if err.errno not in [errno.EINVAL, errno.EOPNOTSUPP]:
+                raise
+            return [(0, size)]
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        extents.append((start, end - start))
+        offset = end
+    return extents
+
+def _copy_file_range(infd, outfd, offset, count):
+    """
+    Function to copy count bytes at offset in file descriptor infd to the
+    same offset in file descriptor outfd.  This uses copy_file_range(),
+    which lets the filesystem share the data blocks or copy them without
+    going through userspace, where it is available.  Returns False if
+    copy_file_range() cannot be used for these files, in which case nothing
+    was copied.
+    """
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    done = 0
+    while done < count:
+        try:
+            copied = os.copy_file_range(infd, outfd, count - done,
+                                        offset + done, offset + done)
+        except OSError as err:
+            if done == 0 and err.errno in [errno.EXDEV, errno.ENOSYS,
+                                           errno.EINVAL, errno.EOPNOTSUPP]:
+                return False
+            raise
+        if copied == 0:
+            raise Exception("Unexpected end of file while copying")
+        done += copied
+    return True
+
 def copyfile_sparse(src, dest):
     """
-    Function to copy a file sparsely if possible.  The logic here is
-    all taken from coreutils cp, specifically the 'sparse_copy' function.
+    Function to copy a file sparsely if possible.  On filesystems that
+    support reflinks, dest simply shares the data blocks of src.  Otherwise
+    only the extents of src that contain data are copied, and blocks in
+    them that are all zeros are skipped, so they become holes in dest.  The
+    data is copied with copy_file_range() where possible, and with
+    sendfile() or read() and write() otherwise.
     """
     if src is None:
         raise Exception("Source of copy cannot be None")
@@ -88,40 +152,69 @@ def copyfile_sparse(src, dest):
     if os.path.exists(dest) and os.path.samefile(src, dest):
         raise Exception("Source '%s' and dest '%s' are the same file" % (src, dest))
 
-    base = os.path.basename(dest)
-    if not os.path.exists(base):
+    base = os.path.dirname(dest)
+    if base and not os.path.exists(base):
         mkdir_p(base)
 
     src_fd = os.open(src, os.O_RDONLY)
-    dest_fd = os.open(dest, os.O_WRONLY|os.O_CREAT|os.O_TRUNC)
-
-    sb = os.fstat(src_fd)
-
-    # See io_blksize() in coreutils for an explanation of why 32*1024
-    buf_size = max(32*1024, sb.st_blksize)
-
-    size = sb.st_size
-    destlen = 0
-    while size != 0:
-        buf = os.read(src_fd, min(buf_size, size))
-        if len(buf) == 0:
-            break
-
-        buflen = len(buf)
-        if buf == r'\0'*buflen:
-            os.lseek(dest_fd, buflen, os.SEEK_CUR)
-        else:
-            # FIXME: check out the python implementation of write, we might have
-            # to handle EINTR here
-            os.write(dest_fd, buf)
-
-        destlen += len(buf)
-        size -= len(buf)
-
-    os.ftruncate(dest_fd, destlen)
-
-    os.close(src_fd)
-    os.close(dest_fd)
+    try:
+        dest_fd = os.open(dest, os.O_WRONLY|os.O_CREAT|os.O_TRUNC)
+        try:
+            try:
+                fcntl.ioctl(dest_fd, FICLONE, src_fd)
+                return
+            except (IOError, OSError) as err:
+                if err.errno not in [errno.EOPNOTSUPP, errno.ENOTTY,
+                                     errno.EXDEV, errno.EINVAL,
+                                     errno.ENOSYS]:
+                    raise
+
+            sb = os.fstat(src_fd)
+            size = sb.st_size
+
+            # See io_blksize() in coreutils for an explanation of why
+            # 32*1024; it is also the granularity of the holes we make
+            buf_size = max(32*1024, sb.st_blksize)
+            zeros = b'\0' * buf_size
+            use_copy_file_range = True
+
+            def _copy_run(offset, count):
+                # returns whether copy_file_range() is still worth trying
+                if count == 0:
+                    return use_copy_file_range
+                if use_copy_file_range and _copy_file_range(src_fd, dest_fd,
+                                                            offset, count):
+                    return True
+                os.lseek(dest_fd, offset, os.SEEK_SET)
+                copy_range(src_fd, dest_fd, offset, count)
+                return False
+
+            for start, length in _data_extents(src_fd, size):
+                # coalesce the blocks that are not all zeros into runs, and
+                # copy each run in one go
+                run = start
+                offset = start
+                end = start + length
+                while offset < end:
+                    buf = pread(src_fd, min(buf_size, end - offset), offset)
+                    if len(buf) == 0:
+                        break
+                    if len(buf) == buf_size:
+                        iszero = buf == zeros
+                    else:
+                        iszero = memoryview(buf) == memoryview(zeros)[:len(buf)]
+                    if iszero:
+                        use_copy_file_range = _copy_run(run, offset - run)
+                        run = offset + len(buf)
+                    offset += len(buf)
+                use_copy_file_range = _copy_run(run, offset - run)
+
+            # the holes at the end of the file are not written above
+            os.ftruncate(dest_fd, size)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
 
 def bsd_split(line, digest_type):
     """
@@ -166,7 +259,7 @@ def sum_split(line, digest_bits):
     Function to split a normal Linux checksum line into a filename and
     checksum.
     """
-    digest_hex_bytes = digest_bits / 4
+    digest_hex_bytes = digest_bits // 4
     min_digest_line_length = digest_hex_bytes + 2 + 1 # length of hex message digest + blank and binary indicator (2 bytes) + minimum file length (1 byte)
 
     min_length = min_digest_line_length
@@ -210,21 +303,24 @@ def sum_split(line, digest_bits):
         # FIXME: a \0 is not allowed in the sum file format, but
         # string_escape allows it.  We'd probably have to implement our
         # own codec to fix this
-        filename = filename.decode('string_escape')
+        if isinstance(filename, bytes):
+            filename = filename.decode('string_escape')
+        else:
+            filename = codecs.decode(filename.encode('latin-1'),
+                                     'unicode_escape')
 
     return hex_digest, filename
 
-def get_sum_from_file(sumfile, file_to_find, digest_bits, digest_type):
+def get_sums_from_file(sumfile, digest_bits, digest_type):
     """
-    Function to get a checksum digest out of a checksum file given a
-    filename.
+    Function to parse a checksum file into a dictionary of filename to
+    checksum digest.  Both BSD-style and regular (GNU coreutils) lines are
+    understood.  If a file is listed more than once, the first entry wins.
     """
-    retval = None
+    sums = {}
 
     f = open(sumfile, 'r')
     for line in f:
-        binary = False
-
         # remove any leading whitespace
         line = line.lstrip()
 
@@ -247,13 +343,19 @@ def get_sum_from_file(sumfile, file_to_find, digest_bits, digest_type):
         if hex_digest is None or filename is None:
             continue
 
-        if filename == file_to_find:
-            retval = hex_digest
-            break
+        if filename not in sums:
+            sums[filename] = hex_digest
 
     f.close()
 
-    return retval
+    return sums
+
+def get_sum_from_file(sumfile, file_to_find, digest_bits, digest_type):
+    """
+    Function to get a checksum digest out of a checksum file given a
+    filename.
+    """
+    return get_sums_from_file(sumfile, digest_bits, digest_type).get(file_to_find)
 
 def get_md5sum_from_file(sumfile, file_to_find):
     """
@@ -576,20 +678,141 @@ def config_get_boolean_key(config, section, key, default):
 
     return retval
 
-def rmtree_and_sync(directory):
+_size_suffixes = ['K', 'M', 'G', 'T']
+
+def parse_size(value):
+    """
+    Function to convert a size like 500M, 20G or 1048576 to a number of
+    bytes.  The suffixes K, M, G, and T are powers of 1024, and may be
+    followed by B or iB.
+    """
+    orig = value
+    value = value.strip().upper()
+    for suffix in ['IB', 'B']:
+        if len(value) > 1 and value.endswith(suffix) and value[-len(suffix)-1:-len(suffix)] in _size_suffixes:
+            value = value[:-len(suffix)]
+            break
+    multiplier = 1
+    if value and value[-1] in _size_suffixes:
+        multiplier = 1024**(_size_suffixes.index(value[-1]) + 1)
+        value = value[:-1]
+    try:
+        size = float(value)
+    except ValueError:
+        raise Exception("Invalid size '%s'" % (orig))
+    if size < 0:
+        raise Exception("Invalid size '%s'" % (orig))
+    return int(size * multiplier)
+
+def format_size(size):
+    """
+    Function to format a number of bytes for humans, for instance as 1.5G.
+    """
+    suffix = ''
+    size = float(size)
+    for s in _size_suffixes:
+        if size < 1024:
+            break
+        size /= 1024
+        suffix = s
+    if suffix == '':
+        return "%d" % (size)
+    return "%.1f%s" % (size, suffix)
+
+def config_get_size_key(config, section, key, default):
+    """
+    Function to retrieve size config parameters (see parse_size()) out of
+    the config file.  An empty value or 0 means no size was set, and returns
+    None.
+    """
+    value = config_get_key(config, section, key, None)
+    if value is None:
+        return default
+    if value.strip() == '':
+        return None
+
+    try:
+        size = parse_size(value)
+    except Exception:
+        raise Exception("Configuration parameter '%s' must be a size, like 500M or 20G" % (key))
+    if size == 0:
+        return None
+    return size
+
+def _rmtree_make_writable(func, path, excinfo):
+    """
+    Function that is called back from shutil.rmtree() when it fails to remove
+    path.  If that is because the directory holding path is not writable,
+    make it writable and try again; otherwise re-raise the error.
+    """
+    err = excinfo[1]
+    if not isinstance(err, OSError) or err.errno not in [errno.EACCES,
+                                                          errno.EPERM]:
+        raise err
+    parent = os.path.dirname(path)
+    os.chmod(parent, os.stat(parent).st_mode|stat.S_IRWXU)
+    func(path)
+
+def rmtree_and_sync(directory, writable=False):
     """
     Function to remove a directory tree and do an fsync afterwards.  Because
     the removal of the directory tree can cause a lot of metadata updates, it
     can cause a lot of disk activity.  By doing the fsync, we ensure that any
     metadata updates caused by us will not cause subsequent steps to fail.  This
     cannot help if the system is otherwise very busy, but it does ensure that
-    the problem is not self-inflicted.
+    the problem is not self-inflicted.  If writable is True, directories that
+    are in the way because they are not writable are made writable as they
+    are found, instead of failing the removal.
     """
-    shutil.rmtree(directory)
+    if writable:
+        shutil.rmtree(directory, onerror=_rmtree_make_writable)
+    else:
+        shutil.rmtree(directory)
     fd = os.open(os.path.dirname(directory), os.O_RDONLY)
     os.fsync(fd)
     os.close(fd)
 
+def rmtree_deferred(directory, trash_dir):
+    """
+    Function to remove a directory tree without waiting for it.  The tree is
+    atomically renamed into trash_dir, so its path can be reused right away,
+    and then removed by a detached "rm" at idle I/O priority, which keeps
+    running even if the caller exits.  Returns the subprocess.Popen object
+    of the helper, or None if the tree was removed synchronously because it
+    could not be moved into trash_dir.
+    """
+    mkdir_p(trash_dir)
+    target = tempfile.mkdtemp(dir=trash_dir)
+    try:
+        os.rename(directory, os.path.join(target, "tree"))
+    except OSError as err:
+        os.rmdir(target)
+        if err.errno == errno.ENOENT:
+            return None
+        if err.errno != errno.EXDEV:
+            raise
+        # trash_dir is on a different filesystem
+        rmtree_and_sync(directory, writable=True)
+        return None
+
+    # never descend into anything that is still mounted in the tree
+    cmd = ["rm", "-rf", "--one-file-system", "--", target]
+    devnull = open(os.devnull, 'r+')
+    try:
+        try:
+            return subprocess.Popen(["ionice", "-c", "3"] + cmd, stdin=devnull,
+                                    stdout=devnull, stderr=devnull,
+                                    close_fds=True)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            # no ionice; at least use the lowest CPU priority
+            return subprocess.Popen(cmd, stdin=devnull, stdout=devnull,
+                                    stderr=devnull, close_fds=True,
+                                    preexec_fn=lambda: os.nice(19))
+    finally:
+        devnull.close()
+
 def parse_config(config_file):
     """
     Function to parse the configuration file.  If the passed in config_file is
@@ -639,97 +862,943 @@ def default_screenshot_dir():
     """
     return os.path.join(default_data_dir(), "screenshots")
 
-def http_get_header(url, redirect=True):
+def pwrite_all(fd, buf, offset):
+    """
+    Function to write all of buf to file descriptor fd at offset, without
+    moving the file position.  Falls back to lseek() + write() on platforms
+    where os.pwrite() is not available.
+    """
+    while len(buf) > 0:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, buf, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, buf)
+        buf = buf[written:]
+        offset += written
+
+def pread(fd, length, offset):
+    """
+    Function to read up to length bytes from file descriptor fd at offset,
+    without moving the file position.  Falls back to lseek() + read() on
+    platforms where os.pread() is not available.
+    """
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+def copy_range(infd, outfd, offset, count):
+    """
+    Function to copy count bytes at offset in file descriptor infd to the
+    current position of file descriptor outfd.  This uses sendfile() where
+    the platform supports it, so the data does not have to be copied through
+    userspace, and falls back to pread() and write() otherwise.
+    """
+    if hasattr(os, 'sendfile'):
+        try:
+            while count > 0:
+                sent = os.sendfile(outfd, infd, offset, min(count, 1024*1024*1024))
+                if sent == 0:
+                    raise Exception("Unexpected end of file while copying")
+                offset += sent
+                count -= sent
+            return
+        except OSError as err:
+            # sendfile() to a regular file is not supported on older kernels;
+            # fall back to copying through userspace
+            if err.errno not in [errno.EINVAL, errno.ENOSYS]:
+                raise
+
+    while count > 0:
+        buf = pread(infd, min(count, 1024*1024), offset)
+        if not buf:
+            raise Exception("Unexpected end of file while copying")
+        while buf:
+            written = os.write(outfd, buf)
+            buf = buf[written:]
+            offset += written
+            count -= written
+
+# ioctl to make a file share the data blocks of another one, from
+# linux/fs.h
+FICLONE = 0x40049409
+
+def clone_file(src, dest):
+    """
+    Function to make dest a copy of src.  On filesystems that support it
+    (like btrfs and XFS), dest shares the data blocks of src until either of
+    them is modified, so the copy is instant and takes no space; otherwise
+    the data is copied with copy_range().
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o644)
+        try:
+            try:
+                fcntl.ioctl(dest_fd, FICLONE, src_fd)
+                return
+            except (IOError, OSError) as err:
+                if err.errno not in [errno.EOPNOTSUPP, errno.ENOTTY,
+                                     errno.EXDEV, errno.EINVAL,
+                                     errno.ENOSYS]:
+                    raise
+            copy_range(src_fd, dest_fd, 0, os.fstat(src_fd).st_size)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+
+def create_qcow2(filename, size):
     """
-    Function to get the HTTP headers from a URL.  The available headers will be
-    returned in a dictionary.  If redirect=True (the default), then this
-    function will automatically follow http redirects through to the final
-    destination, entirely transparently to the caller.  If redirect=False, then
-    this function will follow http redirects through to the final destination,
-    and also store that information in the 'Redirect-URL' key.  Note that
-    'Redirect-URL' will always be None in the redirect=True case, and may be
-    None in the redirect=True case if no redirects were required.
-    """
-    info = {}
-    def _header(buf):
+    Function to create filename as an empty qcow2 (version 2) image of size
+    bytes, without running qemu-img.  The image consists of the header, a
+    refcount table with a single refcount block, and an empty L1 table, each
+    in a cluster of its own; see docs/interop/qcow2.txt in the QEMU sources
+    for the format.
+    """
+    cluster_bits = 16
+    cluster_size = 1 << cluster_bits
+
+    # every L2 table covers cluster_size/8 clusters
+    l2_coverage = (cluster_size // 8) * cluster_size
+    l1_size = (size + l2_coverage - 1) // l2_coverage
+    l1_clusters = max(1, (l1_size * 8 + cluster_size - 1) // cluster_size)
+
+    refcount_table_offset = cluster_size
+    refcount_block_offset = 2 * cluster_size
+    l1_table_offset = 3 * cluster_size
+    nclusters = 3 + l1_clusters
+
+    header = struct.pack(">4sIQIIQIIQQIIQ", b"QFI\xfb", 2, 0, 0,
+                         cluster_bits, size, 0, l1_size, l1_table_offset,
+                         refcount_table_offset, 1, 0, 0)
+    refcount_table = struct.pack(">Q", refcount_block_offset)
+    # 16-bit refcounts; every cluster in the image is in use exactly once
+    refcount_block = struct.pack(">%dH" % (nclusters), *([1] * nclusters))
+
+    fd = os.open(filename, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o644)
+    try:
+        for offset, data in [(0, header),
+                             (refcount_table_offset, refcount_table),
+                             (refcount_block_offset, refcount_block)]:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+        # the L1 table is all zeros, since nothing is allocated yet
+        os.ftruncate(fd, nclusters * cluster_size)
+    except:
+        os.close(fd)
+        os.unlink(filename)
+        raise
+    os.close(fd)
+
+class StreamHasher(object):
+    """
+    Class to compute digests of a file while it is being written.  Digests
+    have to be fed strictly in file order; data written exactly at the
+    current position is fed directly by update(), and any data that was
+    written ahead of the current position (for instance by a later segment
+    of a segmented download, or by an earlier, interrupted download) is read
+    back from fd by catch_up() once everything before it is present.
+    """
+    def __init__(self, fd, hashnames):
+        self.fd = fd
+        self.hashnames = hashnames
+        self.reset()
+
+    def reset(self):
         """
-        Internal function that is called back from pycurl perform() for
-        header data.
+        Method to throw away everything hashed so far and start over at the
+        beginning of the file.
         """
-        buf = buf.strip()
-        if len(buf) == 0:
-            return
+        self.offset = 0
+        self.hashes = {}
+        for name in self.hashnames:
+            self.hashes[name] = hashlib.new(name)
 
-        split = buf.split(':')
-        if len(split) < 2:
-            # not a valid header; skip
+    def update(self, buf, offset):
+        """
+        Method to be called after buf was written to the file at offset.  If
+        that is where the digests left off, the data is hashed directly;
+        otherwise it will be picked up by a later catch_up().
+        """
+        if offset != self.offset:
             return
-        key = split[0].strip()
-        value = split[1].strip()
-        info[key] = value
+        for h in self.hashes.values():
+            h.update(buf)
+        self.offset += len(buf)
 
-    def _data(buf):
+    def catch_up(self, frontier):
         """
-        Empty function that is called back from pycurl perform() for body data.
+        Method to read back and hash the data between the current position and
+        frontier.  The caller guarantees that all of that data is present in
+        the file.
         """
-        pass
-
-    c = pycurl.Curl()
-    c.setopt(c.URL, url)
-    c.setopt(c.NOBODY, True)
-    c.setopt(c.HEADERFUNCTION, _header)
-    c.setopt(c.HEADER, True)
-    c.setopt(c.WRITEFUNCTION, _data)
-    if redirect:
-        c.setopt(c.FOLLOWLOCATION, True)
-    c.perform()
-    info['HTTP-Code'] = c.getinfo(c.HTTP_CODE)
-    if info['HTTP-Code'] == 0:
-        # if this was a file:/// URL, then the HTTP_CODE returned 0.
-        # set it to 200 to be compatible with http
-        info['HTTP-Code'] = 200
-    if not redirect:
-        info['Redirect-URL'] = c.getinfo(c.REDIRECT_URL)
-
-    c.close()
-
-    return info
-
-def http_download_file(url, fd, show_progress, logger):
-    """
-    Function to download a file from url to file descriptor fd.
-    """
-    class Progress(object):
-        def __init__(self):
-            self.last_mb = -1
-
-        def progress(self, down_total, down_current, up_total, up_current):
+        while self.offset < frontier:
+            buf = pread(self.fd, min(1024*1024, frontier - self.offset),
+                        self.offset)
+            if len(buf) == 0:
+                raise Exception("Unexpected end of file while computing checksum")
+            for h in self.hashes.values():
+                h.update(buf)
+            self.offset += len(buf)
+
+    def hexdigests(self):
+        """
+        Method to return a dictionary of hash name to hex digest.
+        """
+        digests = {}
+        for name, h in self.hashes.items():
+            digests[name] = h.hexdigest()
+        return digests
+
+def qcow2_backing_file(filename):
+    """
+    Function to return the name of the backing file recorded in the header
+    of the qcow2 image filename, or None if filename does not exist, is not
+    a qcow2 image, or has no backing file.
+    """
+    try:
+        f = open(filename, 'rb')
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return None
+    try:
+        header = f.read(20)
+        if len(header) < 20 or header[0:4] != b"QFI\xfb":
+            return None
+        (offset, size) = struct.unpack(">QI", header[8:20])
+        if offset == 0 or size == 0:
+            return None
+        f.seek(offset)
+        return f.read(size).decode('utf-8', 'replace')
+    finally:
+        f.close()
+
+def plan_download_segments(content_length, segments, min_segment_size=8*1024*1024):
+    """
+    Function to split content_length bytes into at most segments contiguous
+    byte ranges, none of which is smaller than min_segment_size (except for
+    a file that is smaller than min_segment_size to begin with).  Returns a
+    list of (start, end) tuples; as in an HTTP Range header, end is inclusive.
+    """
+    if content_length <= 0:
+        raise Exception("Cannot plan segments for a download of %d bytes" % (content_length))
+    if segments < 1:
+        raise Exception("Number of segments must be at least 1")
+
+    count = max(1, min(segments, content_length // min_segment_size))
+    size = content_length // count
+
+    plan = []
+    start = 0
+    for i in range(0, count):
+        if i == count - 1:
+            end = content_length - 1
+        else:
+            end = start + size - 1
+        plan.append((start, end))
+        start = end + 1
+
+    return plan
+
+class HttpSession(object):
+    """
+    Class to make HTTP (and FTP and file) requests with pycurl while reusing
+    connections.  Instead of creating a new pycurl handle for every request,
+    handles are kept in a pool and reused, so that keep-alive connections to
+    the same server survive from one request to the next.  All handles of a
+    session also share their DNS cache, TLS session cache and (where libcurl
+    supports it) connection cache, so even requests made on different
+    handles, like the segments of a segmented download, avoid repeated name
+    lookups and handshakes.  Handles are taken from and returned to the pool
+    under a lock, so a session can be used from several threads.
+    """
+    def __init__(self, max_handles=8):
+        self.max_handles = max_handles
+        self.pool = []
+        self.lock = threading.Lock()
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        if hasattr(pycurl, 'LOCK_DATA_CONNECT'):
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+
+    def get_handle(self):
+        """
+        Method to get a pycurl handle from the pool, or a new one if the pool
+        is empty.  The handle has no options set besides being attached to
+        the session, and must be given back with put_handle().
+        """
+        with self.lock:
+            if self.pool:
+                c = self.pool.pop()
+            else:
+                c = pycurl.Curl()
+        c.setopt(c.SHARE, self.share)
+        return c
+
+    def put_handle(self, c):
+        """
+        Method to give a handle from get_handle() back to the pool.  All of
+        the options on the handle are reset, but its connections are kept
+        open for the next request.
+        """
+        # pycurl insists on the handle being detached from the share before
+        # it can be attached again, and reset() does not do that for us
+        c.unsetopt(c.SHARE)
+        c.reset()
+        with self.lock:
+            if len(self.pool) < self.max_handles:
+                self.pool.append(c)
+                return
+        c.close()
+
+    def close(self):
+        """
+        Method to close all of the pooled handles and their connections.
+        """
+        with self.lock:
+            for c in self.pool:
+                c.close()
+            self.pool = []
+
+    def get_header(self, url, redirect=True):
+        """
+        Method to get the HTTP headers from a URL.  The available headers will be
+        returned in a dictionary.  If redirect=True (the default), then this
+        function will automatically follow http redirects through to the final
+        destination, entirely transparently to the caller.  If redirect=False, then
+        this function will follow http redirects through to the final destination,
+        and also store that information in the 'redirect-url' key.  Note that
+        'redirect-url' will always be None in the redirect=True case, and may be
+        None in the redirect=True case if no redirects were required.  The URL
+        that was finally reached is always stored in the 'effective-url' key.
+
+        Header names are case-insensitive, and servers differ in how they
+        write them (HTTP/2 servers use all lowercase, for instance), so all
+        of the keys of the dictionary are lowercase.
+        """
+        info = {}
+        def _header(buf):
             """
-            Function that is called back from the pycurl perform() method to
-            update the progress information.
+            Internal function that is called back from pycurl perform() for
+            header data.
             """
-            if down_total == 0:
+            if isinstance(buf, bytes):
+                buf = buf.decode('iso-8859-1')
+            buf = buf.strip()
+            if len(buf) == 0:
+                return
+
+            # only split on the first ':'; values like Last-Modified contain
+            # more of them
+            split = buf.split(':', 1)
+            if len(split) < 2:
+                # not a valid header; skip
                 return
-            current_mb = int(down_current) / 10485760
-            if current_mb > self.last_mb or down_current == down_total:
-                self.last_mb = current_mb
-                logger.debug("%dkB of %dkB" % (down_current/1024, down_total/1024))
+            key = split[0].strip().lower()
+            value = split[1].strip()
+            info[key] = value
 
-    def _data(buf):
+        def _data(buf):
+            """
+            Empty function that is called back from pycurl perform() for body data.
+            """
+            pass
+
+        c = self.get_handle()
+        c.setopt(c.URL, url)
+        c.setopt(c.NOBODY, True)
+        c.setopt(c.HEADERFUNCTION, _header)
+        c.setopt(c.HEADER, True)
+        c.setopt(c.WRITEFUNCTION, _data)
+        if redirect:
+            c.setopt(c.FOLLOWLOCATION, True)
+        try:
+            c.perform()
+        except:
+            self.put_handle(c)
+            raise
+        info['http-code'] = c.getinfo(c.HTTP_CODE)
+        if info['http-code'] == 0:
+            # if this was a file:/// URL, then the HTTP_CODE returned 0.
+            # set it to 200 to be compatible with http
+            info['http-code'] = 200
+        if not redirect:
+            info['redirect-url'] = c.getinfo(c.REDIRECT_URL)
+        info['effective-url'] = c.getinfo(c.EFFECTIVE_URL)
+
+        self.put_handle(c)
+
+        return info
+
+    def download_file(self, url, fd, show_progress, logger, offset=0,
+                      hashnames=None):
         """
-        Function that is called back from the pycurl perform() method to
-        actually write data to disk.
+        Method to download a file from url to file descriptor fd.  If offset is
+        non-zero, only the data from offset onwards is requested from the server
+        and written to fd starting at offset.  If the server ignores the request
+        and sends the whole file, it is written from the beginning instead.
+
+        hashnames is an optional list of hashlib algorithm names (like 'md5' or
+        'sha256').  The data is hashed as it arrives, and a dictionary of hash
+        name to hex digest of the whole file is returned.
         """
-        os.write(fd, buf)
-
-    progress = Progress()
-    c = pycurl.Curl()
-    c.setopt(c.URL, url)
-    c.setopt(c.CONNECTTIMEOUT, 5)
-    c.setopt(c.WRITEFUNCTION, _data)
-    c.setopt(c.FOLLOWLOCATION, 1)
-    if show_progress:
-        c.setopt(c.NOPROGRESS, 0)
-        c.setopt(c.PROGRESSFUNCTION, progress.progress)
-    c.perform()
-    c.close()
+        hasher = StreamHasher(fd, hashnames or [])
+        class Progress(object):
+            def __init__(self):
+                self.last_mb = -1
+
+            def progress(self, down_total, down_current, up_total, up_current):
+                """
+                Function that is called back from the pycurl perform() method to
+                update the progress information.
+                """
+                if down_total == 0:
+                    return
+                current_mb = int(down_current) / 10485760
+                if current_mb > self.last_mb or down_current == down_total:
+                    self.last_mb = current_mb
+                    logger.debug("%dkB of %dkB" % (down_current/1024, down_total/1024))
+
+        class Position(object):
+            def __init__(self):
+                self.offset = offset
+
+            def header(self, buf):
+                """
+                Function that is called back from the pycurl perform() method for
+                each header line.  A server that does not honor the resume
+                request answers with a 200 instead of a 206, in which case we
+                start writing at the beginning of the file.
+                """
+                if isinstance(buf, bytes):
+                    buf = buf.decode('iso-8859-1')
+                if offset != 0 and buf.startswith("HTTP/"):
+                    split = buf.split()
+                    if len(split) > 1 and split[1] == "200":
+                        self.offset = 0
+                        hasher.reset()
+
+            def data(self, buf):
+                """
+                Function that is called back from the pycurl perform() method to
+                actually write data to disk.
+                """
+                pwrite_all(fd, buf, self.offset)
+                hasher.update(buf, self.offset)
+                self.offset += len(buf)
+
+        # the data before offset is already there, so hash it first
+        hasher.catch_up(offset)
+
+        progress = Progress()
+        position = Position()
+        c = self.get_handle()
+        c.setopt(c.URL, url)
+        c.setopt(c.CONNECTTIMEOUT, 5)
+        c.setopt(c.HEADERFUNCTION, position.header)
+        c.setopt(c.WRITEFUNCTION, position.data)
+        c.setopt(c.FOLLOWLOCATION, 1)
+        if offset != 0:
+            c.setopt(c.RESUME_FROM_LARGE, offset)
+        if show_progress:
+            c.setopt(c.NOPROGRESS, 0)
+            c.setopt(c.PROGRESSFUNCTION, progress.progress)
+        try:
+            c.perform()
+        finally:
+            self.put_handle(c)
+
+        return hasher.hexdigests()
+
+    def download_file_segmented(self, url, fd, show_progress, logger,
+                                content_length, segments=4, ranges=None,
+                                checkpoint=None,
+                                checkpoint_interval=64*1024*1024,
+                                hashnames=None):
+        """
+        Method to download a file from url to file descriptor fd using several
+        concurrent HTTP Range requests.  url must be an http, https or file
+        URL, the server must support byte ranges (i.e. it advertises
+        'Accept-Ranges: bytes'), and content_length must be the length of the
+        file as reported by the server.  Each segment is written directly to
+        its final location in fd with pwrite, so the segments can arrive in
+        any order.  Nothing is written for a response that is not a 206
+        Partial Content covering exactly the requested byte range (a server
+        that ignores the Range header, or an error page), and the download
+        fails instead.
+
+        If ranges is not None, it is a list of (start, end) tuples to fetch
+        instead of the whole file; this is used to resume an earlier download.
+        If checkpoint is not None, it is called every checkpoint_interval bytes
+        (and once more when the download stops, successfully or not) with a list
+        of [start, end, written] entries describing the progress of each
+        segment.  Only data from responses that were accepted is counted.  fd is synced to disk before checkpoint is called, so all of
+        the data described by the list is safely stored.
+
+        hashnames is an optional list of hashlib algorithm names.  A dictionary
+        of hash name to hex digest of the whole file is returned.  The first
+        segment is hashed as it arrives; later segments are read back as soon as
+        everything before them has been downloaded, while they are most likely
+        still in the page cache.
+        """
+        scheme = url.split(':', 1)[0].lower()
+        if scheme not in ['http', 'https', 'file']:
+            raise Exception("Cannot download %s in segments, only http, https and file URLs are supported" % (url))
+
+        hasher = StreamHasher(fd, hashnames or [])
+
+        class Segment(object):
+            """
+            Class to track the progress of a single byte range.
+            """
+            def __init__(self, start, end):
+                self.start = start
+                self.end = end
+                self.written = 0
+                self.status = None
+                self.content_range = None
+                self.checked = False
+                self.error = None
+
+            def length(self):
+                """
+                Method to return the number of bytes this segment should contain.
+                """
+                return self.end - self.start + 1
+
+            def header(self, buf):
+                """
+                Method that is called back from the pycurl perform() method for
+                each header line of the response.
+                """
+                if isinstance(buf, bytes):
+                    buf = buf.decode('iso-8859-1')
+                if buf.startswith("HTTP/"):
+                    # the start of a new response (after a redirect, for
+                    # instance); forget about the previous one
+                    split = buf.split()
+                    self.status = None
+                    if len(split) > 1 and split[1].isdigit():
+                        self.status = int(split[1])
+                    self.content_range = None
+                    return
+                split = buf.split(':', 1)
+                if len(split) == 2 and split[0].strip().lower() == 'content-range':
+                    self.content_range = split[1].strip()
+
+            def _check(self):
+                """
+                Method to check that the response is the byte range that was
+                asked for.  Returns None if it is, or an error message.
+                """
+                if scheme == 'file':
+                    # libcurl reads the range out of the file itself
+                    return None
+                if self.status != 206:
+                    return "Server returned HTTP code %s for byte range %d-%d of %s" % (self.status, self.start, self.end, url)
+                expected = ["bytes %d-%d/%d" % (self.start, self.end, content_length),
+                            "bytes %d-%d/*" % (self.start, self.end)]
+                if self.content_range not in expected:
+                    return "Server returned byte range %s instead of %d-%d of %s" % (self.content_range, self.start, self.end, url)
+                return None
+
+            def write(self, buf):
+                """
+                Method that is called back from the pycurl perform() method to
+                write data for this segment to disk.  Returning a short count
+                makes pycurl abort this transfer with an error.
+                """
+                if not self.checked:
+                    self.error = self._check()
+                    if self.error is not None:
+                        return 0
+                    self.checked = True
+                if self.written + len(buf) > self.length():
+                    self.error = "Server sent more than byte range %d-%d of %s" % (self.start, self.end, url)
+                    return 0
+                pwrite_all(fd, buf, self.start + self.written)
+                hasher.update(buf, self.start + self.written)
+                self.written += len(buf)
+
+        # reserve the space up-front, so we don't fail halfway through the
+        # download (and so that the segments can be written out of order).
+        # Note that this makes fd full-size before any data arrives, so the
+        # caller has to record somewhere that the file is incomplete
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, content_length)
+        else:
+            os.ftruncate(fd, content_length)
+
+        if ranges is None:
+            plan = plan_download_segments(content_length, segments)
+        else:
+            plan = ranges
+        if logger:
+            logger.debug("Downloading %s in %d segment(s)" % (url, len(plan)))
+
+        # create all of the segments before starting any transfers, so that a
+        # checkpoint always describes the whole plan
+        segs = [Segment(start, end) for start, end in plan]
+
+        def _frontier():
+            """
+            Function to find the end of the data that is known to be present
+            from the start of the file onwards.  Anything outside of the planned
+            segments was downloaded earlier.
+            """
+            for seg in sorted(segs, key=lambda x: x.start):
+                if seg.error is not None or seg.written < seg.length():
+                    return seg.start + seg.written
+            return content_length
+
+        def _checkpoint():
+            """
+            Function to make the data written so far durable and report it.
+            Nothing is reported for a segment whose response was rejected, so
+            that the whole segment is fetched again on resume.
+            """
+            if checkpoint is None:
+                return
+            os.fdatasync(fd)
+            checkpoint([[seg.start, seg.end, 0 if seg.error else seg.written]
+                        for seg in segs])
+
+        multi = pycurl.CurlMulti()
+        handles = []
+        last_checkpoint = 0
+        try:
+            for seg in segs:
+                c = self.get_handle()
+                c.setopt(c.URL, url)
+                c.setopt(c.CONNECTTIMEOUT, 5)
+                c.setopt(c.FOLLOWLOCATION, 1)
+                c.setopt(c.RANGE, "%d-%d" % (seg.start, seg.end))
+                c.setopt(c.HEADERFUNCTION, seg.header)
+                c.setopt(c.WRITEFUNCTION, seg.write)
+                multi.add_handle(c)
+                handles.append((c, seg))
+
+            down_total = sum([seg.length() for seg in segs])
+            last_mb = -1
+            num_handles = len(handles)
+            while num_handles > 0:
+                while True:
+                    ret, num_handles = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+
+                # pull any finished transfers out so we can fail early
+                while True:
+                    num_q, ok_list, err_list = multi.info_read()
+                    for c, errno_, errmsg in err_list:
+                        for handle, seg in handles:
+                            if handle is c and seg.error is not None:
+                                raise Exception(seg.error)
+                        raise Exception("Failed to download %s: %s (%d)" % (url, errmsg, errno_))
+                    if num_q == 0:
+                        break
+
+                down_current = sum([seg.written for seg in segs])
+                if show_progress and logger:
+                    current_mb = down_current // 10485760
+                    if current_mb > last_mb or down_current == down_total:
+                        last_mb = current_mb
+                        logger.debug("%dkB of %dkB" % (down_current/1024, down_total/1024))
+
+                if down_current - last_checkpoint >= checkpoint_interval:
+                    _checkpoint()
+                    last_checkpoint = down_current
+
+                hasher.catch_up(_frontier())
+
+                if num_handles > 0:
+                    multi.select(1.0)
+
+            for c, seg in handles:
+                code = c.getinfo(c.HTTP_CODE)
+                if code != (0 if scheme == 'file' else 206):
+                    raise Exception("Server returned HTTP code %d for byte range %d-%d of %s" % (code, seg.start, seg.end, url))
+                if seg.written != seg.length():
+                    raise Exception("Expected %d bytes for byte range %d-%d of %s, got %d" % (seg.length(), seg.start, seg.end, url, seg.written))
+
+            hasher.catch_up(content_length)
+        finally:
+            _checkpoint()
+            for c, seg in handles:
+                multi.remove_handle(c)
+                self.put_handle(c)
+            multi.close()
+
+        return hasher.hexdigests()
+
+    def _perform_all(self, handles):
+        """
+        Internal method to run the requests on all of the given handles
+        concurrently.  Returns the set of handles whose request failed.
+        """
+        failed = set()
+        multi = pycurl.CurlMulti()
+        for c in handles:
+            multi.add_handle(c)
+        try:
+            num_handles = len(handles)
+            while num_handles > 0:
+                while True:
+                    ret, num_handles = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+
+                while True:
+                    num_q, ok_list, err_list = multi.info_read()
+                    for c, errno_, errmsg in err_list:
+                        failed.add(c)
+                    if num_q == 0:
+                        break
+
+                if num_handles > 0:
+                    multi.select(1.0)
+        finally:
+            for c in handles:
+                multi.remove_handle(c)
+            multi.close()
+
+        return failed
+
+    def probe_mirrors(self, urls, require_ranges=False, timeout=5,
+                      probe_bytes=64*1024):
+        """
+        Method to race a list of candidate URLs (typically the same file on
+        several mirrors) against each other.  All of the candidates are first
+        sent a HEAD request at the same time; candidates that fail, return an
+        HTTP error, or (if require_ranges is True) say that they do not
+        accept byte ranges are dropped.  The remaining candidates are then
+        sent a ranged GET for the first probe_bytes bytes at the same time,
+        and the download speed is measured.  If require_ranges is True, HTTP
+        servers that ignore the range are dropped too.  No request is allowed
+        to take longer than timeout seconds.
+
+        Returns a list of (url, bytes per second) tuples for the usable
+        candidates, fastest first.
+        """
+        def _is_http(url):
+            """
+            Function to check whether url uses HTTP, where the status codes
+            and headers mean something.
+            """
+            return url.split(':', 1)[0].lower() in ['http', 'https']
+
+        class Probe(object):
+            """
+            Class to track the headers and data received for one candidate.
+            """
+            def __init__(self, url):
+                self.url = url
+                self.headers = {}
+                self.received = 0
+
+            def header(self, buf):
+                """
+                Method that is called back from pycurl for each header line.
+                """
+                if isinstance(buf, bytes):
+                    buf = buf.decode('iso-8859-1')
+                split = buf.split(':', 1)
+                if len(split) == 2:
+                    self.headers[split[0].strip().lower()] = split[1].strip()
+
+            def data(self, buf):
+                """
+                Method that is called back from pycurl for body data.
+                """
+                self.received += len(buf)
+
+        def _setup(probe):
+            """
+            Function to get a handle with the options common to both stages.
+            """
+            c = self.get_handle()
+            c.setopt(c.URL, probe.url)
+            c.setopt(c.CONNECTTIMEOUT, timeout)
+            c.setopt(c.TIMEOUT, timeout)
+            c.setopt(c.FOLLOWLOCATION, 1)
+            c.setopt(c.HEADERFUNCTION, probe.header)
+            c.setopt(c.WRITEFUNCTION, probe.data)
+            return c
+
+        # stage 1: HEAD
+        probes = [Probe(url) for url in urls]
+        handles = []
+        try:
+            for probe in probes:
+                c = _setup(probe)
+                c.setopt(c.NOBODY, True)
+                handles.append((c, probe))
+            failed = self._perform_all([c for c, probe in handles])
+
+            alive = []
+            for c, probe in handles:
+                if c in failed:
+                    continue
+                if _is_http(probe.url):
+                    if c.getinfo(c.HTTP_CODE) >= 400:
+                        continue
+                    if require_ranges and probe.headers.get('accept-ranges') == 'none':
+                        continue
+                alive.append(Probe(probe.url))
+        finally:
+            for c, probe in handles:
+                self.put_handle(c)
+
+        # stage 2: ranged GET
+        results = []
+        handles = []
+        try:
+            for probe in alive:
+                c = _setup(probe)
+                c.setopt(c.RANGE, "0-%d" % (probe_bytes - 1))
+                handles.append((c, probe))
+            failed = self._perform_all([c for c, probe in handles])
+
+            for c, probe in handles:
+                if c in failed:
+                    continue
+                if _is_http(probe.url):
+                    code = c.getinfo(c.HTTP_CODE)
+                    if code >= 400 or (require_ranges and code != 206):
+                        continue
+                speed = c.getinfo(c.SPEED_DOWNLOAD)
+                if speed <= 0:
+                    total = c.getinfo(c.TOTAL_TIME)
+                    if total > 0:
+                        speed = probe.received / total
+                results.append((probe.url, speed))
+        finally:
+            for c, probe in handles:
+                self.put_handle(c)
+
+        results.sort(key=lambda x: x[1], reverse=True)
+        return results
+
+_default_http_session = None
+
+def default_http_session():
+    """
+    Function to return the HTTP session shared by the http_* functions.
+    """
+    global _default_http_session
+    if _default_http_session is None:
+        _default_http_session = HttpSession()
+    return _default_http_session
+
+def http_get_header(url, redirect=True):
+    """
+    Function to get the HTTP headers from a URL, using the default HTTP
+    session.  See HttpSession.get_header() for details.
+    """
+    return default_http_session().get_header(url, redirect)
+
+def http_download_file(url, fd, show_progress, logger, offset=0,
+                       hashnames=None):
+    """
+    Function to download a file from url to file descriptor fd, using the
+    default HTTP session.  See HttpSession.download_file() for details.
+    """
+    return default_http_session().download_file(url, fd, show_progress,
+                                                logger, offset, hashnames)
+
+def http_download_file_segmented(url, fd, show_progress, logger,
+                                 content_length, segments=4, ranges=None,
+                                 checkpoint=None,
+                                 checkpoint_interval=64*1024*1024,
+                                 hashnames=None):
+    """
+    Function to download a file from url to file descriptor fd using several
+    concurrent HTTP Range requests, using the default HTTP session.  See
+    HttpSession.download_file_segmented() for details.
+    """
+    return default_http_session().download_file_segmented(url, fd,
+                                                          show_progress,
+                                                          logger,
+                                                          content_length,
+                                                          segments, ranges,
+                                                          checkpoint,
+                                                          checkpoint_interval,
+                                                          hashnames)
+
+def read_json_file(filename):
+    """
+    Function to read a small JSON document (such as a cache sidecar) from
+    filename.  Returns None if the file does not exist or cannot be parsed,
+    since a missing or damaged sidecar just means the cached data cannot
+    be trusted.
+    """
+    try:
+        f = open(filename, 'r')
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return None
+
+    try:
+        return json.load(f)
+    except ValueError:
+        return None
+    finally:
+        f.close()
+
+def write_json_file(filename, data):
+    """
+    Function to atomically replace filename with the JSON encoding of data.
+    The data is written to a temporary file in the same directory first and
+    then renamed into place, so readers never see a partially written file.
+    """
+    fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(filename) + '.',
+                                   dir=os.path.dirname(filename))
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
+
+def digest_sidecar_key(path):
+    """
+    Function to return the part of the digest sidecar of path (see
+    read_sidecar_digest()) that says which version of the file the digest
+    belongs to.
+    """
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'inode': st.st_ino}
+
+def read_sidecar_digest(path):
+    """
+    Function to return the SHA-256 digest of path recorded in its sidecar
+    file, path.ozsha256, or None if there is no sidecar or the file has
+    changed since the sidecar was written.
+    """
+    record = read_json_file(path + ".ozsha256")
+    if record is None or record.get('digest') is None:
+        return None
+    key = digest_sidecar_key(path)
+    for k in key:
+        if record.get(k) != key[k]:
+            return None
+    return record['digest']
+
+def unlink_if_exists(filename):
+    """
+    Function to remove filename, ignoring the error if it does not exist.
+    """
+    try:
+        os.unlink(filename)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
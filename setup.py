@@ -3,12 +3,13 @@ from distutils.command.sdist import sdist as _sdist
 import subprocess
 import time
 
+# keep this in sync with __version__ in oz/__init__.py
 VERSION = '0.11.0'
 RELEASE = '0'
 
 datafiles = [('share/man/man1', ['man/oz-install.1', 'man/oz-generate-icicle.1',
                                  'man/oz-customize.1', 'man/oz-examples.1',
-                                 'man/oz-cleanup-cache.1'])
+                                 'man/oz-cleanup-cache.1', 'man/oz-prefetch.1'])
              ]
 
 class sdist(_sdist):
@@ -67,7 +68,7 @@ setup(name='oz',
       package_data={'oz': ['auto/*']},
       packages=['oz'],
       scripts=['oz-install', 'oz-generate-icicle', 'oz-customize',
-               'oz-cleanup-cache'],
+               'oz-cleanup-cache', 'oz-prefetch'],
       cmdclass={'sdist': sdist,
                 'test' : pytest },
       data_files = datafiles,
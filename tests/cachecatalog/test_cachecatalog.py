@@ -0,0 +1,197 @@
+#!/usr/bin/python
+
+import sys
+import os
+import fcntl
+import struct
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.CacheCatalog
+    import oz.JeosCache
+except ImportError as e:
+    print(e)
+    print('Unable to import oz.  Is oz installed or in your PYTHONPATH?')
+    sys.exit(1)
+
+def _cache(catalog, name, category, size=8192, provenance=None):
+    path = os.path.join(catalog.data_dir, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'wb').write(b'x' * size)
+    catalog.use(path, category, provenance)
+    return path
+
+def test_use_counts_hits(tmpdir):
+    catalog = oz.CacheCatalog.CacheCatalog(str(tmpdir))
+    path = _cache(catalog, 'isos/a.iso', 'iso', provenance={'url': 'http://example.org/a.iso'})
+    catalog.use(path, 'iso')
+    catalog.use(path, 'iso')
+
+    entries = catalog.entries()
+    assert len(entries) == 1
+    assert entries[0][0] == path
+    assert entries[0][1]['hits'] == 2
+    assert entries[0][1]['provenance'] == {'url': 'http://example.org/a.iso'}
+
+    stats = catalog.stats()
+    assert stats['iso'] == {'count': 1, 'size': os.stat(path).st_blocks * 512, 'hits': 2}
+    assert stats['jeos'] == {'count': 0, 'size': 0, 'hits': 0}
+
+def test_replaced_file_is_new_entry(tmpdir):
+    catalog = oz.CacheCatalog.CacheCatalog(str(tmpdir))
+    path = _cache(catalog, 'jeos/a.dsk', 'jeos')
+    catalog.use(path, 'jeos')
+    os.unlink(path)
+    _cache(catalog, 'jeos/a.dsk', 'jeos')
+    assert catalog.entries()[0][1]['hits'] == 0
+
+def test_invalid_category(tmpdir):
+    catalog = oz.CacheCatalog.CacheCatalog(str(tmpdir))
+    with py.test.raises(Exception):
+        _cache(catalog, 'isos/a.iso', 'bogus')
+
+def test_missing_files_dropped(tmpdir):
+    catalog = oz.CacheCatalog.CacheCatalog(str(tmpdir))
+    path = _cache(catalog, 'isos/a.iso', 'iso')
+    _cache(catalog, 'kernels/a-kernel', 'kernel')
+    os.unlink(path)
+    assert [entry['category'] for path, entry in catalog.entries()] == ['kernel']
+
+def test_enforce_category_quota(tmpdir):
+    catalog = oz.CacheCatalog.CacheCatalog(str(tmpdir))
+    first = _cache(catalog, 'isos/a.iso', 'iso')
+    second = _cache(catalog, 'isos/b.iso', 'iso')
+    third = _cache(catalog, 'isos/c.iso', 'iso')
+    jeos = _cache(catalog, 'jeos/a.dsk', 'jeos')
+    # using the first ISO makes the second the least recently used
+    catalog.use(first, 'iso')
+
+    size = os.stat(first).st_blocks * 512
+    removed = catalog.enforce({'iso': 2 * size}, None)
+    assert removed == [second]
+    assert os.path.exists(first)
+    assert not os.path.exists(second)
+    assert os.path.exists(third)
+    assert os.path.exists(jeos)
+
+def test_enforce_max_size(tmpdir):
+    catalog = oz.CacheCatalog.CacheCatalog(str(tmpdir))
+    first = _cache(catalog, 'isos/a.iso', 'iso')
+    second = _cache(catalog, 'jeos/a.dsk', 'jeos')
+    third = _cache(catalog, 'floppies/a.img', 'floppy')
+
+    size = os.stat(first).st_blocks * 512
+    removed = catalog.enforce({}, size)
+    assert removed == [first, second]
+    assert [path for path, entry in catalog.entries()] == [third]
+
+def test_enforce_skips_locked(tmpdir):
+    catalog = oz.CacheCatalog.CacheCatalog(str(tmpdir))
+    first = _cache(catalog, 'isos/a.iso', 'iso')
+    second = _cache(catalog, 'isos/b.iso', 'iso')
+
+    # another build holds the lock on the first ISO
+    locked_r, locked_w = os.pipe()
+    done_r, done_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        lockfd = os.open(first + '.lock', os.O_RDWR|os.O_CREAT)
+        fcntl.lockf(lockfd, fcntl.LOCK_SH)
+        os.write(locked_w, b'x')
+        os.read(done_r, 1)
+        os._exit(0)
+    try:
+        os.read(locked_r, 1)
+        removed = catalog.enforce({}, 0)
+    finally:
+        os.write(done_w, b'x')
+        os.waitpid(pid, 0)
+
+    assert removed == [second]
+    assert os.path.exists(first)
+
+def test_enforce_removes_unlinked_blob(tmpdir):
+    catalog = oz.CacheCatalog.CacheCatalog(str(tmpdir))
+    blob = os.path.join(str(tmpdir), 'store', 'blobs', 'ab', 'abcd')
+    os.makedirs(os.path.dirname(blob))
+    open(blob, 'wb').write(b'x' * 8192)
+    path = os.path.join(str(tmpdir), 'isos', 'a.iso')
+    os.makedirs(os.path.dirname(path))
+    os.link(blob, path)
+    catalog.use(path, 'iso', {'blob': 'store/blobs/ab/abcd'})
+
+    assert catalog.enforce({'iso': 0}, None) == [path]
+    assert not os.path.exists(path)
+    assert not os.path.exists(blob)
+
+def test_hardlinked_entries_counted_once(tmpdir):
+    catalog = oz.CacheCatalog.CacheCatalog(str(tmpdir))
+    first = _cache(catalog, 'isos/a.iso', 'iso')
+    second = os.path.join(str(tmpdir), 'isos', 'b.iso')
+    os.link(first, second)
+    catalog.use(second, 'iso')
+    other = _cache(catalog, 'isos/c.iso', 'iso')
+
+    size = os.stat(first).st_blocks * 512
+    stats = catalog.stats()
+    assert stats['iso'] == {'count': 3, 'size': 2 * size, 'hits': 0}
+    assert stats['total'] == stats['iso']
+
+    # the hard links are the least recently used, and go together
+    catalog.use(other, 'iso')
+    removed = catalog.enforce({'iso': size}, None)
+    assert sorted(removed) == [first, second]
+    assert os.path.exists(other)
+
+    # nothing needs to be removed to get under a quota of both links
+    third = _cache(catalog, 'isos/d.iso', 'iso')
+    os.link(third, first)
+    catalog.use(first, 'iso')
+    assert catalog.enforce({'iso': 2 * size}, None) == []
+
+def test_enforce_skips_used_jeos_snapshot(tmpdir):
+    catalog = oz.CacheCatalog.CacheCatalog(str(tmpdir))
+    jeos_cache = oz.JeosCache.JeosCache(os.path.join(str(tmpdir), 'jeos'), 4)
+    jeos = _cache(catalog, 'jeos/a.dsk', 'jeos')
+    overlay = os.path.join(str(tmpdir), 'overlay.qcow2')
+    snapshot = jeos_cache.snapshot(jeos, overlay)
+    # just enough of a qcow2 header to name the backing file
+    backing = os.path.abspath(snapshot).encode('utf-8')
+    open(overlay, 'wb').write(struct.pack(">4sIQI", b"QFI\xfb", 2, 20,
+                                          len(backing)) + backing)
+    catalog.use(snapshot, 'jeos', {'snapshot_of': 'a.dsk'})
+
+    size = os.stat(jeos).st_blocks * 512
+    assert catalog.stats()['jeos'] == {'count': 2, 'size': size, 'hits': 0}
+
+    # replacing the JEOS makes the snapshot use space of its own
+    os.unlink(jeos)
+    jeos = _cache(catalog, 'jeos/a.dsk', 'jeos')
+    assert catalog.stats()['jeos']['size'] == 2 * size
+
+    assert catalog.enforce({'jeos': 0}, None) == [jeos]
+    assert os.path.exists(snapshot)
+
+    # once the overlay is gone (and was registered long enough ago), the
+    # snapshot can go too
+    os.unlink(overlay)
+    snapshots = oz.ozutil.read_json_file(jeos_cache.snapshots_path)
+    snapshots[os.path.basename(snapshot)]['overlays'][overlay] = 0
+    oz.ozutil.write_json_file(jeos_cache.snapshots_path, snapshots)
+    assert catalog.enforce({'jeos': 0}, None) == [snapshot]
+    assert not os.path.exists(snapshot)
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+import sys
+import os
+import struct
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.ElTorito
+    import oz.OzException
+except ImportError as e:
+    print(e)
+    print('Unable to import oz.  Is oz installed or in your PYTHONPATH?')
+    sys.exit(1)
+
+CATALOG = 20
+BIOS_IMAGE = 21
+EFI_IMAGE = 22
+
+def validation_entry(platform):
+    entry = struct.pack('<BBH24sH', 1, platform, 0, b'TEST', 0) + b'\x55\xaa'
+    csum = sum(struct.unpack('<16H', entry)) & 0xffff
+    return entry[:28] + struct.pack('<H', (0x10000 - csum) & 0xffff) + entry[30:]
+
+def boot_entry(media, count, rba):
+    return struct.pack('<BBHBBHI', 0x88, media, 0x7c0, 0, 0, count,
+                       rba).ljust(32, b'\0')
+
+def build_iso(path, catalog):
+    pvd = bytearray(2048)
+    pvd[0:7] = b'\x01CD001\x01'
+    boot = bytearray(2048)
+    boot[0:7] = b'\x00CD001\x01'
+    boot[7:30] = b'EL TORITO SPECIFICATION'
+    boot[71:75] = struct.pack('<I', CATALOG)
+
+    fd = open(path, 'wb')
+    fd.seek(16*2048)
+    fd.write(bytes(pvd))
+    fd.write(bytes(boot))
+    fd.seek(CATALOG*2048)
+    fd.write(catalog.ljust(2048, b'\0'))
+    fd.write(b'B'*2048)
+    fd.write(b'E'*4096)
+    fd.close()
+
+def test_bios_only(tmpdir):
+    path = os.path.join(str(tmpdir), 'boot.iso')
+    build_iso(path, validation_entry(0) + boot_entry(0, 4, BIOS_IMAGE))
+
+    catalog = oz.ElTorito.read_boot_catalog(path)
+    assert(len(catalog.entries) == 1)
+    assert(catalog.default.platform == oz.ElTorito.PLATFORM_X86)
+    assert(catalog.find(oz.ElTorito.PLATFORM_EFI) is None)
+
+    out = os.path.join(str(tmpdir), 'boot.bin')
+    oz.ElTorito.extract_boot_image(path, catalog.default, out)
+    assert(open(out, 'rb').read() == b'B'*2048)
+
+def test_efi_section(tmpdir):
+    path = os.path.join(str(tmpdir), 'boot.iso')
+    # the EFI entry is followed by an extension entry
+    build_iso(path, validation_entry(0) + boot_entry(0, 4, BIOS_IMAGE) +
+              struct.pack('<BBH', 0x91, 0xef, 1).ljust(32, b'\0') +
+              boot_entry(0x20, 8, EFI_IMAGE) + b'\x44'.ljust(32, b'\0'))
+
+    catalog = oz.ElTorito.read_boot_catalog(path)
+    assert(len(catalog.entries) == 2)
+    efi = catalog.find(oz.ElTorito.PLATFORM_EFI)
+    assert(efi.load_rba == EFI_IMAGE)
+    assert(efi.media == 0)
+
+    out = os.path.join(str(tmpdir), 'efi.img')
+    oz.ElTorito.extract_boot_image(path, efi, out)
+    assert(open(out, 'rb').read() == b'E'*4096)
+
+def test_bad_checksum(tmpdir):
+    path = os.path.join(str(tmpdir), 'boot.iso')
+    entry = bytearray(validation_entry(0))
+    entry[28] ^= 1
+    build_iso(path, bytes(entry) + boot_entry(0, 4, BIOS_IMAGE))
+
+    with py.test.raises(oz.OzException.OzException):
+        oz.ElTorito.read_boot_catalog(path)
+
+def test_not_bootable(tmpdir):
+    path = os.path.join(str(tmpdir), 'plain.iso')
+    build_iso(path, b'')
+    fd = open(path, 'r+b')
+    fd.seek(17*2048)
+    fd.write(b'\xffCD001\x01')
+    fd.close()
+
+    with py.test.raises(oz.OzException.OzException):
+        oz.ElTorito.read_boot_catalog(path)
+
+def test_boot_catalog_cache(tmpdir):
+    path = os.path.join(str(tmpdir), 'boot.iso')
+    build_iso(path, validation_entry(0) + boot_entry(0, 4, BIOS_IMAGE))
+
+    catalog = oz.ElTorito.boot_catalog(path, 'eltorito-test-digest')
+    os.unlink(path)
+    assert(oz.ElTorito.boot_catalog(path, 'eltorito-test-digest') is catalog)
@@ -12,6 +12,7 @@ except:
     BytesIO = StringIO
 import logging
 import os
+import libvirt
 
 # Find oz library
 prefix = '.'
@@ -380,3 +381,250 @@ def test_geteltorito_bogus_bootp(tmpdir):
 
     with py.test.raises(Exception):
         guest._geteltorito(src, dst)
+
+def test_stage_iso_overlay(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[paths]\ndata_dir=%s" % (route, str(tmpdir))))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+
+    # pretend that the ISO was mounted on mountdir
+    mountdir = os.path.join(str(tmpdir), 'mount')
+    os.makedirs(os.path.join(mountdir, 'isolinux'))
+    open(os.path.join(mountdir, 'isolinux', 'isolinux.cfg'), 'w').write('cfg')
+    open(os.path.join(mountdir, 'isolinux', 'vmlinuz'), 'w').write('kernel')
+    def _mount_iso(path):
+        guest.iso_mount = (mountdir, ['true'])
+        return True
+    guest._mount_iso = _mount_iso
+
+    os.makedirs(guest.iso_contents)
+    assert(guest._stage_iso_overlay(['isolinux/isolinux.cfg']))
+
+    cfg = os.path.join(guest.iso_contents, 'isolinux', 'isolinux.cfg')
+    kernel = os.path.join(guest.iso_contents, 'isolinux', 'vmlinuz')
+    assert(not os.path.islink(cfg))
+    assert(open(cfg).read() == 'cfg')
+    assert(os.readlink(kernel) == os.path.join(mountdir, 'isolinux', 'vmlinuz'))
+
+def test_modified_media_key(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[paths]\ndata_dir=%s" % (route, str(tmpdir))))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+
+    orig = os.path.join(str(tmpdir), 'orig.iso')
+    open(orig, 'w').write('original media')
+
+    key = guest._modified_media_key([orig])
+    assert(guest._modified_media_key([orig]) == key)
+
+    # a different root password changes the rendered kickstart
+    guest.rootpw = 'changed'
+    changed = guest._modified_media_key([orig])
+    assert(changed != key)
+
+    # and so do different original media
+    open(orig, 'w').write('other original media')
+    assert(guest._modified_media_key([orig]) != changed)
+
+    cached = guest._modified_media_cache_path('/cache/f14-url-oz.iso', [orig])
+    assert(cached.startswith('/cache/f14-url-oz-'))
+    assert(cached.endswith('.iso'))
+
+def test_generate_xml_side_media(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[paths]\ndata_dir=%s" % (route, str(tmpdir))))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+
+    cddev = guest._InstallDev("cdrom", "/path/to/orig.iso", "hdc")
+    sidedev = guest._InstallDev("floppy", "/path/to/side.img", "fda")
+    xml = guest._generate_xml("cdrom", cddev, sidedev=sidedev)
+
+    assert("/path/to/orig.iso" in xml)
+    assert("/path/to/side.img" in xml)
+    assert('<target dev="fda"/>' in xml)
+
+def test_tar_extractor(tmpdir):
+    import tarfile
+    import threading
+
+    src = os.path.join(str(tmpdir), 'src')
+    os.makedirs(os.path.join(src, 'isolinux'))
+    open(os.path.join(src, 'isolinux', 'isolinux.cfg'), 'w').write('cfg')
+    os.chmod(os.path.join(src, 'isolinux', 'isolinux.cfg'), 0o444)
+    os.chmod(os.path.join(src, 'isolinux'), 0o555)
+
+    rd, wr = os.pipe()
+    dest = os.path.join(str(tmpdir), 'dest')
+    os.makedirs(dest)
+    extractor = oz.Guest._TarExtractor(os.fdopen(rd, 'rb'), dest)
+    extractor.start()
+    out = os.fdopen(wr, 'wb')
+    tar = tarfile.open(fileobj=out, mode='w|')
+    tar.add(os.path.join(src, 'isolinux'), 'isolinux')
+    tar.close()
+    out.close()
+    extractor.join()
+
+    assert(extractor.error is None)
+    cfg = os.path.join(dest, 'isolinux', 'isolinux.cfg')
+    assert(open(cfg).read() == 'cfg')
+    assert(os.stat(cfg).st_mode & 0o777 == 0o644)
+    assert(os.stat(os.path.join(dest, 'isolinux')).st_mode & 0o777 == 0o755)
+
+def test_jeos_snapshot(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\nimage_type=qcow2\n[paths]\ndata_dir=%s\n[cache]\njeos_overlay=yes" % (route, str(tmpdir))))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    assert(guest.jeos_overlay)
+
+    os.makedirs(guest.jeos_cache_dir)
+    open(guest.jeos_filename, 'w').write('jeos')
+    mode = os.stat(guest.jeos_filename).st_mode
+    snapshot = guest._jeos_snapshot()
+    assert(os.path.samefile(snapshot, guest.jeos_filename))
+    assert(os.stat(guest.jeos_filename).st_mode == mode)
+    assert(guest._jeos_snapshot() == snapshot)
+
+    # refreshing the cache leaves the snapshot alone
+    os.unlink(guest.jeos_filename)
+    open(guest.jeos_filename, 'w').write('new jeos')
+    assert(guest._jeos_snapshot() != snapshot)
+    assert(open(snapshot).read() == 'jeos')
+
+    # a disk image that is not an overlay is left alone
+    guest.flatten_diskimage()
+
+class FakePool(object):
+    def __init__(self, path):
+        self.path = path
+        self.descs = 0
+
+    def XMLDesc(self, flags):
+        self.descs += 1
+        return "<pool type='dir'><target><path>%s</path></target></pool>" % (self.path)
+
+class FakeConn(object):
+    def __init__(self, pools):
+        self.pools = pools
+
+    def getURI(self):
+        return 'test:///fake'
+
+    def listDefinedStoragePools(self):
+        return []
+
+    def listStoragePools(self):
+        return list(self.pools.keys())
+
+    def storagePoolLookupByName(self, name):
+        if name not in self.pools:
+            raise libvirt.libvirtError("Storage pool not found")
+        return self.pools[name]
+
+def _pool_descs(conn):
+    return sum([pool.descs for pool in conn.pools.values()])
+
+def test_storage_pool_index(tmpdir):
+    conn = FakeConn(dict([('pool%d' % i, FakePool('/dir%d' % i)) for i in range(100)]))
+    path = os.path.join(str(tmpdir), 'storagepools.json')
+
+    assert(oz.Guest._StoragePoolIndex(path).lookup(conn, '/dir42') is conn.pools['pool42'])
+    assert(_pool_descs(conn) == 100)
+
+    # later runs only look at the pool that is found
+    index = oz.Guest._StoragePoolIndex(path)
+    assert(index.lookup(conn, '/dir7') is conn.pools['pool7'])
+    assert(_pool_descs(conn) == 101)
+
+    # a directory that no pool manages needs a full scan
+    assert(index.lookup(conn, '/elsewhere') is None)
+    assert(_pool_descs(conn) == 201)
+
+    # a pool that was redefined to manage the directory is found
+    conn.pools['pool3'] = FakePool('/elsewhere')
+    assert(index.lookup(conn, '/elsewhere') is conn.pools['pool3'])
+    # and the directory it used to manage is no longer found
+    assert(index.lookup(conn, '/dir3') is None)
+
+    # a pool that is gone is not used
+    del conn.pools['pool7']
+    assert(index.lookup(conn, '/dir7') is None)
+
+def test_use_byte_ranges(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[paths]\ndata_dir=%s" % (route, str(tmpdir))))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    assert(guest._use_byte_ranges({'effective-url': 'http://example.org/boot.iso',
+                                   'accept-ranges': 'bytes'}))
+    assert(not guest._use_byte_ranges({'effective-url': 'http://example.org/boot.iso',
+                                       'accept-ranges': 'none'}))
+    # libcurl reports byte ranges for FTP too, but FTP media is fetched in
+    # one piece
+    assert(not guest._use_byte_ranges({'effective-url': 'ftp://example.org/boot.iso',
+                                       'accept-ranges': 'bytes'}))
+
+def test_jeos_filename_inputs(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[paths]\ndata_dir=%s" % (route, str(tmpdir))))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    other = oz.GuestFactory.guest_factory(tdl, config, None)
+    assert(guest.jeos_filename == other.jeos_filename)
+    assert(os.path.dirname(guest.jeos_filename) == guest.jeos_cache_dir)
+    assert(guest.jeos_filename.endswith('.dsk'))
+
+    # a JEOS installed with another root password is a different variant
+    other = oz.GuestFactory.guest_factory(tdl, config, None)
+    other.rootpw = 'secret'
+    assert(guest.jeos_filename != other.jeos_filename)
+    assert(guest.jeos_inputs['auto_sha256'] != other.jeos_inputs['auto_sha256'])
+
+def test_side_media_url_install(tmpdir, monkeypatch):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[paths]\ndata_dir=%s\noutput_dir=%s" % (route, str(tmpdir), str(tmpdir))))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+
+    class FakeISO(object):
+        def __init__(self, path):
+            pass
+        def lookup(self, name):
+            return name
+        def extract_file(self, record, dest, mode):
+            open(dest, 'w').write(record)
+        def close(self):
+            pass
+    monkeypatch.setattr(oz.ISO, 'ISO9660Image', FakeISO)
+
+    floppies = []
+    guest._create_side_floppy = lambda files: floppies.append(sorted(files.values()))
+
+    assert(guest._generate_side_media())
+    assert(floppies == [['ks.cfg']])
+    assert(open(guest.kernelfname).read() == 'isolinux/vmlinuz')
+
+    # the stock kickstarts have no install source, so the command line has
+    # to carry the same one as the modified ISO
+    args = guest.side_media_cmdline.split()
+    assert('ks=hd:fd0:/ks.cfg' in args)
+    assert('repo=' + guest.url in args or 'method=' + guest.url in args)
+    assert(guest._boot_args('cdrom:/ks.cfg').split()[1:] == args[1:])
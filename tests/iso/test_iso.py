@@ -0,0 +1,264 @@
+#!/usr/bin/python
+
+import sys
+import os
+import struct
+import stat
+
+# Find oz library
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.ISO
+    import oz.ISORemaster
+    import oz.OzException
+except ImportError as e:
+    print(e)
+    print('Unable to import oz.  Is oz installed or in your PYTHONPATH?')
+    sys.exit(1)
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# sector layout of the images built below
+ROOT = 18
+SUBDIR = 19
+DATA = 20
+
+def both16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+def both32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+def record(name, extent, length, flags=0, sysuse=b''):
+    pad = b''
+    if len(name) % 2 == 0:
+        pad = b'\0'
+    reclen = 33 + len(name) + len(pad) + len(sysuse)
+    if reclen % 2:
+        sysuse += b'\0'
+        reclen += 1
+    date = struct.pack('=BBBBBBb', 113, 10, 17, 12, 0, 0, 0)
+    return (struct.pack('=BB', reclen, 0) + both32(extent) + both32(length) +
+            date + struct.pack('=BBB', flags, 0, 0) + both16(1) +
+            struct.pack('=B', len(name)) + name + pad + sysuse)
+
+def susp(sig, body):
+    return sig + struct.pack('=BB', len(body) + 4, 1) + body
+
+def build_iso(path, rootrecs, subrecs, files, rock_ridge=False):
+    dotsu = b''
+    if rock_ridge:
+        dotsu = susp(b'SP', b'\xbe\xef\x00')
+    root = (record(b'\x00', ROOT, 2048, 2, dotsu) +
+            record(b'\x01', ROOT, 2048, 2) + b''.join(rootrecs))
+    sub = (record(b'\x00', SUBDIR, 2048, 2) + record(b'\x01', ROOT, 2048, 2) +
+           b''.join(subrecs))
+
+    pvd = bytearray(2048)
+    pvd[0:7] = b'\x01CD001\x01'
+    pvd[8:40] = b'LINUX'.ljust(32)
+    pvd[40:72] = b'TESTVOL'.ljust(32)
+    pvd[80:88] = both32(DATA + len(files))
+    pvd[128:132] = both16(2048)
+    pvd[156:190] = record(b'\x00', ROOT, 2048, 2)
+
+    fd = open(path, 'wb')
+    fd.seek(16*2048)
+    fd.write(bytes(pvd))
+    fd.write(b'\xffCD001\x01'.ljust(2048, b'\0'))
+    fd.write(root.ljust(2048, b'\0'))
+    fd.write(sub.ljust(2048, b'\0'))
+    for data in files:
+        fd.write(data.ljust(2048, b'\0'))
+    fd.close()
+
+def plain_iso(path):
+    build_iso(path,
+              [record(b'ISOLINUX', SUBDIR, 2048, 2),
+               record(b'README.TXT;1', DATA, 5),
+               record(b'KS.;1', DATA + 1, 3)],
+              [record(b'ISOLINUX.CFG;1', DATA + 2, 7)],
+              [b'hello', b'ks\n', b'default'])
+
+# test oz.ISO.ISO9660Image
+def test_iso_not_an_iso(tmpdir):
+    path = os.path.join(str(tmpdir), 'bogus.iso')
+    open(path, 'wb').write(b'\0'*20*2048)
+
+    with py.test.raises(oz.OzException.OzException):
+        oz.ISO.ISO9660Image(path)
+
+def test_iso_truncated(tmpdir):
+    path = os.path.join(str(tmpdir), 'short.iso')
+    open(path, 'wb').write(b'foo')
+
+    with py.test.raises(oz.OzException.OzException):
+        oz.ISO.ISO9660Image(path)
+
+def test_iso_plain(tmpdir):
+    path = os.path.join(str(tmpdir), 'plain.iso')
+    plain_iso(path)
+
+    iso = oz.ISO.ISO9660Image(path)
+    assert(not iso.rock_ridge)
+    assert(not iso.joliet)
+    assert(iso.volume_identifier == 'TESTVOL')
+    assert(iso.tree_size() == 23*2048)
+    assert(sorted([r.name for r in iso.listdir()]) == ['isolinux', 'ks', 'readme.txt'])
+    assert(iso.lookup('isolinux').is_dir())
+    assert(iso.read_file(iso.lookup('/isolinux/isolinux.cfg')) == b'default')
+    assert(iso.lookup('isolinux/missing') is None)
+    assert(iso.lookup('readme.txt/foo') is None)
+    iso.close()
+
+def test_iso_extract(tmpdir):
+    path = os.path.join(str(tmpdir), 'plain.iso')
+    plain_iso(path)
+    dest = os.path.join(str(tmpdir), 'out')
+    os.mkdir(dest)
+
+    iso = oz.ISO.ISO9660Image(path)
+    iso.extract(dest)
+    iso.close()
+
+    cfg = os.path.join(dest, 'isolinux', 'isolinux.cfg')
+    assert(open(cfg, 'rb').read() == b'default')
+    assert(open(os.path.join(dest, 'ks'), 'rb').read() == b'ks\n')
+    # extracted files and directories have to be writable
+    assert(os.stat(cfg).st_mode & stat.S_IWUSR)
+    assert(os.stat(os.path.join(dest, 'isolinux')).st_mode & stat.S_IWUSR)
+
+def test_iso_rock_ridge(tmpdir):
+    path = os.path.join(str(tmpdir), 'rr.iso')
+    px = susp(b'PX', both32(0o100555) + both32(1) + both32(0) + both32(0))
+    build_iso(path,
+              [record(b'ISOLINUX', SUBDIR, 2048, 2,
+                      susp(b'NM', b'\0isolinux')),
+               record(b'LONGFILE.TXT;1', DATA, 5,
+                      sysuse=susp(b'NM', b'\0a long file name.txt') + px),
+               record(b'LINK.;1', DATA + 1, 0,
+                      sysuse=susp(b'NM', b'\0link') +
+                      susp(b'SL', b'\0' + b'\0\x08isolinux' + b'\0\x0cisolinux.cfg'))],
+              [record(b'ISOLINUX.CFG;1', DATA + 2, 7,
+                      sysuse=susp(b'NM', b'\0isolinux.cfg'))],
+              [b'hello', b'', b'default'], rock_ridge=True)
+
+    iso = oz.ISO.ISO9660Image(path)
+    assert(iso.rock_ridge)
+    names = sorted([r.name for r in iso.listdir()])
+    assert(names == ['a long file name.txt', 'isolinux', 'link'])
+    assert(iso.lookup('link').symlink == 'isolinux/isolinux.cfg')
+
+    dest = os.path.join(str(tmpdir), 'out')
+    os.mkdir(dest)
+    iso.extract(dest)
+    iso.close()
+
+    longfile = os.path.join(dest, 'a long file name.txt')
+    assert(stat.S_IMODE(os.stat(longfile).st_mode) == 0o755)
+    assert(os.readlink(os.path.join(dest, 'link')) == 'isolinux/isolinux.cfg')
+    assert(open(os.path.join(dest, 'link'), 'rb').read() == b'default')
+
+def test_iso_rock_ridge_malicious_names(tmpdir):
+    for name in [b'..', b'.', b'../escaped', b'a/b', b'a\0b']:
+        path = os.path.join(str(tmpdir), 'evil.iso')
+        build_iso(path,
+                  [record(b'EVIL.;1', DATA, 5,
+                          sysuse=susp(b'NM', b'\0' + name))],
+                  [], [b'hello'], rock_ridge=True)
+
+        dest = os.path.join(str(tmpdir), 'out')
+        os.mkdir(dest)
+        iso = oz.ISO.ISO9660Image(path)
+        try:
+            with py.test.raises(oz.OzException.OzException):
+                iso.extract(dest)
+        finally:
+            iso.close()
+        assert(os.listdir(dest) == [])
+        assert(not os.path.exists(os.path.join(str(tmpdir), 'escaped')))
+        os.rmdir(dest)
+
+def test_iso_multi_extent(tmpdir):
+    path = os.path.join(str(tmpdir), 'multi.iso')
+    build_iso(path,
+              [record(b'BIG.;1', DATA, 2048, oz.ISO.FLAG_MULTI_EXTENT),
+               record(b'BIG.;1', DATA + 1, 3)],
+              [],
+              [b'a'*2048, b'bcd'])
+
+    iso = oz.ISO.ISO9660Image(path)
+    records = iso.listdir()
+    assert(len(records) == 1)
+    assert(records[0].size() == 2051)
+    assert(iso.read_file(records[0]) == b'a'*2048 + b'bcd')
+    iso.close()
+
+def stage_overlay(path, tmpdir):
+    mount = os.path.join(str(tmpdir), 'mount')
+    contents = os.path.join(str(tmpdir), 'contents')
+    os.mkdir(mount)
+    os.mkdir(contents)
+    iso = oz.ISO.ISO9660Image(path)
+    iso.extract(mount)
+    iso.close()
+    for dirpath, dirnames, filenames in os.walk(mount):
+        dest = os.path.join(contents, os.path.relpath(dirpath, mount))
+        for name in dirnames:
+            os.mkdir(os.path.join(dest, name))
+        for name in filenames:
+            os.symlink(os.path.join(dirpath, name), os.path.join(dest, name))
+    return (mount, contents)
+
+# test oz.ISORemaster.ISORemaster
+def test_remaster(tmpdir):
+    path = os.path.join(str(tmpdir), 'plain.iso')
+    plain_iso(path)
+    mount, contents = stage_overlay(path, tmpdir)
+
+    cfg = os.path.join(contents, 'isolinux', 'isolinux.cfg')
+    os.unlink(cfg)
+    open(cfg, 'wb').write(b'default ks')
+    os.mkdir(os.path.join(contents, 'newdir'))
+    open(os.path.join(contents, 'newdir', 'new.txt'), 'wb').write(b'new')
+
+    output = os.path.join(str(tmpdir), 'out.iso')
+    remaster = oz.ISORemaster.ISORemaster(path, contents, mount)
+    remaster.write(output, volume_identifier='Custom')
+    remaster.close()
+
+    # the original data is left where it was
+    assert(open(output, 'rb').read()[DATA*2048:23*2048] == open(path, 'rb').read()[DATA*2048:])
+
+    iso = oz.ISO.ISO9660Image(output)
+    assert(iso.volume_identifier == 'Custom')
+    assert(sorted([r.name for r in iso.listdir()]) == ['isolinux', 'ks', 'newdir', 'readme.txt'])
+    assert(iso.read_file(iso.lookup('isolinux/isolinux.cfg')) == b'default ks')
+    assert(iso.read_file(iso.lookup('newdir/new.txt')) == b'new')
+    assert(iso.read_file(iso.lookup('readme.txt')) == b'hello')
+    assert(iso.tree_size() == os.path.getsize(output))
+    iso.close()
+
+def test_remaster_removed_file(tmpdir):
+    path = os.path.join(str(tmpdir), 'plain.iso')
+    plain_iso(path)
+    mount, contents = stage_overlay(path, tmpdir)
+    os.unlink(os.path.join(contents, 'ks'))
+
+    output = os.path.join(str(tmpdir), 'out.iso')
+    remaster = oz.ISORemaster.ISORemaster(path, contents, mount)
+    with py.test.raises(oz.OzException.OzException):
+        remaster.write(output)
+    remaster.close()
+    assert(not os.path.exists(output))
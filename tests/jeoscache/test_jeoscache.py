@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+import sys
+import os
+import struct
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.JeosCache
+    import oz.ozutil
+except ImportError as e:
+    print(e)
+    print('Unable to import oz.  Is oz installed or in your PYTHONPATH?')
+    sys.exit(1)
+
+def _install(cache, osname, key, inputs=None):
+    path = cache.path(osname, key, 'dsk')
+    open(path, 'w').write(key)
+    cache.add(path, osname, inputs or {'key': key})
+    return path
+
+def _overlay(path, backing):
+    # just enough of a qcow2 header to name the backing file
+    backing = backing.encode('utf-8')
+    header = struct.pack(">4sIQI", b"QFI\xfb", 2, 20, len(backing))
+    open(path, 'wb').write(header + backing)
+
+def test_path(tmpdir):
+    cache = oz.JeosCache.JeosCache(str(tmpdir), 4)
+    assert cache.path('Fedora19x86_64', 'abc', 'qcow2') == os.path.join(str(tmpdir), 'Fedora19x86_64-abc.qcow2')
+
+def test_add_records_inputs(tmpdir):
+    cache = oz.JeosCache.JeosCache(str(tmpdir), 4)
+    _install(cache, 'Fedora19x86_64', 'abc', {'disksize': '10'})
+    index = cache._read_index()
+    entry = index['Fedora19x86_64-abc.dsk']
+    assert entry['os'] == 'Fedora19x86_64'
+    assert entry['inputs'] == {'disksize': '10'}
+
+def test_evict_least_recently_used(tmpdir):
+    cache = oz.JeosCache.JeosCache(str(tmpdir), 2)
+    first = _install(cache, 'Fedora19x86_64', 'a')
+    second = _install(cache, 'Fedora19x86_64', 'b')
+    other = _install(cache, 'RHEL-6.4x86_64', 'c')
+    # using the first variant makes the second the least recently used
+    cache.touch(first)
+    third = _install(cache, 'Fedora19x86_64', 'd')
+
+    assert os.path.exists(first)
+    assert not os.path.exists(second)
+    assert os.path.exists(third)
+    assert os.path.exists(other)
+    assert sorted(cache._read_index().keys()) == ['Fedora19x86_64-a.dsk',
+                                                  'Fedora19x86_64-d.dsk',
+                                                  'RHEL-6.4x86_64-c.dsk']
+
+def test_missing_variants_dropped(tmpdir):
+    cache = oz.JeosCache.JeosCache(str(tmpdir), 4)
+    first = _install(cache, 'Fedora19x86_64', 'a')
+    os.unlink(first)
+    _install(cache, 'Fedora19x86_64', 'b')
+    assert list(cache._read_index().keys()) == ['Fedora19x86_64-b.dsk']
+
+def test_snapshot_kept_while_used(tmpdir):
+    cache = oz.JeosCache.JeosCache(str(tmpdir), 4)
+    jeos = _install(cache, 'Fedora19x86_64', 'a')
+    os.chmod(jeos, 0o644)
+    overlay = os.path.join(str(tmpdir), 'overlay.qcow2')
+    snapshot = cache.snapshot(jeos, overlay)
+    assert os.path.samefile(snapshot, jeos)
+    # the cached JEOS itself is left writable
+    assert os.stat(jeos).st_mode & 0o777 == 0o644
+    assert cache.snapshot(jeos, overlay) == snapshot
+
+    _overlay(overlay, os.path.abspath(snapshot))
+    cache.snapshot_grace = 0
+    # refreshing the variant leaves the snapshot alone
+    os.unlink(jeos)
+    _install(cache, 'Fedora19x86_64', 'a')
+    assert open(snapshot).read() == 'a'
+    assert cache.in_use(snapshot)
+
+    # once the overlay is gone, so is the snapshot
+    os.unlink(overlay)
+    assert not cache.in_use(snapshot)
+    assert not os.path.exists(snapshot)
+
+def test_snapshot_removed_with_evicted_variant(tmpdir):
+    cache = oz.JeosCache.JeosCache(str(tmpdir), 1)
+    jeos = _install(cache, 'Fedora19x86_64', 'a')
+    overlay = os.path.join(str(tmpdir), 'overlay.qcow2')
+    snapshot = cache.snapshot(jeos, overlay)
+    # the overlay is flattened, so it does not use the snapshot any more
+    _overlay(overlay, '')
+    cache.snapshot_grace = 0
+    _install(cache, 'Fedora19x86_64', 'b')
+    assert not os.path.exists(jeos)
+    assert not os.path.exists(snapshot)
+    assert oz.ozutil.read_json_file(cache.snapshots_path) == {}
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+import sys
+import os
+import struct
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.MediaIndex
+    import oz.MediaStore
+    import oz.OzException
+except ImportError as e:
+    print(e)
+    print('Unable to import oz.  Is oz installed or in your PYTHONPATH?')
+    sys.exit(1)
+
+ROOT = 18
+DATA = 19
+
+def both16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+def both32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+def record(name, extent, length, flags=0, sysuse=b''):
+    pad = b''
+    if len(name) % 2 == 0:
+        pad = b'\0'
+    reclen = 33 + len(name) + len(pad) + len(sysuse)
+    if reclen % 2:
+        sysuse += b'\0'
+        reclen += 1
+    date = struct.pack('=BBBBBBb', 113, 10, 17, 12, 0, 0, 0)
+    return (struct.pack('=BB', reclen, 0) + both32(extent) + both32(length) +
+            date + struct.pack('=BBB', flags, 0, 0) + both16(1) +
+            struct.pack('=B', len(name)) + name + pad + sysuse)
+
+def susp(sig, body):
+    return sig + struct.pack('=BB', len(body) + 4, 1) + body
+
+def build_iso(path, files, volid=b'TESTVOL'):
+    # files is a list of (Rock Ridge name, contents) in the root directory
+    root = (record(b'\x00', ROOT, 2048, 2, susp(b'SP', b'\xbe\xef\x00')) +
+            record(b'\x01', ROOT, 2048, 2))
+    for i, (name, data) in enumerate(files):
+        root += record(('F%d.;1' % i).encode('ascii'), DATA + i, len(data),
+                       sysuse=susp(b'NM', b'\0' + name))
+
+    pvd = bytearray(2048)
+    pvd[0:7] = b'\x01CD001\x01'
+    pvd[8:40] = b'LINUX'.ljust(32)
+    pvd[40:72] = volid.ljust(32)
+    pvd[80:88] = both32(DATA + len(files))
+    pvd[128:132] = both16(2048)
+    pvd[156:190] = record(b'\x00', ROOT, 2048, 2)
+
+    fd = open(path, 'wb')
+    fd.seek(16*2048)
+    fd.write(bytes(pvd))
+    fd.write(b'\xffCD001\x01'.ljust(2048, b'\0'))
+    fd.write(root.ljust(2048, b'\0'))
+    for name, data in files:
+        fd.write(data.ljust(2048, b'\0'))
+    fd.close()
+
+def identify(tmpdir, files, volid=b'TESTVOL'):
+    path = os.path.join(str(tmpdir), 'media.iso')
+    build_iso(path, files, volid)
+    return oz.MediaIndex.identify(oz.MediaIndex.fingerprint(path))
+
+FEDORA_TREEINFO = b"""[general]
+family = Fedora
+timestamp = 1357758411.37
+variant = Fedora
+version = 18
+packagedir =
+arch = x86_64
+"""
+
+def test_identify_treeinfo(tmpdir):
+    assert(identify(tmpdir, [(b'.treeinfo', FEDORA_TREEINFO)]) ==
+           {'distro': 'Fedora', 'update': '18', 'arch': 'x86_64'})
+
+    rhel = b"[general]\nfamily = Red Hat Enterprise Linux\nversion = 6.4\narch = x86_64\n"
+    assert(identify(tmpdir, [(b'.treeinfo', rhel)]) ==
+           {'distro': 'RHEL-6', 'update': '4', 'arch': 'x86_64'})
+
+    centos = b"[general]\nfamily = CentOS\nversion = 5.9\narch = i386\n"
+    assert(identify(tmpdir, [(b'.treeinfo', centos)]) ==
+           {'distro': 'CentOS-5', 'update': 'U9', 'arch': 'i386'})
+
+def test_identify_discinfo(tmpdir):
+    discinfo = b"1161110513.520981\nFedora Core 6\ni386\n1,2,3,4,5\n"
+    assert(identify(tmpdir, [(b'.discinfo', discinfo)]) ==
+           {'distro': 'FedoraCore', 'update': '6', 'arch': 'i386'})
+
+def test_identify_diskdefines(tmpdir):
+    defines = (b'#define DISKNAME  Ubuntu-Server 12.04.2 LTS "Precise Pangolin" - Release amd64\n'
+               b'#define TYPE  binary\n#define ARCH  amd64\n')
+    assert(identify(tmpdir, [(b'README.diskdefines', defines)]) ==
+           {'distro': 'Ubuntu', 'update': '12.04.2', 'arch': 'x86_64'})
+
+    defines = b'#define DISKNAME  Debian GNU/Linux 7.0.0 "Wheezy" - Official amd64 CD Binary-1 20130504-14:43\n'
+    assert(identify(tmpdir, [(b'README.diskdefines', defines)]) ==
+           {'distro': 'Debian', 'update': '7', 'arch': 'x86_64'})
+
+def test_identify_suse_content(tmpdir):
+    content = b"CONTENTSTYLE 11\nLABEL openSUSE 12.3\nVERSION 12.3\nBASEARCHS x86_64\n"
+    assert(identify(tmpdir, [(b'content', content)]) ==
+           {'distro': 'OpenSUSE', 'update': '12.3', 'arch': 'x86_64'})
+
+def test_identify_volume_id(tmpdir):
+    assert(identify(tmpdir, [], b'Fedora 18 x86_64 DVD') ==
+           {'distro': 'Fedora', 'update': '18', 'arch': 'x86_64'})
+    assert(identify(tmpdir, [(b'README.TXT', b'hello')]) is None)
+
+def test_identify_unsupported(tmpdir):
+    # RHEL-7 is not in GuestFactory.os_dict
+    rhel = b"[general]\nfamily = Red Hat Enterprise Linux\nversion = 7.0\narch = x86_64\n"
+    assert(identify(tmpdir, [(b'.treeinfo', rhel)]) is None)
+
+def test_index_caches(tmpdir):
+    path = os.path.join(str(tmpdir), 'media.iso')
+    build_iso(path, [(b'.treeinfo', FEDORA_TREEINFO)])
+    store = oz.MediaStore.MediaStore(os.path.join(str(tmpdir), 'store'))
+    index = oz.MediaIndex.MediaIndex(os.path.join(str(tmpdir), 'fingerprints'),
+                                     store)
+    expected = {'distro': 'Fedora', 'update': '18', 'arch': 'x86_64'}
+    assert(index.lookup(path, 'abc') == expected)
+
+    # the second lookup is answered from the index, without reading the ISO
+    os.unlink(path)
+    open(path, 'wb').write(b'not an iso')
+    assert(index.lookup(path, 'abc') == expected)
+    with py.test.raises(oz.OzException.OzException):
+        index.lookup(path, 'def')
+
+class FakeTDL(object):
+    def __init__(self, iso):
+        self.installtype = 'iso'
+        self.iso = iso
+        self.distro = None
+        self.update = None
+        self.arch = None
+
+def test_detect_tdl_os(tmpdir):
+    path = os.path.join(str(tmpdir), 'media.iso')
+    build_iso(path, [(b'.treeinfo', FEDORA_TREEINFO)])
+
+    config = configparser.SafeConfigParser()
+    config.add_section('paths')
+    config.set('paths', 'data_dir', os.path.join(str(tmpdir), 'data'))
+
+    tdl = FakeTDL('file://' + path)
+    tdl.update = '17'
+    oz.MediaIndex.detect_tdl_os(tdl, config)
+    assert((tdl.distro, tdl.update, tdl.arch) == ('Fedora', '17', 'x86_64'))
+
+    # remote media that has never been downloaded cannot be detected
+    tdl = FakeTDL('http://example.com/media.iso')
+    with py.test.raises(oz.OzException.OzException):
+        oz.MediaIndex.detect_tdl_os(tdl, config)
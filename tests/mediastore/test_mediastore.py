@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+import sys
+import os
+import hashlib
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.MediaStore
+except ImportError as e:
+    print(e)
+    print('Unable to import oz.  Is oz installed or in your PYTHONPATH?')
+    sys.exit(1)
+
+def _make_media(tmpdir, name, data):
+    path = os.path.join(str(tmpdir), name)
+    open(path, 'wb').write(data)
+    return path, {'sha256': hashlib.sha256(data).hexdigest(),
+                  'md5': hashlib.md5(data).hexdigest()}
+
+def test_add_links_blob(tmpdir):
+    store = oz.MediaStore.MediaStore(os.path.join(str(tmpdir), 'store'))
+    path, digests = _make_media(tmpdir, 'a.iso', b'media')
+    blob = store.add(path, digests, 'http://example.com/a.iso', None)
+    assert(blob == store.blob_path(digests['sha256']))
+    assert(os.path.samefile(blob, path))
+
+def test_add_dedups(tmpdir):
+    store = oz.MediaStore.MediaStore(os.path.join(str(tmpdir), 'store'))
+    path1, digests = _make_media(tmpdir, 'a.iso', b'media')
+    path2, digests = _make_media(tmpdir, 'b.iso', b'media')
+    store.add(path1, digests, 'http://example.com/a.iso', None)
+    blob = store.add(path2, digests, 'http://example.org/b.iso', None)
+    assert(os.path.samefile(path1, path2))
+    assert(os.stat(blob).st_nlink == 3)
+
+def test_lookup_url(tmpdir):
+    store = oz.MediaStore.MediaStore(os.path.join(str(tmpdir), 'store'))
+    path, digests = _make_media(tmpdir, 'a.iso', b'media')
+    validators = {'etag': '"1"', 'content_length': 5}
+    blob = store.add(path, digests, 'http://example.com/a.iso', validators)
+    assert(store.lookup_url('http://example.com/a.iso', validators) == blob)
+    assert(store.lookup_url('http://example.com/a.iso', {'etag': '"2"', 'content_length': 5}) is None)
+    assert(store.lookup_url('http://example.com/a.iso', None) is None)
+    assert(store.lookup_url('http://example.com/b.iso', validators) is None)
+
+def test_lookup_sum(tmpdir):
+    store = oz.MediaStore.MediaStore(os.path.join(str(tmpdir), 'store'))
+    path, digests = _make_media(tmpdir, 'a.iso', b'media')
+    blob = store.add(path, digests, 'http://example.com/a.iso', None)
+    assert(store.lookup_sum('md5', digests['md5'].upper()) == blob)
+    assert(store.lookup_sum('sha1', hashlib.sha1(b'media').hexdigest()) is None)
+    assert(store.sums(blob) == digests)
+
+def test_lookup_missing_blob(tmpdir):
+    store = oz.MediaStore.MediaStore(os.path.join(str(tmpdir), 'store'))
+    path, digests = _make_media(tmpdir, 'a.iso', b'media')
+    blob = store.add(path, digests, 'http://example.com/a.iso', None)
+    os.unlink(blob)
+    assert(store.lookup_sum('md5', digests['md5']) is None)
+
+def test_name_url(tmpdir):
+    store = oz.MediaStore.MediaStore(os.path.join(str(tmpdir), 'store'))
+    path, digests = _make_media(tmpdir, 'a.iso', b'media')
+    assert(store.name_url(path) is None)
+    store.add(path, digests, 'http://example.com/a.iso', None)
+    assert(store.name_url(path) == 'http://example.com/a.iso')
+
+def test_digest(tmpdir):
+    store = oz.MediaStore.MediaStore(os.path.join(str(tmpdir), 'store'))
+    path, digests = _make_media(tmpdir, 'a.iso', b'media')
+    assert(store.digest(path) is None)
+    store.add(path, digests, 'http://example.com/a.iso', None)
+    assert(store.digest(path) == digests['sha256'])
+
+    # a file that replaced the link is not the blob any more
+    os.unlink(path)
+    open(path, 'wb').write(b'other')
+    assert(store.digest(path) is None)
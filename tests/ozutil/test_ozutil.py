@@ -2,6 +2,8 @@
 
 import sys
 import os
+import hashlib
+import struct
 
 try:
     import py.test
@@ -162,6 +164,31 @@ def test_copy_sparse_dest_not_exists(tmpdir):
     dstname = os.path.join(str(tmpdir), 'dst')
     oz.ozutil.copyfile_sparse(srcname, dstname)
 
+def test_copy_sparse_dest_dir_not_exists(tmpdir):
+    srcname = os.path.join(str(tmpdir), 'src')
+    open(srcname, 'w').write('src')
+    dstname = os.path.join(str(tmpdir), 'subdir', 'dst')
+    oz.ozutil.copyfile_sparse(srcname, dstname)
+    assert(open(dstname, 'r').read() == 'src')
+
+def test_copy_sparse_holes(tmpdir):
+    data = os.urandom(100*1024)
+    srcname = os.path.join(str(tmpdir), 'src')
+    outfd = open(srcname, 'wb')
+    outfd.write(data)
+    # zeros that were written out, followed by a hole, some more data, and
+    # a hole at the end
+    outfd.write(b'\0'*1024*1024)
+    outfd.seek(10*1024*1024)
+    outfd.write(data)
+    outfd.truncate(20*1024*1024)
+    outfd.close()
+
+    dstname = os.path.join(str(tmpdir), 'dst')
+    oz.ozutil.copyfile_sparse(srcname, dstname)
+    assert(open(dstname, 'rb').read() == open(srcname, 'rb').read())
+    assert(os.stat(dstname).st_blocks <= os.stat(srcname).st_blocks)
+
 
 # test oz.ozutil.string_to_bool
 def test_stb_no():
@@ -433,3 +460,685 @@ def test_md5sum_regular_no_space(tmpdir):
     f.close()
 
     oz.ozutil.get_md5sum_from_file(src, 'Fedora-11-i386-DVD.iso')
+
+# test oz.ozutil.get_sums_from_file
+def test_sums_mixed_formats(tmpdir):
+    src = os.path.join(str(tmpdir), 'sha256sum')
+    f = open(src, 'w')
+    f.write('# comment\n')
+    f.write('SHA256 (Fedora-19-x86_64-DVD.iso) = ' + 'a'*64 + '\n')
+    f.write('b'*64 + ' *Fedora-19-x86_64-netinst.iso\n')
+    f.write('c'*64 + '  Fedora-19-x86_64-netinst.iso\n')
+    f.write('bogus line\n')
+    f.close()
+
+    sums = oz.ozutil.get_sums_from_file(src, 256, 'SHA256')
+    assert(sums == {'Fedora-19-x86_64-DVD.iso': 'a'*64,
+                    'Fedora-19-x86_64-netinst.iso': 'b'*64})
+
+def test_sums_empty_file(tmpdir):
+    src = os.path.join(str(tmpdir), 'sha256sum')
+    open(src, 'w').close()
+    assert(oz.ozutil.get_sums_from_file(src, 256, 'SHA256') == {})
+
+# test oz.ozutil.plan_download_segments
+def test_plan_segments_zero_length():
+    with py.test.raises(Exception):
+        oz.ozutil.plan_download_segments(0, 4)
+
+def test_plan_segments_zero_segments():
+    with py.test.raises(Exception):
+        oz.ozutil.plan_download_segments(1024, 0)
+
+def test_plan_segments_small_file():
+    plan = oz.ozutil.plan_download_segments(1024, 4)
+    assert(plan == [(0, 1023)])
+
+def test_plan_segments_covers_file():
+    length = 100*1024*1024 + 3
+    plan = oz.ozutil.plan_download_segments(length, 4)
+    assert(len(plan) == 4)
+    assert(plan[0][0] == 0)
+    assert(plan[-1][1] == length - 1)
+    for i in range(1, len(plan)):
+        assert(plan[i][0] == plan[i-1][1] + 1)
+
+# test oz.ozutil.pwrite_all
+def test_pwrite_all(tmpdir):
+    fullname = os.path.join(str(tmpdir), 'pwrite')
+    fd = os.open(fullname, os.O_RDWR|os.O_CREAT)
+    oz.ozutil.pwrite_all(fd, b'world', 6)
+    oz.ozutil.pwrite_all(fd, b'hello ', 0)
+    os.close(fd)
+    assert(open(fullname, 'rb').read() == b'hello world')
+
+# test oz.ozutil.http_download_file_segmented
+def test_download_segmented_file_url(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    data = os.urandom(32*1024*1024 + 17)
+    open(src, 'wb').write(data)
+
+    dst = os.path.join(str(tmpdir), 'dst')
+    fd = os.open(dst, os.O_RDWR|os.O_CREAT)
+    oz.ozutil.http_download_file_segmented('file://' + src, fd, False, None,
+                                           len(data), 4)
+    os.close(fd)
+    assert(open(dst, 'rb').read() == data)
+
+def test_download_segmented_resume(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    data = os.urandom(1024*1024)
+    open(src, 'wb').write(data)
+
+    dst = os.path.join(str(tmpdir), 'dst')
+    open(dst, 'wb').write(data[:1000])
+
+    progress = []
+    fd = os.open(dst, os.O_RDWR|os.O_CREAT)
+    oz.ozutil.http_download_file_segmented('file://' + src, fd, False, None,
+                                           len(data), 4,
+                                           [(1000, len(data) - 1)],
+                                           progress.append)
+    os.close(fd)
+    assert(open(dst, 'rb').read() == data)
+    assert(progress[-1] == [[1000, len(data) - 1, len(data) - 1000]])
+
+def test_download_segmented_digest(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    data = os.urandom(32*1024*1024 + 17)
+    open(src, 'wb').write(data)
+
+    dst = os.path.join(str(tmpdir), 'dst')
+    fd = os.open(dst, os.O_RDWR|os.O_CREAT)
+    digests = oz.ozutil.http_download_file_segmented('file://' + src, fd,
+                                                     False, None, len(data), 4,
+                                                     hashnames=['md5', 'sha256'])
+    os.close(fd)
+    assert(digests == {'md5': hashlib.md5(data).hexdigest(),
+                       'sha256': hashlib.sha256(data).hexdigest()})
+
+def test_download_segmented_resume_digest(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    data = os.urandom(1024*1024)
+    open(src, 'wb').write(data)
+
+    dst = os.path.join(str(tmpdir), 'dst')
+    open(dst, 'wb').write(data[:1000])
+
+    fd = os.open(dst, os.O_RDWR|os.O_CREAT)
+    digests = oz.ozutil.http_download_file_segmented('file://' + src, fd,
+                                                     False, None, len(data), 4,
+                                                     [(1000, len(data) - 1)],
+                                                     hashnames=['sha1'])
+    os.close(fd)
+    assert(digests == {'sha1': hashlib.sha1(data).hexdigest()})
+
+def _serve_http(handler):
+    # a threaded HTTP server, since the segments are fetched concurrently
+    try:
+        import BaseHTTPServer as server
+        import SocketServer as socketserver
+    except ImportError:
+        import http.server as server
+        import socketserver
+    import threading
+
+    class Server(socketserver.ThreadingMixIn, server.HTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            # the client hangs up on responses it does not want
+            pass
+
+    httpd = Server(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd
+
+def _bad_range_handler(data, code):
+    try:
+        import BaseHTTPServer as server
+    except ImportError:
+        import http.server as server
+
+    class Handler(server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            # ignore the Range header, and answer with all of data
+            self.send_response(code)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def _download_segmented_rejected(tmpdir, code, body=None):
+    data = os.urandom(16*1024*1024 + 17)
+    httpd = _serve_http(_bad_range_handler(body or data, code))
+    url = 'http://127.0.0.1:%d/src' % (httpd.server_address[1])
+
+    dst = os.path.join(str(tmpdir), 'dst')
+    open(dst, 'wb').write(b'\0' * len(data))
+    progress = []
+    fd = os.open(dst, os.O_RDWR)
+    try:
+        with py.test.raises(Exception):
+            oz.ozutil.http_download_file_segmented(url, fd, False, None,
+                                                   len(data), 2,
+                                                   checkpoint=progress.append)
+    finally:
+        os.close(fd)
+        httpd.shutdown()
+        httpd.server_close()
+
+    # nothing from the rejected responses was written
+    assert(open(dst, 'rb').read() == b'\0' * len(data))
+    return data, dst, progress
+
+def _resume(data, dst, progress):
+    # resume the way Guest does, from the last checkpoint
+    src = dst + '.src'
+    open(src, 'wb').write(data)
+    ranges = [(start + written, end) for start, end, written in progress[-1]
+              if start + written <= end]
+    fd = os.open(dst, os.O_RDWR)
+    oz.ozutil.http_download_file_segmented('file://' + src, fd, False, None,
+                                           len(data), 2, ranges)
+    os.close(fd)
+    assert(open(dst, 'rb').read() == data)
+
+def test_download_segmented_range_ignored(tmpdir):
+    data, dst, progress = _download_segmented_rejected(tmpdir, 200)
+    # none of the rejected data counts as downloaded
+    plan = oz.ozutil.plan_download_segments(len(data), 2)
+    assert(progress[-1] == [[start, end, 0] for start, end in plan])
+    _resume(data, dst, progress)
+
+def test_download_segmented_error_page(tmpdir):
+    data, dst, progress = _download_segmented_rejected(tmpdir, 404,
+                                                       b'<html>Not Found</html>')
+    assert([written for start, end, written in progress[-1]] == [0, 0])
+    _resume(data, dst, progress)
+
+def test_download_segmented_overlong(tmpdir):
+    try:
+        import BaseHTTPServer as server
+    except ImportError:
+        import http.server as server
+
+    data = os.urandom(16*1024*1024 + 17)
+
+    class Handler(server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            # the right range, followed by the rest of the file
+            start, end = [int(x) for x in self.headers['Range'][6:].split('-')]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+            self.send_header('Content-Length', str(len(data) - start))
+            self.end_headers()
+            self.wfile.write(data[start:])
+
+        def log_message(self, *args):
+            pass
+
+    httpd = _serve_http(Handler)
+    url = 'http://127.0.0.1:%d/src' % (httpd.server_address[1])
+    dst = os.path.join(str(tmpdir), 'dst')
+    progress = []
+    fd = os.open(dst, os.O_RDWR|os.O_CREAT)
+    try:
+        with py.test.raises(Exception):
+            oz.ozutil.http_download_file_segmented(url, fd, False, None,
+                                                   len(data), 2,
+                                                   checkpoint=progress.append)
+    finally:
+        os.close(fd)
+        httpd.shutdown()
+        httpd.server_close()
+
+    # the segment that overflowed does not count as done
+    assert(all([written < end - start + 1 for start, end, written in progress[-1]]))
+    _resume(data, dst, progress)
+
+def test_download_segmented_partly_rejected(tmpdir):
+    try:
+        import BaseHTTPServer as server
+    except ImportError:
+        import http.server as server
+
+    data = os.urandom(16*1024*1024 + 17)
+
+    class Handler(server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            start, end = [int(x) for x in self.headers['Range'][6:].split('-')]
+            if start != 0:
+                # only the first segment is served properly
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            self.wfile.write(data[start:end + 1])
+
+        def log_message(self, *args):
+            pass
+
+    httpd = _serve_http(Handler)
+    url = 'http://127.0.0.1:%d/src' % (httpd.server_address[1])
+    dst = os.path.join(str(tmpdir), 'dst')
+    progress = []
+    fd = os.open(dst, os.O_RDWR|os.O_CREAT)
+    try:
+        with py.test.raises(Exception):
+            oz.ozutil.http_download_file_segmented(url, fd, False, None,
+                                                   len(data), 2,
+                                                   checkpoint=progress.append)
+    finally:
+        os.close(fd)
+        httpd.shutdown()
+        httpd.server_close()
+
+    # the accepted data is kept, whether or not the first segment finished
+    # before the second failed
+    first, second = progress[-1]
+    assert(second == [first[1] + 1, len(data) - 1, 0])
+    assert(open(dst, 'rb').read()[:first[2]] == data[:first[2]])
+    _resume(data, dst, progress)
+
+def test_download_segmented_unsupported_scheme(tmpdir):
+    dst = os.path.join(str(tmpdir), 'dst')
+    fd = os.open(dst, os.O_RDWR|os.O_CREAT)
+    try:
+        with py.test.raises(Exception):
+            oz.ozutil.http_download_file_segmented('ftp://127.0.0.1/src', fd,
+                                                   False, None, 1024, 2)
+    finally:
+        os.close(fd)
+    assert(os.path.getsize(dst) == 0)
+
+# test oz.ozutil.http_download_file
+def test_download_file_offset(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'wb').write(b'hello world')
+
+    dst = os.path.join(str(tmpdir), 'dst')
+    open(dst, 'wb').write(b'hello ')
+    fd = os.open(dst, os.O_RDWR)
+    oz.ozutil.http_download_file('file://' + src, fd, False, None, 6)
+    os.close(fd)
+    assert(open(dst, 'rb').read() == b'hello world')
+
+def test_download_file_offset_digest(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'wb').write(b'hello world')
+
+    dst = os.path.join(str(tmpdir), 'dst')
+    open(dst, 'wb').write(b'hello ')
+    fd = os.open(dst, os.O_RDWR)
+    digests = oz.ozutil.http_download_file('file://' + src, fd, False, None, 6,
+                                           hashnames=['sha256'])
+    os.close(fd)
+    assert(digests == {'sha256': hashlib.sha256(b'hello world').hexdigest()})
+
+# test oz.ozutil.StreamHasher
+def test_stream_hasher_out_of_order(tmpdir):
+    fullname = os.path.join(str(tmpdir), 'hashed')
+    fd = os.open(fullname, os.O_RDWR|os.O_CREAT)
+    hasher = oz.ozutil.StreamHasher(fd, ['md5'])
+    oz.ozutil.pwrite_all(fd, b'world', 6)
+    hasher.update(b'world', 6)
+    oz.ozutil.pwrite_all(fd, b'hello ', 0)
+    hasher.update(b'hello ', 0)
+    hasher.catch_up(11)
+    os.close(fd)
+    assert(hasher.hexdigests() == {'md5': hashlib.md5(b'hello world').hexdigest()})
+
+def test_stream_hasher_short_file(tmpdir):
+    fullname = os.path.join(str(tmpdir), 'hashed')
+    open(fullname, 'wb').write(b'hello')
+    fd = os.open(fullname, os.O_RDONLY)
+    hasher = oz.ozutil.StreamHasher(fd, ['md5'])
+    with py.test.raises(Exception):
+        hasher.catch_up(11)
+    os.close(fd)
+
+# test oz.ozutil.read_json_file and oz.ozutil.write_json_file
+def test_json_file_roundtrip(tmpdir):
+    fullname = os.path.join(str(tmpdir), 'sidecar')
+    oz.ozutil.write_json_file(fullname, {'url': 'http://example.com/foo.iso'})
+    assert(oz.ozutil.read_json_file(fullname) == {'url': 'http://example.com/foo.iso'})
+
+def test_json_file_missing(tmpdir):
+    fullname = os.path.join(str(tmpdir), 'sidecar')
+    assert(oz.ozutil.read_json_file(fullname) is None)
+
+def test_json_file_corrupt(tmpdir):
+    fullname = os.path.join(str(tmpdir), 'sidecar')
+    open(fullname, 'w').write('{"url": ')
+    assert(oz.ozutil.read_json_file(fullname) is None)
+
+# test oz.ozutil.unlink_if_exists
+def test_unlink_if_exists(tmpdir):
+    fullname = os.path.join(str(tmpdir), 'file')
+    open(fullname, 'w').write('file')
+    oz.ozutil.unlink_if_exists(fullname)
+    oz.ozutil.unlink_if_exists(fullname)
+    assert(not os.path.exists(fullname))
+
+# test oz.ozutil.HttpSession
+def test_http_session_reuses_handles():
+    session = oz.ozutil.HttpSession()
+    c = session.get_handle()
+    session.put_handle(c)
+    assert(session.get_handle() is c)
+    session.put_handle(c)
+    session.close()
+
+def test_http_session_max_handles():
+    session = oz.ozutil.HttpSession(max_handles=1)
+    c1 = session.get_handle()
+    c2 = session.get_handle()
+    session.put_handle(c1)
+    session.put_handle(c2)
+    assert(session.pool == [c1])
+    session.close()
+
+def test_http_session_download_file(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'wb').write(b'hello world')
+
+    session = oz.ozutil.HttpSession()
+    info = session.get_header('file://' + src)
+    assert(info['http-code'] == 200)
+    # libcurl writes 'Accept-ranges' and 'Content-Length' for files
+    assert(info['accept-ranges'] == 'bytes')
+    assert(info['content-length'] == '11')
+
+    dst = os.path.join(str(tmpdir), 'dst')
+    for i in range(2):
+        fd = os.open(dst, os.O_RDWR|os.O_CREAT|os.O_TRUNC)
+        session.download_file('file://' + src, fd, False, None)
+        os.close(fd)
+        assert(open(dst, 'rb').read() == b'hello world')
+    session.close()
+
+def test_http_session_lowercase_headers():
+    try:
+        import BaseHTTPServer as server
+    except ImportError:
+        import http.server as server
+    import threading
+
+    class Handler(server.BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            # the way HTTP/2 servers write header names
+            self.wfile.write(b"HTTP/1.0 200 OK\r\n"
+                             b"content-length: 11\r\n"
+                             b"accept-ranges: bytes\r\n"
+                             b"etag: \"abc\"\r\n"
+                             b"last-modified: Mon, 01 Jul 2013 00:00:00 GMT\r\n"
+                             b"\r\n")
+
+        def log_message(self, *args):
+            pass
+
+    httpd = server.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.handle_request)
+    thread.start()
+    try:
+        session = oz.ozutil.HttpSession()
+        info = session.get_header('http://127.0.0.1:%d/file' % (httpd.server_address[1]))
+        session.close()
+    finally:
+        thread.join()
+        httpd.server_close()
+
+    assert(info['http-code'] == 200)
+    assert(info['content-length'] == '11')
+    assert(info['accept-ranges'] == 'bytes')
+    assert(info['etag'] == '"abc"')
+    assert(info['last-modified'] == 'Mon, 01 Jul 2013 00:00:00 GMT')
+
+def test_http_session_probe_mirrors(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'wb').write(b'hello world')
+
+    session = oz.ozutil.HttpSession()
+    results = session.probe_mirrors(['file://' + src,
+                                     'file://' + os.path.join(str(tmpdir), 'missing')])
+    assert(len(results) == 1)
+    assert(results[0][0] == 'file://' + src)
+    session.close()
+
+def _serve_ftp(data):
+    # just enough of an anonymous FTP server for libcurl to fetch one file
+    import socket
+    import threading
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    def _session():
+        while True:
+            try:
+                conn, addr = listener.accept()
+            except socket.error:
+                return
+            f = conn.makefile('rb')
+            conn.sendall(b"220 ready\r\n")
+            passive = None
+            rest = 0
+            while True:
+                line = f.readline().decode('ascii').strip()
+                if not line:
+                    break
+                cmd = line.split(' ', 1)[0].upper()
+                arg = line[len(cmd) + 1:]
+                if cmd == 'USER':
+                    conn.sendall(b"331 password please\r\n")
+                elif cmd == 'PASS':
+                    conn.sendall(b"230 logged in\r\n")
+                elif cmd == 'PWD':
+                    conn.sendall(b"257 \"/\"\r\n")
+                elif cmd == 'TYPE':
+                    conn.sendall(b"200 ok\r\n")
+                elif cmd == 'SIZE':
+                    conn.sendall(("213 %d\r\n" % (len(data))).encode('ascii'))
+                elif cmd == 'REST':
+                    rest = int(arg)
+                    conn.sendall(b"350 ok\r\n")
+                elif cmd == 'EPSV':
+                    passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    passive.bind(('127.0.0.1', 0))
+                    passive.listen(1)
+                    conn.sendall(("229 passive (|||%d|)\r\n" % (passive.getsockname()[1])).encode('ascii'))
+                elif cmd == 'RETR':
+                    conn.sendall(b"150 sending\r\n")
+                    dataconn, addr = passive.accept()
+                    dataconn.sendall(data[rest:])
+                    dataconn.close()
+                    passive.close()
+                    conn.sendall(b"226 done\r\n")
+                elif cmd == 'QUIT':
+                    conn.sendall(b"221 bye\r\n")
+                    break
+                else:
+                    conn.sendall(b"502 not implemented\r\n")
+            f.close()
+            conn.close()
+
+    thread = threading.Thread(target=_session)
+    thread.daemon = True
+    thread.start()
+    return listener
+
+def test_http_session_ftp(tmpdir):
+    data = b'hello world'
+    listener = _serve_ftp(data)
+    url = 'ftp://127.0.0.1:%d/src' % (listener.getsockname()[1])
+    try:
+        session = oz.ozutil.HttpSession()
+        info = session.get_header(url)
+        # libcurl claims byte range support for FTP too, but segmented
+        # downloads need HTTP status codes, so they refuse FTP URLs
+        assert(info['accept-ranges'] == 'bytes')
+        assert(info['content-length'] == '11')
+
+        dst = os.path.join(str(tmpdir), 'dst')
+        fd = os.open(dst, os.O_RDWR|os.O_CREAT)
+        try:
+            with py.test.raises(Exception):
+                session.download_file_segmented(url, fd, False, None,
+                                                 len(data), 2)
+            digests = session.download_file(url, fd, False, None,
+                                            hashnames=['sha256'])
+        finally:
+            os.close(fd)
+        session.close()
+    finally:
+        listener.close()
+
+    assert(open(dst, 'rb').read() == data)
+    assert(digests == {'sha256': hashlib.sha256(data).hexdigest()})
+
+# test oz.ozutil.copy_range
+def test_copy_range(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'wb').write(b'0123456789')
+    dst = os.path.join(str(tmpdir), 'dst')
+
+    infd = os.open(src, os.O_RDONLY)
+    outfd = os.open(dst, os.O_WRONLY|os.O_CREAT)
+    oz.ozutil.copy_range(infd, outfd, 2, 3)
+    oz.ozutil.copy_range(infd, outfd, 8, 2)
+    os.close(outfd)
+    os.close(infd)
+    assert(open(dst, 'rb').read() == b'23489')
+
+def test_copy_range_short(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'wb').write(b'0123')
+    dst = os.path.join(str(tmpdir), 'dst')
+
+    infd = os.open(src, os.O_RDONLY)
+    outfd = os.open(dst, os.O_WRONLY|os.O_CREAT)
+    try:
+        with py.test.raises(Exception):
+            oz.ozutil.copy_range(infd, outfd, 2, 10)
+    finally:
+        os.close(outfd)
+        os.close(infd)
+
+def test_clone_file(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'wb').write(b'0123456789'*1000)
+    dst = os.path.join(str(tmpdir), 'dst')
+    open(dst, 'wb').write(b'old contents that are longer'*1000)
+
+    oz.ozutil.clone_file(src, dst)
+    assert(open(dst, 'rb').read() == b'0123456789'*1000)
+
+def test_rmtree_and_sync_writable(tmpdir):
+    top = os.path.join(str(tmpdir), 'top')
+    sub = os.path.join(top, 'sub')
+    os.makedirs(sub)
+    open(os.path.join(sub, 'file'), 'w').write('contents')
+    os.chmod(sub, 0o555)
+
+    oz.ozutil.rmtree_and_sync(top, writable=True)
+    assert(not os.path.exists(top))
+
+def test_rmtree_deferred(tmpdir):
+    top = os.path.join(str(tmpdir), 'top')
+    os.makedirs(os.path.join(top, 'sub'))
+    open(os.path.join(top, 'sub', 'file'), 'w').write('contents')
+    trash = os.path.join(str(tmpdir), 'trash')
+
+    helper = oz.ozutil.rmtree_deferred(top, trash)
+    # the path can be reused right away
+    assert(not os.path.exists(top))
+    assert(helper.wait() == 0)
+    assert(os.listdir(trash) == [])
+
+def test_rmtree_deferred_missing(tmpdir):
+    trash = os.path.join(str(tmpdir), 'trash')
+    assert(oz.ozutil.rmtree_deferred(os.path.join(str(tmpdir), 'missing'), trash) is None)
+    assert(os.listdir(trash) == [])
+
+# test oz.ozutil.create_qcow2
+def test_create_qcow2(tmpdir):
+    path = os.path.join(str(tmpdir), 'disk.qcow2')
+    size = 10*1024*1024*1024
+    oz.ozutil.create_qcow2(path, size)
+
+    data = open(path, 'rb').read()
+    (magic, version, backing_offset, backing_size, cluster_bits, disksize,
+     crypt, l1_size, l1_offset, refcount_offset, refcount_clusters,
+     nb_snapshots, snapshots_offset) = struct.unpack_from('>4sIQIIQIIQQIIQ',
+                                                          data)
+    assert(magic == b'QFI\xfb')
+    assert(version == 2)
+    assert(backing_offset == 0)
+    assert(disksize == size)
+    cluster_size = 1 << cluster_bits
+    # every L1 entry covers 512MB with 64KB clusters
+    assert(l1_size == 20)
+    assert(data[l1_offset:l1_offset + l1_size*8] == b'\0'*l1_size*8)
+    assert(len(data) == 4*cluster_size)
+
+    # each of the 4 clusters is referenced once
+    block = struct.unpack_from('>Q', data, refcount_offset)[0]
+    assert(struct.unpack_from('>5H', data, block) == (1, 1, 1, 1, 0))
+
+def test_create_qcow2_exists(tmpdir):
+    path = os.path.join(str(tmpdir), 'disk.qcow2')
+    open(path, 'w').write('disk')
+    with py.test.raises(OSError):
+        oz.ozutil.create_qcow2(path, 1024*1024)
+
+# test oz.ozutil.qcow2_backing_file
+def test_qcow2_backing_file(tmpdir):
+    path = os.path.join(str(tmpdir), 'disk.qcow2')
+    assert(oz.ozutil.qcow2_backing_file(path) is None)
+    oz.ozutil.create_qcow2(path, 1024*1024)
+    assert(oz.ozutil.qcow2_backing_file(path) is None)
+
+    # point the header at a backing file name in the unused part of the
+    # header cluster
+    f = open(path, 'r+b')
+    f.seek(8)
+    f.write(struct.pack('>QI', 1024, len(b'/jeos/base.qcow2')))
+    f.seek(1024)
+    f.write(b'/jeos/base.qcow2')
+    f.close()
+    assert(oz.ozutil.qcow2_backing_file(path) == '/jeos/base.qcow2')
+
+def test_qcow2_backing_file_not_qcow2(tmpdir):
+    path = os.path.join(str(tmpdir), 'disk.raw')
+    open(path, 'wb').write(b'\0' * 1024)
+    assert(oz.ozutil.qcow2_backing_file(path) is None)
+
+# test oz.ozutil.parse_size
+def test_parse_size():
+    assert(oz.ozutil.parse_size('1048576') == 1048576)
+    assert(oz.ozutil.parse_size('500M') == 500*1024*1024)
+    assert(oz.ozutil.parse_size('20g') == 20*1024**3)
+    assert(oz.ozutil.parse_size('1.5GiB') == 1536*1024*1024)
+    assert(oz.ozutil.parse_size('2TB') == 2*1024**4)
+
+def test_parse_size_invalid():
+    for value in ['', 'G', 'abc', '-1G', '10X']:
+        with py.test.raises(Exception):
+            oz.ozutil.parse_size(value)
+
+def test_format_size():
+    assert(oz.ozutil.format_size(100) == '100')
+    assert(oz.ozutil.format_size(1536) == '1.5K')
+    assert(oz.ozutil.format_size(20*1024**3) == '20.0G')
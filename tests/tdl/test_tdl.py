@@ -90,6 +90,9 @@ tests = {
     "test-53-command-http-url.tdl": True,
     "test-54-files-file-url.tdl": True,
     "test-55-files-http-url.tdl": True,
+    "test-56-url-mirrors.tdl": True,
+    "test-57-url-empty-mirror.tdl": False,
+    "test-58-iso-no-os.tdl": True,
 }
 
 # Validate oz handling of tdl file
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+import sys
+import os
+import stat
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.TreeCache
+except ImportError as e:
+    print(e)
+    print('Unable to import oz.  Is oz installed or in your PYTHONPATH?')
+    sys.exit(1)
+
+def _populate(calls):
+    def populate(dest):
+        calls.append(dest)
+        os.mkdir(os.path.join(dest, 'isolinux'))
+        open(os.path.join(dest, 'isolinux', 'isolinux.cfg'), 'w').write('cfg')
+        open(os.path.join(dest, 'vmlinuz'), 'w').write('kernel')
+        os.symlink('vmlinuz', os.path.join(dest, 'link'))
+    return populate
+
+def test_get_populates_once(tmpdir):
+    cache = oz.TreeCache.TreeCache(os.path.join(str(tmpdir), 'trees'), 2)
+    calls = []
+    tree = cache.get('abc', _populate(calls))
+    assert(tree == cache.tree_path('abc'))
+    assert(cache.get('abc', _populate(calls)) == tree)
+    assert(len(calls) == 1)
+    assert(open(os.path.join(tree, 'vmlinuz')).read() == 'kernel')
+
+def test_get_failed_populate(tmpdir):
+    cache = oz.TreeCache.TreeCache(os.path.join(str(tmpdir), 'trees'), 2)
+    def populate(dest):
+        raise Exception("extraction failed")
+    with py.test.raises(Exception):
+        cache.get('abc', populate)
+    assert(not os.path.exists(cache.tree_path('abc')))
+    assert(not os.path.exists(cache.tree_path('abc') + ".tmp"))
+
+def test_clone_links_unmodified(tmpdir):
+    cache = oz.TreeCache.TreeCache(os.path.join(str(tmpdir), 'trees'), 2)
+    cache.link_files = True
+    tree = cache.get('abc', _populate([]))
+    dest = os.path.join(str(tmpdir), 'clone')
+    os.mkdir(dest)
+    cache.clone('abc', dest, ['isolinux/isolinux.cfg'])
+
+    cfg = os.path.join(dest, 'isolinux', 'isolinux.cfg')
+    assert(not os.path.samefile(cfg, os.path.join(tree, 'isolinux', 'isolinux.cfg')))
+    assert(os.path.samefile(os.path.join(dest, 'vmlinuz'), os.path.join(tree, 'vmlinuz')))
+    assert(os.readlink(os.path.join(dest, 'link')) == 'vmlinuz')
+
+    # modifying the declared file leaves the cache alone
+    open(cfg, 'w').write('changed')
+    assert(open(os.path.join(tree, 'isolinux', 'isolinux.cfg')).read() == 'cfg')
+
+def test_clone_undeclared(tmpdir):
+    cache = oz.TreeCache.TreeCache(os.path.join(str(tmpdir), 'trees'), 2)
+    tree = cache.get('abc', _populate([]))
+    dest = os.path.join(str(tmpdir), 'clone')
+    os.mkdir(dest)
+    cache.clone('abc', dest, None)
+
+    kernel = os.path.join(dest, 'vmlinuz')
+    assert(not os.path.samefile(kernel, os.path.join(tree, 'vmlinuz')))
+    assert(open(kernel).read() == 'kernel')
+
+def test_clone_as_root(tmpdir, monkeypatch):
+    monkeypatch.setattr(os, 'geteuid', lambda: 0)
+    cache = oz.TreeCache.TreeCache(os.path.join(str(tmpdir), 'trees'), 2)
+    tree = cache.get('abc', _populate([]))
+    dest = os.path.join(str(tmpdir), 'clone')
+    os.mkdir(dest)
+    cache.clone('abc', dest, ['isolinux/isolinux.cfg'])
+
+    # root could write through a hard link, so nothing is shared
+    kernel = os.path.join(dest, 'vmlinuz')
+    assert(not os.path.samefile(kernel, os.path.join(tree, 'vmlinuz')))
+    open(kernel, 'w').write('changed')
+    assert(open(os.path.join(tree, 'vmlinuz')).read() == 'kernel')
+
+def test_evicts_least_recently_used(tmpdir):
+    cache = oz.TreeCache.TreeCache(os.path.join(str(tmpdir), 'trees'), 2)
+    cache.get('a', _populate([]))
+    cache.get('b', _populate([]))
+    cache.get('a', _populate([]))
+    cache.get('c', _populate([]))
+    assert(os.path.isdir(cache.tree_path('a')))
+    assert(not os.path.exists(cache.tree_path('b')))
+    assert(os.path.isdir(cache.tree_path('c')))
+
+def test_cached_tree_read_only(tmpdir):
+    cache = oz.TreeCache.TreeCache(os.path.join(str(tmpdir), 'trees'), 2)
+    cache.link_files = True
+    tree = cache.get('abc', _populate([]))
+    dest = os.path.join(str(tmpdir), 'clone')
+    os.mkdir(dest)
+    cache.clone('abc', dest, ['isolinux/isolinux.cfg'])
+
+    # the hard links share the read-only mode of the cached tree
+    writable = stat.S_IWUSR|stat.S_IWGRP|stat.S_IWOTH
+    assert(not os.stat(os.path.join(tree, 'vmlinuz')).st_mode & writable)
+    assert(not os.stat(os.path.join(dest, 'vmlinuz')).st_mode & writable)
+    # the copies can be modified, and so can the directories
+    assert(os.stat(os.path.join(dest, 'isolinux', 'isolinux.cfg')).st_mode & stat.S_IWUSR)
+    assert(os.stat(os.path.join(dest, 'isolinux')).st_mode & stat.S_IWUSR)
+
+def test_get_other_digest_not_blocked(tmpdir):
+    cache = oz.TreeCache.TreeCache(os.path.join(str(tmpdir), 'trees'), 2)
+    os.makedirs(cache.cache_dir)
+
+    # another build is busy extracting a different ISO
+    locked_r, locked_w = os.pipe()
+    done_r, done_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        def populate(dest):
+            os.write(locked_w, b'x')
+            os.read(done_r, 1)
+        try:
+            cache.get('a', populate)
+        finally:
+            os._exit(0)
+    try:
+        os.read(locked_r, 1)
+        # this would block forever if get() held a global lock for the
+        # whole extraction
+        tree = cache.get('b', _populate([]))
+    finally:
+        os.write(done_w, b'x')
+        os.waitpid(pid, 0)
+    assert(os.path.isdir(tree))